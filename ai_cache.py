@@ -0,0 +1,224 @@
+"""
+AI Response Cache for ChirpX
+Two-tier cache under AIService._call_groq: an in-memory LRU per worker in
+front of a persistent SQLite tier (the ai_cache table) shared by all workers
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import db
+
+# Settings (override through environment variables)
+AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', '1') == '1'
+AI_CACHE_MEMORY_ENTRIES = int(os.getenv('AI_CACHE_MEMORY_ENTRIES', '1024'))
+AI_CACHE_PERSISTENT = os.getenv('AI_CACHE_PERSISTENT', '1') == '1'
+# Hits on the shared tier are counted in memory and written out at most this often
+AI_CACHE_HIT_FLUSH_SECONDS = float(os.getenv('AI_CACHE_HIT_FLUSH_SECONDS', '60'))
+
+# Seconds a response stays cached, per task. 0 disables caching for the task.
+# Tasks sampled at a non-zero temperature are listed here on purpose: reusing
+# one good answer for a while is preferable to paying for a fresh one.
+TASK_TTLS: Dict[str, int] = {
+    'analyze_chirp': 7 * 24 * 3600,
+    'moderation': 7 * 24 * 3600,
+    'spam': 24 * 3600,
+    'sentiment': 7 * 24 * 3600,
+    'hashtags': 24 * 3600,
+    'reply_suggestions': 3600,
+    'enhance_content': 3600,
+    'trending_topics': 300,
+    'conversation_summary': 600,
+    'image_prompt': 0,  # Users expect a new take on every generation
+}
+# Tasks without a policy are cached only when sampled deterministically
+DEFAULT_TTL = int(os.getenv('AI_CACHE_DEFAULT_TTL', '3600'))
+
+
+def ttl_for(task: str, temperature: float) -> int:
+    """How long to cache a response for task; 0 means do not cache"""
+    if not AI_CACHE_ENABLED:
+        return 0
+    if task in TASK_TTLS:
+        return TASK_TTLS[task]
+    return DEFAULT_TTL if temperature == 0 else 0
+
+
+def make_key(model: str, messages: List[Dict], **params) -> str:
+    """Stable hash of everything that determines a completion"""
+    raw = json.dumps({'model': model, 'messages': messages, 'params': params},
+                     sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe LRU with a per-entry expiry time"""
+
+    def __init__(self, max_entries: int = AI_CACHE_MEMORY_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[str, Tuple[float, str]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, expires_at: float) -> None:
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_memory = LRUCache()
+_local = threading.local()
+_counters: Counter = Counter()
+_counters_lock = threading.Lock()
+
+
+def _count(task: str, outcome: str) -> None:
+    with _counters_lock:
+        _counters[(task, outcome)] += 1
+
+
+_pending_hits: Counter = Counter()
+_last_flush = time.monotonic()
+
+
+def _record_hit(key: str) -> bool:
+    """Count a shared-tier hit; True when the pending counts are due to be written"""
+    with _counters_lock:
+        _pending_hits[key] += 1
+        return time.monotonic() - _last_flush >= AI_CACHE_HIT_FLUSH_SECONDS
+
+
+def flush_hits(conn: Optional[sqlite3.Connection] = None) -> None:
+    """Add the hits counted since the last flush to ai_cache.hits, in one transaction"""
+    global _last_flush
+    with _counters_lock:
+        pending = list(_pending_hits.items())
+        _pending_hits.clear()
+        _last_flush = time.monotonic()
+    if not pending:
+        return
+    conn = conn or _connection()
+    try:
+        conn.executemany('UPDATE ai_cache SET hits = hits + ? WHERE key = ?', [(n, key) for key, n in pending])
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        print(f"AI cache hit count error: {str(e)}")
+
+
+atexit.register(flush_hits)
+
+
+def _connection() -> sqlite3.Connection:
+    """One connection per thread for the persistent tier"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'pid', None) != os.getpid():
+        conn = _local.conn = db.connect()
+        _local.pid = os.getpid()
+    return conn
+
+
+def get(key: str, task: str) -> Optional[str]:
+    """Look key up in memory, then in SQLite (promoting a hit to memory)"""
+    value = _memory.get(key)
+    if value is not None:
+        _count(task, 'memory_hit')
+        return value
+
+    if AI_CACHE_PERSISTENT:
+        try:
+            conn = _connection()
+            row = conn.execute('SELECT response, expires_at FROM ai_cache WHERE key = ? AND expires_at > ?',
+                               (key, time.time())).fetchone()
+            if row:
+                # Reads stay read-only; the hit is written out later with others
+                if _record_hit(key):
+                    flush_hits(conn)
+                _memory.set(key, row['response'], row['expires_at'])
+                _count(task, 'sqlite_hit')
+                return row['response']
+        except sqlite3.Error as e:
+            print(f"AI cache read error: {str(e)}")
+
+    _count(task, 'miss')
+    return None
+
+
+def put(key: str, task: str, response: str, ttl: int) -> None:
+    """Store a response in both tiers for ttl seconds"""
+    expires_at = time.time() + ttl
+    _memory.set(key, response, expires_at)
+
+    if AI_CACHE_PERSISTENT:
+        try:
+            conn = _connection()
+            conn.execute('''
+                INSERT INTO ai_cache (key, task, response, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    response = excluded.response,
+                    expires_at = excluded.expires_at
+            ''', (key, task, response, expires_at))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"AI cache write error: {str(e)}")
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """This process's hit/miss counters by task"""
+    result: Dict[str, Dict[str, int]] = {}
+    with _counters_lock:
+        for (task, outcome), n in _counters.items():
+            result.setdefault(task, {'memory_hit': 0, 'sqlite_hit': 0, 'miss': 0})[outcome] = n
+    return result
+
+
+def persistent_stats(conn: sqlite3.Connection) -> List[sqlite3.Row]:
+    """Live entries and lifetime hits per task in the shared tier"""
+    flush_hits(conn)
+    return conn.execute('''
+        SELECT task, COUNT(*) AS entries, COALESCE(SUM(hits), 0) AS hits
+        FROM ai_cache WHERE expires_at > ?
+        GROUP BY task ORDER BY task
+    ''', (time.time(),)).fetchall()
+
+
+def purge_expired(conn: sqlite3.Connection) -> int:
+    """Delete expired entries from the shared tier. Returns how many were removed."""
+    return conn.execute('DELETE FROM ai_cache WHERE expires_at <= ?', (time.time(),)).rowcount
+
+
+def clear(conn: sqlite3.Connection) -> int:
+    """Drop every cached response. Returns how many shared entries were removed."""
+    _memory.clear()
+    return conn.execute('DELETE FROM ai_cache').rowcount
@@ -5,11 +5,12 @@ Provides AI-powered features using Groq API
 
 import os
 from groq import Groq
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 import json
 import re
-import requests
-import time
+
+import ai_cache
+import groq_client
 
 class AIService:
     def __init__(self, api_key: Optional[str] = None):
@@ -17,22 +18,79 @@ class AIService:
         self.api_key = api_key or os.getenv('GROQ_API_KEY')
         if not self.api_key:
             raise ValueError("GROQ_API_KEY not found. Please set it in your environment or .env file")
-        self.client = Groq(api_key=self.api_key)
+        # Retries are handled by groq_client so they share one deadline and breaker
+        self.client = Groq(api_key=self.api_key, max_retries=0)
         self.model = "llama-3.3-70b-versatile"  # Fast and capable model
     
-    def _call_groq(self, messages: List[Dict], temperature: float = 0.7, max_tokens: int = 500) -> str:
-        """Make a call to Groq API"""
+    def _call_groq(self, messages: List[Dict], temperature: float = 0.7, max_tokens: int = 500,
+                   response_format: Optional[Dict] = None, task: str = 'default') -> str:
+        """
+        Make a call to Groq API
+        Responses are cached per task (see ai_cache.TASK_TTLS), keyed by the model,
+        messages and sampling parameters.
+        """
+        ttl = ai_cache.ttl_for(task, temperature)
+        if ttl:
+            cache_key = ai_cache.make_key(self.model, messages, temperature=temperature,
+                                          max_tokens=max_tokens, response_format=response_format)
+            cached = ai_cache.get(cache_key, task)
+            if cached is not None:
+                return cached
+        
+        options = {}
+        if response_format:
+            options['response_format'] = response_format
         try:
-            chat_completion = self.client.chat.completions.create(
+            chat_completion = groq_client.call(lambda timeout: self.client.chat.completions.create(
                 messages=messages,
                 model=self.model,
                 temperature=temperature,
                 max_tokens=max_tokens,
-            )
-            return chat_completion.choices[0].message.content.strip()
+                timeout=timeout,
+                **options,
+            ))
+            response = chat_completion.choices[0].message.content.strip()
         except Exception as e:
             print(f"Groq API Error: {str(e)}")
             return None
+        
+        if ttl and response:
+            ai_cache.put(cache_key, task, response, ttl)
+        return response
+    
+    def _stream_groq(self, messages: List[Dict], temperature: float = 0.7, max_tokens: int = 500,
+                     task: str = 'default') -> Iterator[str]:
+        """
+        Stream a completion from Groq API as text deltas
+        Shares _call_groq's cache: a cached response is yielded in one piece, and a
+        completed stream is cached for both. Errors are raised to the caller.
+        """
+        ttl = ai_cache.ttl_for(task, temperature)
+        if ttl:
+            cache_key = ai_cache.make_key(self.model, messages, temperature=temperature,
+                                          max_tokens=max_tokens, response_format=None)
+            cached = ai_cache.get(cache_key, task)
+            if cached is not None:
+                yield cached
+                return
+        
+        parts = []
+        for chunk in groq_client.stream(lambda timeout: self.client.chat.completions.create(
+                messages=messages,
+                model=self.model,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                timeout=timeout,
+                stream=True,
+        )):
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+        
+        response = ''.join(parts).strip()
+        if ttl and response:
+            ai_cache.put(cache_key, task, response, ttl)
     
     def moderate_content(self, content: str) -> Dict:
         """
@@ -64,7 +122,7 @@ Respond ONLY in JSON format:
             {"role": "user", "content": prompt}
         ]
         
-        response = self._call_groq(messages, temperature=0.3, max_tokens=200)
+        response = self._call_groq(messages, temperature=0.3, max_tokens=200, task='moderation')
         
         if response:
             try:
@@ -78,11 +136,7 @@ Respond ONLY in JSON format:
         # Default safe response if API fails
         return {"is_safe": True, "reason": "", "categories": []}
     
-    def generate_reply_suggestions(self, chirp_content: str, num_suggestions: int = 3) -> List[str]:
-        """
-        Generate smart reply suggestions for a chirp
-        Returns list of suggested replies
-        """
+    def _reply_suggestion_messages(self, chirp_content: str, num_suggestions: int) -> List[Dict]:
         prompt = f"""Generate {num_suggestions} brief, engaging reply suggestions (max 100 characters each) for this social media post:
 
 "{chirp_content}"
@@ -95,28 +149,63 @@ Requirements:
 
 Respond with ONLY the suggestions, one per line, numbered 1-{num_suggestions}."""
 
-        messages = [
+        return [
             {"role": "system", "content": "You are a helpful assistant that generates engaging social media replies."},
             {"role": "user", "content": prompt}
         ]
-        
-        response = self._call_groq(messages, temperature=0.8, max_tokens=300)
+    
+    @staticmethod
+    def _parse_reply_suggestion(line: str) -> Optional[str]:
+        """One numbered suggestion line, cleaned, or None if it is not usable"""
+        line = line.strip()
+        # Remove numbering (1., 2., etc.)
+        cleaned = re.sub(r'^\d+[\.\)]\s*', '', line)
+        # Remove quotes if present
+        cleaned = cleaned.strip('"\'')
+        if cleaned and len(cleaned) <= 150:
+            return cleaned
+        return None
+    
+    def generate_reply_suggestions(self, chirp_content: str, num_suggestions: int = 3) -> List[str]:
+        """
+        Generate smart reply suggestions for a chirp
+        Returns list of suggested replies
+        """
+        messages = self._reply_suggestion_messages(chirp_content, num_suggestions)
+        response = self._call_groq(messages, temperature=0.8, max_tokens=300, task='reply_suggestions')
         
         if response:
             # Parse numbered suggestions
             suggestions = []
             for line in response.split('\n'):
-                line = line.strip()
-                # Remove numbering (1., 2., etc.)
-                cleaned = re.sub(r'^\d+[\.\)]\s*', '', line)
-                # Remove quotes if present
-                cleaned = cleaned.strip('"\'')
-                if cleaned and len(cleaned) <= 150:
+                cleaned = self._parse_reply_suggestion(line)
+                if cleaned:
                     suggestions.append(cleaned)
             return suggestions[:num_suggestions]
         
         return []
     
+    def stream_reply_suggestions(self, chirp_content: str, num_suggestions: int = 3) -> Iterator[str]:
+        """
+        Like generate_reply_suggestions, but yields each suggestion as soon as its
+        line is complete. Raises if Groq is unavailable.
+        """
+        messages = self._reply_suggestion_messages(chirp_content, num_suggestions)
+        buffer = ''
+        count = 0
+        for delta in self._stream_groq(messages, temperature=0.8, max_tokens=300, task='reply_suggestions'):
+            buffer += delta
+            *lines, buffer = buffer.split('\n')
+            for line in lines:
+                cleaned = self._parse_reply_suggestion(line)
+                if cleaned and count < num_suggestions:
+                    count += 1
+                    yield cleaned
+        
+        cleaned = self._parse_reply_suggestion(buffer)
+        if cleaned and count < num_suggestions:
+            yield cleaned
+    
     def analyze_sentiment(self, content: str) -> Dict:
         """
         Analyze the sentiment of a chirp
@@ -144,7 +233,7 @@ Common emotions: joy, sadness, anger, fear, surprise, love, excitement, frustrat
             {"role": "user", "content": prompt}
         ]
         
-        response = self._call_groq(messages, temperature=0.3, max_tokens=200)
+        response = self._call_groq(messages, temperature=0.3, max_tokens=200, task='sentiment')
         
         if response:
             try:
@@ -182,7 +271,7 @@ AI"""
             {"role": "user", "content": prompt}
         ]
         
-        response = self._call_groq(messages, temperature=0.7, max_tokens=150)
+        response = self._call_groq(messages, temperature=0.7, max_tokens=150, task='hashtags')
         
         if response:
             tags = []
@@ -228,7 +317,7 @@ Respond in JSON format:
             {"role": "user", "content": prompt}
         ]
         
-        response = self._call_groq(messages, temperature=0.7, max_tokens=400)
+        response = self._call_groq(messages, temperature=0.7, max_tokens=400, task='enhance_content')
         
         if response:
             try:
@@ -240,6 +329,84 @@ Respond in JSON format:
         
         return {"improved_content": content, "suggestions": []}
     
+    def stream_enhance_content(self, content: str) -> Iterator[Tuple[str, object]]:
+        """
+        Streaming version of enhance_content
+        Yields ('content', text delta) while the improved post is generated, then
+        ('tip', tip) for each improvement tip, and finally ('done', result) with
+        the same dict enhance_content returns. Raises if Groq is unavailable.
+        """
+        prompt = f"""Improve this social media post to make it more engaging while keeping the original message:
+
+Original: "{content}"
+
+Requirements:
+- Keep it under 280 characters
+- Maintain the original tone and message
+- Make it more engaging and clear
+- Fix any grammar issues
+
+Respond in exactly this format, with no quotes around the post:
+<the improved version>
+TIPS:
+- tip1
+- tip2
+- tip3"""
+
+        messages = [
+            {"role": "system", "content": "You are a social media writing coach. Follow the requested format exactly."},
+            {"role": "user", "content": prompt}
+        ]
+        
+        marker = 'TIPS:'
+        text = ''
+        sent = 0  # Characters of the improved post already yielded
+        improved = None
+        tips = []
+        tip_buffer = ''
+        
+        def parse_tip(line: str) -> Optional[str]:
+            tip = re.sub(r'^\s*(?:[-*•]|\d+[\.\)])\s*', '', line).strip()
+            return tip or None
+        
+        for delta in self._stream_groq(messages, temperature=0.7, max_tokens=400, task='enhance_content'):
+            if improved is None:
+                text += delta
+                index = text.find(marker)
+                if index >= 0:
+                    improved = text[:index].strip()
+                    if len(text[:index].rstrip()) > sent:
+                        yield 'content', text[sent:len(text[:index].rstrip())]
+                    tip_buffer = text[index + len(marker):]
+                else:
+                    # Hold back anything that could be the start of the marker
+                    safe = len(text) - len(marker) + 1
+                    if safe > sent:
+                        yield 'content', text[sent:safe]
+                        sent = safe
+                    continue
+            else:
+                tip_buffer += delta
+            
+            *lines, tip_buffer = tip_buffer.split('\n')
+            for line in lines:
+                tip = parse_tip(line)
+                if tip:
+                    tips.append(tip)
+                    yield 'tip', tip
+        
+        if improved is None:
+            improved = text.strip()
+            if len(text.rstrip()) > sent:
+                yield 'content', text[sent:len(text.rstrip())]
+        else:
+            tip = parse_tip(tip_buffer)
+            if tip:
+                tips.append(tip)
+                yield 'tip', tip
+        
+        yield 'done', {"improved_content": improved or content, "suggestions": tips}
+    
     def detect_spam(self, content: str, user_history: Optional[Dict] = None) -> Dict:
         """
         Detect if content is spam or suspicious
@@ -277,7 +444,7 @@ Respond ONLY in JSON format:
             {"role": "user", "content": prompt}
         ]
         
-        response = self._call_groq(messages, temperature=0.2, max_tokens=200)
+        response = self._call_groq(messages, temperature=0.2, max_tokens=200, task='spam')
         
         if response:
             try:
@@ -289,6 +456,92 @@ Respond ONLY in JSON format:
         
         return {"is_spam": False, "confidence": 0.0, "reason": ""}
     
+    def analyze_chirp(self, content: str, user_history: Optional[Dict] = None, num_tags: int = 5) -> Optional[Dict]:
+        """
+        Moderation, spam detection, sentiment and hashtags for a chirp in a single call
+        Returns: {
+            'moderation': {'is_safe': bool, 'reason': str, 'categories': list},
+            'spam': {'is_spam': bool, 'confidence': float (0-1), 'reason': str},
+            'sentiment': 'positive'/'negative'/'neutral',
+            'score': float (-1 to 1),
+            'emotions': list of detected emotions,
+            'hashtags': list of hashtag suggestions (without #)
+        }
+        or None if the API call failed or returned something unusable
+        """
+        history_context = ""
+        if user_history:
+            history_context = f"\nUser has posted {user_history.get('post_count', 0)} times today."
+        
+        prompt = f"""Analyze this social media post:
+
+"{content}"{history_context}
+
+1. Moderation - check for hate speech, harassment, bullying, violence, graphic, sexual or adult content, personal attacks or threats.
+2. Spam - check for excessive links or promotion, repetitive messages, suspicious URLs, get-rich-quick schemes, phishing and too many hashtags.
+3. Sentiment - overall sentiment, a score from -1 (very negative) to 1 (very positive) and the primary emotions (joy, sadness, anger, fear, surprise, love, excitement, frustration, hope).
+4. Hashtags - {num_tags} relevant, concise (1-2 words) hashtags without the # symbol.
+
+Respond ONLY with a JSON object with exactly these keys:
+{{
+    "moderation": {{"is_safe": true/false, "reason": "brief explanation if not safe, empty string if safe", "categories": ["list", "of", "violations"] or []}},
+    "spam": {{"is_spam": true/false, "confidence": number between 0 and 1, "reason": "brief explanation"}},
+    "sentiment": "positive" or "negative" or "neutral",
+    "score": number between -1 and 1,
+    "emotions": ["list", "of", "emotions"],
+    "hashtags": ["Tag1", "Tag2"]
+}}"""
+
+        messages = [
+            {"role": "system", "content": "You are a content analysis assistant for a social network. Respond only with valid JSON matching the requested schema."},
+            {"role": "user", "content": prompt}
+        ]
+        
+        response = self._call_groq(messages, temperature=0.2, max_tokens=400, task='analyze_chirp',
+                                   response_format={"type": "json_object"})
+        
+        if response:
+            try:
+                json_match = re.search(r'\{.*\}', response, re.DOTALL)
+                if json_match:
+                    return self._normalize_chirp_analysis(json.loads(json_match.group()), num_tags)
+            except (json.JSONDecodeError, TypeError, ValueError, AttributeError):
+                pass
+        
+        return None
+    
+    @staticmethod
+    def _normalize_chirp_analysis(data: Dict, num_tags: int) -> Dict:
+        """Coerce a model response into the analyze_chirp schema, filling safe defaults"""
+        moderation = data.get('moderation') or {}
+        spam = data.get('spam') or {}
+        sentiment = str(data.get('sentiment', 'neutral')).lower()
+        if sentiment not in ('positive', 'negative', 'neutral'):
+            sentiment = 'neutral'
+        
+        tags = []
+        for tag in data.get('hashtags') or []:
+            cleaned = re.sub(r'^[#\s]+', '', str(tag)).strip('"\'')
+            if cleaned and len(cleaned) <= 30:
+                tags.append(''.join(word[:1].upper() + word[1:] for word in cleaned.split()))
+        
+        return {
+            'moderation': {
+                'is_safe': moderation.get('is_safe', True) is not False,
+                'reason': str(moderation.get('reason') or ''),
+                'categories': [str(c) for c in moderation.get('categories') or []],
+            },
+            'spam': {
+                'is_spam': spam.get('is_spam', False) is True,
+                'confidence': min(1.0, max(0.0, float(spam.get('confidence') or 0.0))),
+                'reason': str(spam.get('reason') or ''),
+            },
+            'sentiment': sentiment,
+            'score': min(1.0, max(-1.0, float(data.get('score') or 0.0))),
+            'emotions': [str(e) for e in data.get('emotions') or []],
+            'hashtags': tags[:num_tags],
+        }
+    
     def summarize_conversation(self, messages: List[Dict]) -> str:
         """
         Summarize a conversation thread
@@ -307,7 +560,7 @@ Keep the summary concise and capture the main points."""
             {"role": "user", "content": prompt}
         ]
         
-        response = self._call_groq(system_message, temperature=0.5, max_tokens=150)
+        response = self._call_groq(system_message, temperature=0.5, max_tokens=150, task='conversation_summary')
         return response if response else "Unable to generate summary."
     
     def generate_trending_topics(self, chirps: List[str], top_n: int = 5) -> List[Dict]:
@@ -315,8 +568,8 @@ Keep the summary concise and capture the main points."""
         Analyze chirps to identify trending topics
         Returns list of topics with relevance scores
         """
-        # Combine recent chirps
-        combined = "\n".join(chirps[:50])  # Limit to 50 recent chirps
+        # Callers choose the sample size; nothing is dropped here
+        combined = "\n".join(chirps)
         
         prompt = f"""Analyze these social media posts and identify the top {top_n} trending topics or themes:
 
@@ -335,7 +588,7 @@ Relevance should be between 0 and 1."""
             {"role": "user", "content": prompt}
         ]
         
-        response = self._call_groq(messages, temperature=0.5, max_tokens=300)
+        response = self._call_groq(messages, temperature=0.5, max_tokens=300, task='trending_topics')
         
         if response:
             try:
@@ -348,51 +601,52 @@ Relevance should be between 0 and 1."""
         
         return []
     
-    def generate_image_with_pollinations(self, prompt: str) -> Dict:
+    def label_trending_topics(self, terms: List[Tuple[str, float]], top_n: int = 5) -> List[Dict]:
         """
-        Generate an image using Pollinations.ai (completely free, no API key needed)
-        Returns: {
-            'success': bool,
-            'image_path': str,
-            'enhanced_prompt': str,
-            'error': str (if failed)
-        }
+        Group the heaviest trending terms into labeled topics
+        terms: (term or #hashtag, weight) pairs, heaviest first
+        Returns list of {'topic': str, 'relevance': float (0-1), 'terms': list}
         """
-        try:
-            # Use Groq to enhance the prompt for better image generation
-            enhanced_prompt = self._enhance_image_prompt(prompt)
-            
-            # Pollinations.ai - completely free image generation
-            # URL format: https://image.pollinations.ai/prompt/{prompt}
-            import urllib.parse
-            encoded_prompt = urllib.parse.quote(enhanced_prompt)
-            pollinations_url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?width=1024&height=1024&nologo=true"
-            
-            # Download the image
-            timestamp = int(time.time())
-            img_filename = f"ai_generated_{timestamp}.png"
-            img_filepath = os.path.join('static', 'uploads', img_filename)
-            os.makedirs(os.path.dirname(img_filepath), exist_ok=True)
-            
-            # Download and save the image from Pollinations.ai
-            response = requests.get(pollinations_url, timeout=60)
-            response.raise_for_status()
-            
-            with open(img_filepath, 'wb') as handler:
-                handler.write(response.content)
-            
-            return {
-                'success': True,
-                'image_path': f'uploads/{img_filename}',
-                'enhanced_prompt': enhanced_prompt,
-                'type': 'pollinations'
-            }
-            
-        except Exception as e:
-            return {
-                'success': False,
-                'error': f'Image generation error: {str(e)}'
-            }
+        listing = "\n".join(f"{term} ({weight:g})" for term, weight in terms)
+        
+        prompt = f"""These are the most frequent hashtags and terms on a social network right now, with their trend weight:
+
+{listing}
+
+Group related terms into the top {top_n} trending topics and give each a short, human-readable name.
+
+Respond ONLY in JSON format as an array, strongest topic first:
+[
+    {{"topic": "topic name", "relevance": 0.95, "terms": ["term", "#hashtag"]}}
+]
+
+Relevance should be between 0 and 1."""
+
+        messages = [
+            {"role": "system", "content": "You are a trend analysis assistant. Respond only with valid JSON array."},
+            {"role": "user", "content": prompt}
+        ]
+        
+        response = self._call_groq(messages, temperature=0.3, max_tokens=400, task='trending_topics')
+        
+        if response:
+            try:
+                json_match = re.search(r'\[.*\]', response, re.DOTALL)
+                if json_match:
+                    topics = [
+                        {
+                            'topic': str(topic['topic']),
+                            'relevance': min(1.0, max(0.0, float(topic.get('relevance', 0)))),
+                            'terms': [str(t) for t in topic.get('terms') or []],
+                        }
+                        for topic in json.loads(json_match.group())
+                        if isinstance(topic, dict) and topic.get('topic')
+                    ]
+                    return topics[:top_n]
+            except (json.JSONDecodeError, TypeError, ValueError):
+                pass
+        
+        return []
     
     def generate_image(self, prompt: str) -> Dict:
         """
@@ -443,7 +697,7 @@ Relevance should be between 0 and 1."""
             {"role": "user", "content": f"Enhance this image generation prompt to be more detailed and artistic: {prompt}\n\nProvide only the enhanced prompt, nothing else."}
         ]
         
-        response = self._call_groq(messages, temperature=0.8, max_tokens=150)
+        response = self._call_groq(messages, temperature=0.8, max_tokens=150, task='image_prompt')
         return response if response else prompt
 
 
@@ -1,17 +1,40 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 import sqlite3
 from functools import wraps
 import os
 from dotenv import load_dotenv
 import json
+import time
+import click
 
 # Load environment variables
 load_dotenv()
 
 # Import AI service
 from ai_service import get_ai_service
+import db
+from db import get_db
+import timeline_store
+import chirp_stats
+import feeds
+import search_index
+import jobs
+import ai_cache
+import content_filter
+import groq_client
+import trending
+import inbox
+import events
+import images
+import media_store
+import media_serving
+import image_gen
+import recommendations
+import profiles
+import fragments
+import conditional
+import feed_api
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-change-this-in-production')
@@ -24,6 +47,7 @@ ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'mov', 'avi', 'webm'}
 MAX_MEDIA_FILES = 4  # Maximum media files per chirp
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
+app.config['USE_X_SENDFILE'] = media_serving.MEDIA_X_SENDFILE
 
 # Create upload folder if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -40,41 +64,34 @@ def get_media_type(filename):
     return None
 
 # Database helper functions
-def get_db_connection():
-    conn = sqlite3.connect('chirpx.db')
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    conn = get_db_connection()
-    with open('schema.sql', 'r') as f:
-        conn.executescript(f.read())
-    conn.commit()
-    conn.close()
+# Routes use db.get_db(): one pooled connection per request, returned on teardown.
+db.init_app(app)
 
 # Initialize database on startup if it doesn't exist
 def ensure_database_exists():
-    """Ensure database is initialized on first run"""
-    import os
-    if not os.path.exists('chirpx.db'):
+    """Create the database on first run, or bring an existing one up to date (see db.initialize)"""
+    if not os.path.exists(db.DATABASE_PATH):
         print("Database not found. Initializing...")
-        init_db()
+        db.initialize()
         print("Database initialized successfully!")
     else:
-        # Check if tables exist
-        try:
-            conn = get_db_connection()
-            conn.execute('SELECT 1 FROM users LIMIT 1')
-            conn.close()
-        except sqlite3.OperationalError:
-            # Tables don't exist, initialize
-            print("Database exists but tables not found. Initializing...")
-            init_db()
-            print("Database initialized successfully!")
+        db.initialize()
 
 # Ensure database exists when app starts
 ensure_database_exists()
 
+# How often an open DM thread polls for new messages
+DM_POLL_INTERVAL_MS = int(os.getenv('DM_POLL_INTERVAL_MS', '5000'))
+
+# Background job workers run inside each web process unless a dedicated
+# `flask run-worker` process drains the queue instead (JOB_WORKERS_INPROCESS=0)
+JOB_WORKERS_INPROCESS = os.getenv('JOB_WORKERS_INPROCESS', '1') == '1'
+
+@app.before_request
+def start_job_workers():
+    if JOB_WORKERS_INPROCESS:
+        jobs.start_workers()
+
 # Login required decorator
 def login_required(f):
     @wraps(f)
@@ -85,7 +102,83 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+@app.template_global()
+def media_url(path):
+    """URL of an uploaded file stored as a path relative to static/ (uploads/...)"""
+    filename = media_serving.media_path(path)
+    if filename is None:
+        return url_for('static', filename=path)
+    return url_for('media', filename=filename)
+
+@app.template_global()
+def image_srcset(variants, fmt='webp'):
+    """srcset attribute value for stored image variants in one format ('webp' or 'jpeg')"""
+    return ', '.join(f"{media_url(v[fmt])} {v['width']}w" for v in images.parse_variants(variants))
+
+@app.template_global()
+def cached_chirp_card(chirp, variant, caller):
+    """
+    {% call cached_chirp_card(chirp, 'timeline') %}card markup{% endcall %}:
+    the card from the fragment cache, rendered only on a miss, with the
+    viewer_toggle() markers filled in for the current user
+    """
+    return fragments.render(chirp, variant, caller, session.get('user_id'))
+
+@app.template_global()
+def viewer_toggle(flag, on='', off='', caller=None):
+    """Markup inside a cached card that depends on the viewer ('user_liked', 'is_owner', ...)"""
+    return fragments.toggle(flag, caller() if caller else on, off)
+
+def next_page_url(next_cursor):
+    """URL of the following feed page, keeping the current query args"""
+    if not next_cursor:
+        return None
+    args = request.args.to_dict()
+    args['cursor'] = next_cursor
+    return url_for(request.endpoint, **request.view_args, **args)
+
+def page_etag(validator, *args):
+    """
+    ETag of a feed or profile page from one of the conditional.*_etag
+    validators, or None when conditional GET is off or flash messages are
+    pending (a page that shows them once must not be reused once they are gone)
+    """
+    if not conditional.CONDITIONAL_GET_ENABLED or session.get('_flashes'):
+        return None
+    return validator(*args)
+
+def not_modified(etag):
+    """A 304 when the client already holds the page tagged etag, else None"""
+    if etag is None or not request.if_none_match.contains_weak(etag):
+        return None
+    return validated(app.response_class(status=304), etag)
+
+def validated(response, etag):
+    """
+    Mark a session-dependent page private and no-cache, so browsers keep it
+    but check back every time (usually getting a 304), and tag it with etag
+    """
+    response = app.make_response(response)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
+
+def notify_chirp_author(conn, chirp_id, event, **data):
+    """Push a live event about a chirp to its author, unless they caused it"""
+    chirp = conn.execute('SELECT user_id FROM chirps WHERE id = ?', (chirp_id,)).fetchone()
+    if chirp and chirp['user_id'] != session['user_id']:
+        events.publish([events.user_channel(chirp['user_id'])], event,
+                       {'chirp_id': chirp_id, 'username': session['username'], **data})
+
 # Routes
+@app.route('/media/<path:filename>')
+def media(filename):
+    """Uploaded files, with long-lived caching for content-addressed ones and Range support"""
+    return media_serving.send_media(filename)
+
 @app.route('/')
 def index():
     if 'user_id' in session:
@@ -105,14 +198,13 @@ def signup():
             flash('All fields are required!', 'danger')
             return redirect(url_for('signup'))
         
-        conn = get_db_connection()
+        conn = get_db()
         
         # Check if user exists
         existing_user = conn.execute('SELECT id FROM users WHERE username = ? OR email = ?',
                                     (username, email)).fetchone()
         if existing_user:
             flash('Username or email already exists!', 'danger')
-            conn.close()
             return redirect(url_for('signup'))
         
         # Create user
@@ -120,7 +212,6 @@ def signup():
         conn.execute('INSERT INTO users (username, email, password, full_name) VALUES (?, ?, ?, ?)',
                     (username, email, hashed_password, full_name))
         conn.commit()
-        conn.close()
         
         flash('Account created successfully! Please log in.', 'success')
         return redirect(url_for('login'))
@@ -133,9 +224,8 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        conn = get_db_connection()
+        conn = get_db()
         user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        conn.close()
         
         if user and check_password_hash(user['password'], password):
             session['user_id'] = user['id']
@@ -156,58 +246,41 @@ def logout():
 @app.route('/timeline')
 @login_required
 def timeline():
-    conn = get_db_connection()
-    
-    # Get chirps from followed users and self
-    chirps = conn.execute('''
-        SELECT c.*, u.username, u.full_name, u.profile_picture,
-               (SELECT COUNT(*) FROM likes WHERE chirp_id = c.id) as like_count,
-               (SELECT COUNT(*) FROM likes WHERE chirp_id = c.id AND user_id = ?) as user_liked,
-               (SELECT COUNT(*) FROM comments WHERE chirp_id = c.id) as comment_count,
-               (SELECT COUNT(*) FROM retweets WHERE chirp_id = c.id) as retweet_count,
-               (SELECT COUNT(*) FROM retweets WHERE chirp_id = c.id AND user_id = ?) as user_retweeted,
-               (SELECT COUNT(*) FROM bookmarks WHERE chirp_id = c.id AND user_id = ?) as is_bookmarked
-        FROM chirps c
-        JOIN users u ON c.user_id = u.id
-        WHERE c.user_id IN (
-            SELECT following_id FROM follows WHERE follower_id = ?
-            UNION
-            SELECT ?
-        )
-        ORDER BY c.created_at DESC
-    ''', (session['user_id'], session['user_id'], session['user_id'], session['user_id'], session['user_id'])).fetchall()
-    
-    # Fetch media for each chirp
-    chirps_with_media = []
-    for chirp in chirps:
-        chirp_dict = dict(chirp)
-        media = conn.execute('SELECT * FROM chirp_media WHERE chirp_id = ? ORDER BY display_order', (chirp['id'],)).fetchall()
-        chirp_dict['media'] = [dict(m) for m in media]
-        chirps_with_media.append(chirp_dict)
-    
-    conn.close()
-    return render_template('timeline.html', chirps=chirps_with_media)
+    cursor = feeds.decode_cursor(request.args.get('cursor'))
+    limit = feeds.page_size(request.args.get('limit'))
+    
+    conn = get_db()
+    
+    etag = page_etag(conditional.timeline_etag, conn, session['user_id'], cursor, limit)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    
+    # Get one page of the user's materialized home timeline (followed users and self)
+    chirps, next_cursor = feeds.timeline_page(conn, session['user_id'], cursor, limit)
+    chirps = feeds.hydrate_chirps(conn, chirps, session['user_id'])
+    
+    return validated(render_template('timeline.html', chirps=chirps,
+                                     next_url=next_page_url(next_cursor)), etag)
 
 @app.route('/explore')
 @login_required
 def explore():
-    conn = get_db_connection()
-    
-    # Get all chirps
-    chirps = conn.execute('''
-        SELECT c.*, u.username, u.full_name, u.profile_picture,
-               (SELECT COUNT(*) FROM likes WHERE chirp_id = c.id) as like_count,
-               (SELECT COUNT(*) FROM likes WHERE chirp_id = c.id AND user_id = ?) as user_liked,
-               (SELECT COUNT(*) FROM comments WHERE chirp_id = c.id) as comment_count,
-               (SELECT COUNT(*) FROM retweets WHERE chirp_id = c.id) as retweet_count,
-               (SELECT COUNT(*) FROM retweets WHERE chirp_id = c.id AND user_id = ?) as user_retweeted
-        FROM chirps c
-        JOIN users u ON c.user_id = u.id
-        ORDER BY c.created_at DESC
-    ''', (session['user_id'], session['user_id'])).fetchall()
+    cursor = feeds.decode_cursor(request.args.get('cursor'))
+    limit = feeds.page_size(request.args.get('limit'))
+    
+    conn = get_db()
     
-    conn.close()
-    return render_template('explore.html', chirps=chirps)
+    etag = page_etag(conditional.explore_etag, conn, session['user_id'], cursor, limit)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    
+    # Get one page of all chirps, newest first
+    chirps, next_cursor = feeds.explore_page(conn, cursor, limit)
+    chirps = feeds.hydrate_chirps(conn, chirps, session['user_id'])
+    
+    return validated(render_template('explore.html', chirps=chirps, next_url=next_page_url(next_cursor)), etag)
 
 @app.route('/post_chirp', methods=['POST'])
 @login_required
@@ -218,6 +291,15 @@ def post_chirp():
         flash('Chirp must be between 1 and 280 characters!', 'danger')
         return redirect(url_for('timeline'))
     
+    conn = get_db()
+    
+    # Local heuristics reject clear spam without the LLM and vouch for clearly clean chirps
+    verdict = content_filter.classify(conn, session['user_id'], content)
+    if verdict.decision == content_filter.BLOCK:
+        label = 'Content moderation' if verdict.category == 'moderation' else 'Spam detected'
+        flash(f"{label}: {verdict.reason}", 'danger')
+        return redirect(url_for('timeline'))
+    
     # Handle multiple media uploads
     media_files = []
     if 'media' in request.files:
@@ -230,65 +312,69 @@ def post_chirp():
         
         for idx, file in enumerate(files):
             if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                # Add timestamp to avoid conflicts
-                import time
-                filename = f"{int(time.time())}_{idx}_{filename}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                media_url = f"uploads/{filename}"
+                # Stored by content hash, so a re-posted file is stored (and processed) once
                 media_type = get_media_type(file.filename)
-                media_files.append({'url': media_url, 'type': media_type, 'order': idx})
-    
-    # AI Content Moderation
+                kind = media_store.IMAGE if media_type == 'image' else media_store.FILE
+                try:
+                    blob = media_store.store(conn, file.stream, file.filename.rsplit('.', 1)[1], kind)
+                except images.InvalidImage:
+                    flash(f'Could not read {file.filename} as an image.', 'warning')
+                    continue
+                media_files.append({'blob': blob, 'type': media_type, 'order': idx})
+        # store() commits each blob row as it goes; blobs of a chirp rejected below are collected later
+    
+    # AI moderation, spam detection, sentiment and hashtags in one call
+    analysis = None
     try:
         ai = get_ai_service()
-        moderation_result = ai.moderate_content(content)
-        
-        if not moderation_result.get('is_safe', True):
-            flash(f"Content moderation: {moderation_result.get('reason', 'Inappropriate content detected')}", 'danger')
-            return redirect(url_for('timeline'))
-        
-        # Spam Detection
-        spam_result = ai.detect_spam(content)
-        if spam_result.get('is_spam', False) and spam_result.get('confidence', 0) > 0.7:
-            flash(f"Spam detected: {spam_result.get('reason', 'Suspicious content')}", 'danger')
-            return redirect(url_for('timeline'))
+        analysis = ai.analyze_chirp(content)
     except Exception as e:
         print(f"AI moderation error: {str(e)}")
         # Continue posting if AI fails
     
-    conn = get_db_connection()
+    if analysis:
+        moderation_result = analysis['moderation']
+        if not moderation_result['is_safe']:
+            flash(f"Content moderation: {moderation_result['reason'] or 'Inappropriate content detected'}", 'danger')
+            return redirect(url_for('timeline'))
+        
+        # The pre-filter already cleared ALLOW chirps of spam
+        spam_result = analysis['spam']
+        if verdict.decision == content_filter.UNSURE and spam_result['is_spam'] and spam_result['confidence'] > 0.7:
+            flash(f"Spam detected: {spam_result['reason'] or 'Suspicious content'}", 'danger')
+            return redirect(url_for('timeline'))
+    
     cursor = conn.execute('INSERT INTO chirps (user_id, content) VALUES (?, ?)',
                 (session['user_id'], content))
     chirp_id = cursor.lastrowid
     
     # Insert media files
     for media in media_files:
-        conn.execute('INSERT INTO chirp_media (chirp_id, media_url, media_type, display_order) VALUES (?, ?, ?, ?)',
-                    (chirp_id, media['url'], media['type'], media['order']))
-    
-    # Analyze sentiment and store in background (non-blocking)
-    try:
-        ai = get_ai_service()
-        sentiment_result = ai.analyze_sentiment(content)
-        hashtag_suggestions = ai.suggest_hashtags(content)
-        
+        blob = media['blob']
         conn.execute('''
-            INSERT INTO ai_analysis (chirp_id, sentiment, sentiment_score, emotions, suggested_hashtags)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (
-            chirp_id,
-            sentiment_result.get('sentiment', 'neutral'),
-            sentiment_result.get('score', 0.0),
-            json.dumps(sentiment_result.get('emotions', [])),
-            json.dumps(hashtag_suggestions)
-        ))
-    except Exception as e:
-        print(f"AI analysis error: {str(e)}")
+            INSERT INTO chirp_media (chirp_id, media_url, media_type, display_order, width, height, variants, blob_key)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (chirp_id, blob['url'], media['type'], media['order'],
+              blob['width'], blob['height'], blob['variants'], blob['key']))
+    
+    # Deliver to the author's and followers' home timelines
+    timeline_store.fan_out_chirp(conn, chirp_id)
+    
+    if analysis:
+        save_chirp_analysis(conn, chirp_id, analysis)
+    else:
+        # AI was unavailable; analyze in the background
+        jobs.enqueue(conn, 'enrich_chirp', key=str(chirp_id), payload={'chirp_id': chirp_id})
     
     conn.commit()
-    conn.close()
+    jobs.notify()
+    
+    # Tell followers with an open page that there is something new
+    events.publish([events.author_channel(session['user_id'])], 'chirp',
+                   {'chirp_id': chirp_id, 'username': session['username']})
+    
+    # Count the new chirp's hashtags and terms towards trending topics
+    trending.get_detector().sync(conn)
     
     flash('Chirp posted!', 'success')
     return redirect(url_for('timeline'))
@@ -296,7 +382,8 @@ def post_chirp():
 @app.route('/like/<int:chirp_id>', methods=['POST'])
 @login_required
 def like_chirp(chirp_id):
-    conn = get_db_connection()
+    conn = get_db()
+    liked = False
     
     # Check if already liked
     existing_like = conn.execute('SELECT id FROM likes WHERE user_id = ? AND chirp_id = ?',
@@ -307,57 +394,52 @@ def like_chirp(chirp_id):
         conn.execute('DELETE FROM likes WHERE user_id = ? AND chirp_id = ?',
                     (session['user_id'], chirp_id))
     else:
-        # Like
-        conn.execute('INSERT INTO likes (user_id, chirp_id) VALUES (?, ?)',
-                    (session['user_id'], chirp_id))
+        # Like (foreign keys reject chirps that no longer exist)
+        try:
+            conn.execute('INSERT INTO likes (user_id, chirp_id) VALUES (?, ?)',
+                        (session['user_id'], chirp_id))
+        except sqlite3.IntegrityError:
+            flash('Chirp not found!', 'danger')
+        else:
+            liked = True
     
     conn.commit()
-    conn.close()
+    fragments.invalidate_chirp(chirp_id)
+    
+    if liked:
+        notify_chirp_author(conn, chirp_id, 'like')
     
     return redirect(request.referrer or url_for('timeline'))
 
 @app.route('/profile/<username>')
 @login_required
 def profile(username):
-    conn = get_db_connection()
+    conn = get_db()
+    cursor = feeds.decode_cursor(request.args.get('cursor'))
+    limit = feeds.page_size(request.args.get('limit'))
     
-    # Get user info
-    user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+    # Profile fields and counts in one primary-key read
+    user = profiles.get_header_by_username(conn, username)
     
     if not user:
         flash('User not found!', 'danger')
-        conn.close()
         return redirect(url_for('timeline'))
     
-    # Get user's chirps
-    chirps = conn.execute('''
-        SELECT c.*, u.username, u.full_name, u.profile_picture,
-               (SELECT COUNT(*) FROM likes WHERE chirp_id = c.id) as like_count,
-               (SELECT COUNT(*) FROM likes WHERE chirp_id = c.id AND user_id = ?) as user_liked,
-               (SELECT COUNT(*) FROM comments WHERE chirp_id = c.id) as comment_count,
-               (SELECT COUNT(*) FROM retweets WHERE chirp_id = c.id) as retweet_count,
-               (SELECT COUNT(*) FROM retweets WHERE chirp_id = c.id AND user_id = ?) as user_retweeted
-        FROM chirps c
-        JOIN users u ON c.user_id = u.id
-        WHERE c.user_id = ?
-        ORDER BY c.created_at DESC
-    ''', (session['user_id'], session['user_id'], user['id'])).fetchall()
+    etag = page_etag(conditional.profile_etag, conn, session['user_id'], user, cursor, limit)
+    response = not_modified(etag)
+    if response is not None:
+        return response
     
-    # Get follower/following counts
-    follower_count = conn.execute('SELECT COUNT(*) as count FROM follows WHERE following_id = ?',
-                                  (user['id'],)).fetchone()['count']
-    following_count = conn.execute('SELECT COUNT(*) as count FROM follows WHERE follower_id = ?',
-                                   (user['id'],)).fetchone()['count']
+    # Get one page of the user's chirps
+    chirps, next_cursor = feeds.user_page(conn, user['id'], cursor, limit)
+    chirps = feeds.hydrate_chirps(conn, chirps, session['user_id'])
     
     # Check if current user is following this user
     is_following = conn.execute('SELECT id FROM follows WHERE follower_id = ? AND following_id = ?',
                                (session['user_id'], user['id'])).fetchone()
     
-    conn.close()
-    
-    return render_template('profile.html', user=user, chirps=chirps,
-                         follower_count=follower_count, following_count=following_count,
-                         is_following=bool(is_following))
+    return validated(render_template('profile.html', user=user, chirps=chirps,
+                                     is_following=bool(is_following), next_url=next_page_url(next_cursor)), etag)
 
 @app.route('/follow/<int:user_id>', methods=['POST'])
 @login_required
@@ -366,7 +448,7 @@ def follow_user(user_id):
         flash('You cannot follow yourself!', 'warning')
         return redirect(request.referrer or url_for('timeline'))
     
-    conn = get_db_connection()
+    conn = get_db()
     
     # Check if already following
     existing_follow = conn.execute('SELECT id FROM follows WHERE follower_id = ? AND following_id = ?',
@@ -376,15 +458,24 @@ def follow_user(user_id):
         # Unfollow
         conn.execute('DELETE FROM follows WHERE follower_id = ? AND following_id = ?',
                     (session['user_id'], user_id))
+        timeline_store.remove_follow(conn, session['user_id'], user_id)
         flash('Unfollowed!', 'info')
     else:
-        # Follow
-        conn.execute('INSERT INTO follows (follower_id, following_id) VALUES (?, ?)',
-                    (session['user_id'], user_id))
+        # Follow (foreign keys reject users that no longer exist)
+        try:
+            conn.execute('INSERT INTO follows (follower_id, following_id) VALUES (?, ?)',
+                        (session['user_id'], user_id))
+        except sqlite3.IntegrityError:
+            flash('User not found!', 'danger')
+            return redirect(request.referrer or url_for('timeline'))
+        timeline_store.add_follow(conn, session['user_id'], user_id)
+        recommendations.record_follow(conn, session['user_id'], user_id)
         flash('Followed!', 'success')
     
+    # Friends of the (un)followed user change this user's suggestions
+    queue_suggestions_refresh(conn, session['user_id'])
     conn.commit()
-    conn.close()
+    jobs.notify()
     
     return redirect(request.referrer or url_for('timeline'))
 
@@ -396,40 +487,34 @@ def search():
     if not query:
         return render_template('search.html', users=[], chirps=[])
     
-    conn = get_db_connection()
-    
-    # Search users
-    users = conn.execute('''
-        SELECT id, username, full_name, bio, profile_picture,
-               (SELECT COUNT(*) FROM follows WHERE following_id = users.id) as follower_count
-        FROM users
-        WHERE username LIKE ? OR full_name LIKE ?
-        LIMIT 20
-    ''', (f'%{query}%', f'%{query}%')).fetchall()
-    
-    # Search chirps
-    chirps = conn.execute('''
-        SELECT c.*, u.username, u.full_name, u.profile_picture,
-               (SELECT COUNT(*) FROM likes WHERE chirp_id = c.id) as like_count,
-               (SELECT COUNT(*) FROM likes WHERE chirp_id = c.id AND user_id = ?) as user_liked,
-               (SELECT COUNT(*) FROM comments WHERE chirp_id = c.id) as comment_count,
-               (SELECT COUNT(*) FROM retweets WHERE chirp_id = c.id) as retweet_count,
-               (SELECT COUNT(*) FROM retweets WHERE chirp_id = c.id AND user_id = ?) as user_retweeted
-        FROM chirps c
-        JOIN users u ON c.user_id = u.id
-        WHERE c.content LIKE ?
-        ORDER BY c.created_at DESC
-        LIMIT 50
-    ''', (session['user_id'], session['user_id'], f'%{query}%')).fetchall()
-    
-    conn.close()
-    
-    return render_template('search.html', users=users, chirps=chirps, query=query)
+    cursor = feeds.decode_rank_cursor(request.args.get('cursor'))
+    seen = cursor[2] if cursor else 0
+    limit = min(feeds.page_size(request.args.get('limit')), max(search_index.SEARCH_MAX_RESULTS - seen, 0))
+    
+    conn = get_db()
+    
+    # Search users (first page only; later pages just continue the chirp results)
+    users = search_index.search_users(conn, query) if cursor is None else []
+    
+    # Search chirps, best BM25 match first, continuing after the cursor's (rank, id)
+    chirps = []
+    if limit:
+        chirps = search_index.search_chirps(conn, query, limit + 1, cursor[:2] if cursor else None)
+    has_more = len(chirps) > limit and seen + limit < search_index.SEARCH_MAX_RESULTS
+    chirps = chirps[:limit]
+    next_cursor = None
+    if has_more:
+        last = chirps[-1]
+        next_cursor = feeds.encode_rank_cursor(last['search_rank'], last['id'], seen + len(chirps))
+    chirps = feeds.hydrate_chirps(conn, chirps, session['user_id'])
+    
+    next_url = next_page_url(next_cursor)
+    return render_template('search.html', users=users, chirps=chirps, query=query, next_url=next_url)
 
 @app.route('/delete_chirp/<int:chirp_id>', methods=['POST'])
 @login_required
 def delete_chirp(chirp_id):
-    conn = get_db_connection()
+    conn = get_db()
     
     # Verify ownership
     chirp = conn.execute('SELECT user_id FROM chirps WHERE id = ?', (chirp_id,)).fetchone()
@@ -438,16 +523,17 @@ def delete_chirp(chirp_id):
         flash('You can only delete your own chirps!', 'danger')
     else:
         conn.execute('DELETE FROM chirps WHERE id = ?', (chirp_id,))
+        timeline_store.remove_chirp(conn, chirp_id)
         conn.commit()
+        fragments.invalidate_chirp(chirp_id)
         flash('Chirp deleted!', 'success')
     
-    conn.close()
     return redirect(request.referrer or url_for('timeline'))
 
 @app.route('/retweet/<int:chirp_id>', methods=['POST'])
 @login_required
 def retweet_chirp(chirp_id):
-    conn = get_db_connection()
+    conn = get_db()
     
     # Check if already retweeted
     existing_retweet = conn.execute('SELECT id FROM retweets WHERE user_id = ? AND chirp_id = ?',
@@ -459,49 +545,50 @@ def retweet_chirp(chirp_id):
                     (session['user_id'], chirp_id))
         flash('Retweet removed!', 'info')
     else:
-        # Retweet
-        conn.execute('INSERT INTO retweets (user_id, chirp_id) VALUES (?, ?)',
-                    (session['user_id'], chirp_id))
-        flash('Retweeted!', 'success')
+        # Retweet (foreign keys reject chirps that no longer exist)
+        try:
+            conn.execute('INSERT INTO retweets (user_id, chirp_id) VALUES (?, ?)',
+                        (session['user_id'], chirp_id))
+            flash('Retweeted!', 'success')
+        except sqlite3.IntegrityError:
+            flash('Chirp not found!', 'danger')
     
     conn.commit()
-    conn.close()
+    fragments.invalidate_chirp(chirp_id)
     
     return redirect(request.referrer or url_for('timeline'))
 
 @app.route('/chirp/<int:chirp_id>')
 @login_required
 def view_chirp(chirp_id):
-    conn = get_db_connection()
+    conn = get_db()
     
     # Get chirp details
     chirp = conn.execute('''
-        SELECT c.*, u.username, u.full_name, u.profile_picture,
-               (SELECT COUNT(*) FROM likes WHERE chirp_id = c.id) as like_count,
-               (SELECT COUNT(*) FROM likes WHERE chirp_id = c.id AND user_id = ?) as user_liked,
-               (SELECT COUNT(*) FROM retweets WHERE chirp_id = c.id) as retweet_count,
-               (SELECT COUNT(*) FROM retweets WHERE chirp_id = c.id AND user_id = ?) as user_retweeted
+        SELECT c.*, u.username, u.full_name, u.profile_picture, u.profile_picture_variants,
+               COALESCE(s.like_count, 0) as like_count,
+               EXISTS(SELECT 1 FROM likes WHERE chirp_id = c.id AND user_id = ?) as user_liked,
+               COALESCE(s.retweet_count, 0) as retweet_count,
+               EXISTS(SELECT 1 FROM retweets WHERE chirp_id = c.id AND user_id = ?) as user_retweeted
         FROM chirps c
         JOIN users u ON c.user_id = u.id
+        LEFT JOIN chirp_stats s ON s.chirp_id = c.id
         WHERE c.id = ?
     ''', (session['user_id'], session['user_id'], chirp_id)).fetchone()
     
     if not chirp:
         flash('Chirp not found!', 'danger')
-        conn.close()
         return redirect(url_for('timeline'))
     
     # Get comments
     comments = conn.execute('''
-        SELECT c.*, u.username, u.full_name, u.profile_picture
+        SELECT c.*, u.username, u.full_name, u.profile_picture, u.profile_picture_variants
         FROM comments c
         JOIN users u ON c.user_id = u.id
         WHERE c.chirp_id = ?
         ORDER BY c.created_at ASC
     ''', (chirp_id,)).fetchall()
     
-    conn.close()
-    
     return render_template('chirp_detail.html', chirp=chirp, comments=comments)
 
 @app.route('/comment/<int:chirp_id>', methods=['POST'])
@@ -513,11 +600,16 @@ def add_comment(chirp_id):
         flash('Comment must be between 1 and 280 characters!', 'danger')
         return redirect(url_for('view_chirp', chirp_id=chirp_id))
     
-    conn = get_db_connection()
-    conn.execute('INSERT INTO comments (user_id, chirp_id, content) VALUES (?, ?, ?)',
-                (session['user_id'], chirp_id, content))
+    conn = get_db()
+    try:
+        conn.execute('INSERT INTO comments (user_id, chirp_id, content) VALUES (?, ?, ?)',
+                    (session['user_id'], chirp_id, content))
+    except sqlite3.IntegrityError:
+        flash('Chirp not found!', 'danger')
+        return redirect(url_for('timeline'))
     conn.commit()
-    conn.close()
+    fragments.invalidate_chirp(chirp_id)
+    notify_chirp_author(conn, chirp_id, 'comment', content=content[:inbox.PREVIEW_LENGTH])
     
     flash('Comment added!', 'success')
     return redirect(url_for('view_chirp', chirp_id=chirp_id))
@@ -525,20 +617,19 @@ def add_comment(chirp_id):
 @app.route('/delete_comment/<int:comment_id>', methods=['POST'])
 @login_required
 def delete_comment(comment_id):
-    conn = get_db_connection()
+    conn = get_db()
     
     # Get comment to find chirp_id and verify ownership
     comment = conn.execute('SELECT user_id, chirp_id FROM comments WHERE id = ?', (comment_id,)).fetchone()
     
     if not comment or comment['user_id'] != session['user_id']:
         flash('You can only delete your own comments!', 'danger')
-        conn.close()
         return redirect(request.referrer or url_for('timeline'))
     
     chirp_id = comment['chirp_id']
     conn.execute('DELETE FROM comments WHERE id = ?', (comment_id,))
     conn.commit()
-    conn.close()
+    fragments.invalidate_chirp(chirp_id)
     
     flash('Comment deleted!', 'success')
     return redirect(url_for('view_chirp', chirp_id=chirp_id))
@@ -546,7 +637,7 @@ def delete_comment(comment_id):
 @app.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
 def edit_profile():
-    conn = get_db_connection()
+    conn = get_db()
     
     if request.method == 'POST':
         full_name = request.form.get('full_name', '')
@@ -554,23 +645,27 @@ def edit_profile():
         location = request.form.get('location', '')
         website = request.form.get('website', '')
         
-        # Handle profile picture upload
+        # Handle profile picture upload (square avatar sizes)
         profile_picture = None
         if 'profile_picture' in request.files:
             file = request.files['profile_picture']
-            if file and file.filename != '' and allowed_file(file.filename):
-                filename = secure_filename(f"{session['user_id']}_{file.filename}")
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                profile_picture = f'uploads/{filename}'
+            if file and file.filename != '' and allowed_file(file.filename) \
+                    and get_media_type(file.filename) == 'image':
+                try:
+                    profile_picture = media_store.store(conn, file.stream, file.filename.rsplit('.', 1)[1],
+                                                        media_store.AVATAR)
+                except images.InvalidImage:
+                    flash('Could not read the profile picture as an image.', 'warning')
         
         # Update user profile
         if profile_picture:
             conn.execute('''
                 UPDATE users 
-                SET full_name = ?, bio = ?, location = ?, website = ?, profile_picture = ?
+                SET full_name = ?, bio = ?, location = ?, website = ?, profile_picture = ?,
+                    profile_picture_variants = ?, profile_picture_blob = ?
                 WHERE id = ?
-            ''', (full_name, bio, location, website, profile_picture, session['user_id']))
+            ''', (full_name, bio, location, website, profile_picture['url'], profile_picture['variants'],
+                  profile_picture['key'], session['user_id']))
         else:
             conn.execute('''
                 UPDATE users 
@@ -579,14 +674,13 @@ def edit_profile():
             ''', (full_name, bio, location, website, session['user_id']))
         
         conn.commit()
-        conn.close()
+        fragments.invalidate_author(session['user_id'])
         
         flash('Profile updated successfully!', 'success')
         return redirect(url_for('profile', username=session['username']))
     
     # GET request - show form
     user = conn.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    conn.close()
     
     return render_template('edit_profile.html', user=user)
 
@@ -594,98 +688,70 @@ def edit_profile():
 @app.route('/messages')
 @login_required
 def messages():
-    conn = get_db_connection()
-    
-    # Get all unique users the current user has messaged with
-    conversations_query = '''
-        SELECT DISTINCT
-            CASE 
-                WHEN m.sender_id = ? THEN m.receiver_id 
-                ELSE m.sender_id 
-            END as other_user_id
-        FROM messages m
-        WHERE m.sender_id = ? OR m.receiver_id = ?
-    '''
-    
-    user_ids = conn.execute(conversations_query, 
-                           (session['user_id'], session['user_id'], session['user_id'])).fetchall()
-    
-    conversations = []
-    for row in user_ids:
-        other_id = row['other_user_id']
-        
-        # Get user info
-        user = conn.execute('SELECT * FROM users WHERE id = ?', (other_id,)).fetchone()
-        
-        # Get last message
-        last_msg = conn.execute('''
-            SELECT content, created_at FROM messages 
-            WHERE (sender_id = ? AND receiver_id = ?) 
-               OR (sender_id = ? AND receiver_id = ?)
-            ORDER BY created_at DESC LIMIT 1
-        ''', (session['user_id'], other_id, other_id, session['user_id'])).fetchone()
-        
-        # Get unread count
-        unread = conn.execute('''
-            SELECT COUNT(*) as count FROM messages 
-            WHERE sender_id = ? AND receiver_id = ? AND read = 0
-        ''', (other_id, session['user_id'])).fetchone()
-        
-        conversations.append({
-            'username': user['username'],
-            'full_name': user['full_name'],
-            'profile_picture': user['profile_picture'],
-            'last_message': last_msg['content'] if last_msg else '',
-            'last_message_time': last_msg['created_at'] if last_msg else '',
-            'unread_count': unread['count']
-        })
+    conn = get_db()
     
-    # Sort by last message time
-    conversations.sort(key=lambda x: x['last_message_time'], reverse=True)
-    
-    # Get total unread count
-    unread_total = conn.execute('''
-        SELECT COUNT(*) as count FROM messages 
-        WHERE receiver_id = ? AND read = 0
-    ''', (session['user_id'],)).fetchone()['count']
-    
-    conn.close()
+    # One row per conversation partner, already sorted by last message time
+    conversations = inbox.list_conversations(conn, session['user_id'])
+    unread_total = sum(conv['unread_count'] for conv in conversations)
     
     return render_template('messages.html', conversations=conversations, unread_total=unread_total)
 
 @app.route('/messages/<username>')
 @login_required
 def conversation(username):
-    conn = get_db_connection()
+    conn = get_db()
     
     # Get the other user
     other_user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
     
     if not other_user:
-        conn.close()
         flash('User not found.', 'danger')
         return redirect(url_for('messages'))
     
-    # Mark messages from this user as read
-    conn.execute('''
-        UPDATE messages SET read = 1 
-        WHERE sender_id = ? AND receiver_id = ? AND read = 0
-    ''', (other_user['id'], session['user_id']))
+    # Mark messages from this user as read (and clear the inbox counter)
+    inbox.mark_read(conn, session['user_id'], other_user['id'])
     conn.commit()
     
-    # Get all messages between these two users
-    msgs = conn.execute('''
-        SELECT m.*, u.username, u.profile_picture
-        FROM messages m
-        JOIN users u ON u.id = m.sender_id
-        WHERE (m.sender_id = ? AND m.receiver_id = ?) 
-           OR (m.sender_id = ? AND m.receiver_id = ?)
-        ORDER BY m.created_at ASC
-    ''', (session['user_id'], other_user['id'], other_user['id'], session['user_id'])).fetchall()
+    # Latest page of the thread; older pages are fetched from /api/messages/<username>?before=
+    msgs, has_older = inbox.thread_page(conn, session['user_id'], other_user['id'],
+                                        request.args.get('before', type=int))
+    
+    return render_template('conversation.html', other_user=other_user, messages=msgs,
+                           has_older=has_older, poll_interval=DM_POLL_INTERVAL_MS)
+
+@app.route('/api/messages/<username>')
+@login_required
+def conversation_messages(username):
+    """A conversation's messages as JSON: newer than ?since_id=, or the page before ?before="""
+    conn = get_db()
+    other_user = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
     
-    conn.close()
+    if not other_user:
+        return jsonify({'error': 'User not found'}), 404
     
-    return render_template('conversation.html', other_user=other_user, messages=msgs)
+    since_id = request.args.get('since_id', type=int)
+    has_older = None
+    if since_id is not None:
+        msgs = inbox.messages_since(conn, session['user_id'], other_user['id'], since_id)
+        # The thread is open, so what just arrived has been seen
+        if any(msg['sender_id'] == other_user['id'] for msg in msgs):
+            inbox.mark_read(conn, session['user_id'], other_user['id'])
+            conn.commit()
+    else:
+        msgs, has_older = inbox.thread_page(conn, session['user_id'], other_user['id'],
+                                            request.args.get('before', type=int))
+    
+    return jsonify({
+        'messages': [{
+            'id': msg['id'],
+            'sender_id': msg['sender_id'],
+            'username': msg['username'],
+            'content': msg['content'],
+            'created_at': msg['created_at'],
+            'mine': msg['sender_id'] == session['user_id'],
+        } for msg in msgs],
+        'has_older': has_older,
+    })
 
 @app.route('/messages/send/<username>', methods=['POST'])
 @login_required
@@ -700,24 +766,30 @@ def send_message(username):
         flash('Message is too long. Maximum 1000 characters.', 'danger')
         return redirect(url_for('conversation', username=username))
     
-    conn = get_db_connection()
+    conn = get_db()
     
     # Get receiver user
     receiver = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
     
     if not receiver:
-        conn.close()
         flash('User not found.', 'danger')
         return redirect(url_for('messages'))
     
-    # Insert message
-    conn.execute('''
+    # Insert message and update both participants' inbox rows
+    cursor = conn.execute('''
         INSERT INTO messages (sender_id, receiver_id, content)
         VALUES (?, ?, ?)
     ''', (session['user_id'], receiver['id'], content))
+    inbox.record_message(conn, cursor.lastrowid)
     
     conn.commit()
-    conn.close()
+    
+    if receiver['id'] != session['user_id']:
+        events.publish([events.user_channel(receiver['id'])], 'message', {
+            'message_id': cursor.lastrowid,
+            'username': session['username'],
+            'preview': content[:inbox.PREVIEW_LENGTH],
+        })
     
     return redirect(url_for('conversation', username=username))
 
@@ -725,9 +797,8 @@ def send_message(username):
 @login_required
 def new_message(username):
     """Start a new conversation with a user"""
-    conn = get_db_connection()
+    conn = get_db()
     user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-    conn.close()
     
     if not user:
         flash('User not found.', 'danger')
@@ -735,15 +806,69 @@ def new_message(username):
     
     return redirect(url_for('conversation', username=username))
 
+# ============== Live Events ==============
+
+def sse_event(event, data, event_id=None):
+    """Format one Server-Sent Events message with a JSON payload"""
+    prefix = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{prefix}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def sse_response(stream):
+    """Stream an iterable of sse_event() strings without proxy buffering"""
+    return Response(stream_with_context(stream), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+# How long the browser waits before reconnecting a dropped stream
+EVENTS_RETRY_MS = int(os.getenv('EVENTS_RETRY_MS', '3000'))
+
+@app.route('/events/stream')
+@login_required
+def event_stream():
+    """
+    Server-Sent Events for the signed-in user: messages, likes and comments
+    addressed to them and new chirps from people they follow.
+    """
+    user_id = session['user_id']
+    conn = get_db()
+    following = conn.execute('SELECT following_id FROM follows WHERE follower_id = ?', (user_id,)).fetchall()
+    channels = [events.user_channel(user_id)] + [events.author_channel(row['following_id']) for row in following]
+    # An open stream must not keep a pooled connection checked out
+    db.close_db()
+    
+    if not events.acquire_stream():
+        # Every stream slot in this worker is taken: end at once and have the
+        # browser come back later instead of holding another thread
+        return sse_response(iter([f"retry: {events.EVENTS_BUSY_RETRY_MS}\n\n"]))
+    
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    
+    def generate():
+        with events.subscribe(channels, last_event_id) as subscription:
+            yield f"retry: {EVENTS_RETRY_MS}\n\n"
+            deadline = time.monotonic() + events.EVENTS_MAX_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                event = subscription.get(timeout=min(events.EVENTS_KEEPALIVE_SECONDS,
+                                                     max(0.0, deadline - time.monotonic())))
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield sse_event(event.event, event.data, event.id)
+    
+    response = sse_response(generate())
+    # Runs however the stream ends, including a client that never read it
+    response.call_on_close(events.release_stream)
+    return response
+
 # ============== AI Feature Endpoints ==============
 
 @app.route('/ai/reply-suggestions/<int:chirp_id>')
 @login_required
 def get_reply_suggestions(chirp_id):
     """Get AI-generated reply suggestions for a chirp"""
-    conn = get_db_connection()
+    conn = get_db()
     chirp = conn.execute('SELECT content FROM chirps WHERE id = ?', (chirp_id,)).fetchone()
-    conn.close()
     
     if not chirp:
         return jsonify({'error': 'Chirp not found'}), 404
@@ -755,6 +880,30 @@ def get_reply_suggestions(chirp_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/ai/reply-suggestions/<int:chirp_id>/stream')
+@login_required
+def stream_reply_suggestions(chirp_id):
+    """Stream reply suggestions as SSE, one 'suggestion' event per completed suggestion"""
+    conn = get_db()
+    chirp = conn.execute('SELECT content FROM chirps WHERE id = ?', (chirp_id,)).fetchone()
+    
+    if not chirp:
+        return jsonify({'error': 'Chirp not found'}), 404
+    
+    def generate():
+        count = 0
+        try:
+            ai = get_ai_service()
+            for suggestion in ai.stream_reply_suggestions(chirp['content'], num_suggestions=3):
+                yield sse_event('suggestion', {'index': count, 'text': suggestion})
+                count += 1
+        except Exception as e:
+            print(f"Error in stream_reply_suggestions: {str(e)}")
+            yield sse_event('error', {'error': 'AI suggestions are unavailable right now'})
+        yield sse_event('done', {'count': count})
+    
+    return sse_response(generate())
+
 @app.route('/ai/enhance-content', methods=['POST'])
 @login_required
 def enhance_content():
@@ -778,6 +927,32 @@ def enhance_content():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/ai/enhance-content/stream', methods=['POST'])
+@login_required
+def stream_enhance_content():
+    """Stream the improved chirp as SSE 'content' deltas, then 'tip' events and a final 'done'"""
+    data = request.get_json()
+    content = data.get('content', '')
+    
+    if not content:
+        return jsonify({'error': 'Content is required'}), 400
+    
+    def generate():
+        try:
+            ai = get_ai_service()
+            for kind, value in ai.stream_enhance_content(content):
+                if kind == 'content':
+                    yield sse_event('content', {'delta': value})
+                elif kind == 'tip':
+                    yield sse_event('tip', {'text': value})
+                else:
+                    yield sse_event('done', value)
+        except Exception as e:
+            print(f"Error in stream_enhance_content: {str(e)}")
+            yield sse_event('error', {'error': 'AI enhancement is unavailable right now'})
+    
+    return sse_response(generate())
+
 @app.route('/ai/hashtag-suggestions', methods=['POST'])
 @login_required
 def get_hashtag_suggestions():
@@ -805,7 +980,7 @@ def get_hashtag_suggestions():
 @login_required
 def get_chirp_sentiment(chirp_id):
     """Get sentiment analysis for a chirp"""
-    conn = get_db_connection()
+    conn = get_db()
     
     # Check if analysis exists in cache
     analysis = conn.execute('''
@@ -814,7 +989,6 @@ def get_chirp_sentiment(chirp_id):
     ''', (chirp_id,)).fetchone()
     
     if analysis:
-        conn.close()
         return jsonify({
             'sentiment': analysis['sentiment'],
             'score': analysis['sentiment_score'],
@@ -826,7 +1000,6 @@ def get_chirp_sentiment(chirp_id):
     chirp = conn.execute('SELECT content FROM chirps WHERE id = ?', (chirp_id,)).fetchone()
     
     if not chirp:
-        conn.close()
         return jsonify({'error': 'Chirp not found'}), 404
     
     try:
@@ -839,71 +1012,61 @@ def get_chirp_sentiment(chirp_id):
             VALUES (?, ?, ?, ?)
         ''', (chirp_id, result['sentiment'], result['score'], json.dumps(result['emotions'])))
         conn.commit()
-        conn.close()
         
         return jsonify(result)
     except Exception as e:
-        conn.close()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/ai/metrics')
+@login_required
+def get_ai_metrics():
+    """AI client, response cache and pre-filter counters for this worker process"""
+    return jsonify({
+        'groq': groq_client.stats(),
+        'cache': ai_cache.stats(),
+        'prefilter': content_filter.stats(),
+    })
+
 @app.route('/ai/trending-topics')
 @login_required
 def get_trending_topics():
-    """Get AI-analyzed trending topics from recent chirps"""
-    conn = get_db_connection()
+    """Get the latest trending topics (labeled by AI in the background)"""
+    conn = get_db()
+    snapshot = trending.latest_snapshot(conn)
     
-    # Get recent chirps (last 24 hours)
-    recent_chirps = conn.execute('''
-        SELECT content FROM chirps
-        WHERE created_at >= datetime('now', '-1 day')
-        ORDER BY created_at DESC
-        LIMIT 100
-    ''').fetchall()
-    
-    conn.close()
+    if trending.is_stale(snapshot):
+        jobs.enqueue(conn, 'label_trending', key='trending')
+        conn.commit()
+        jobs.notify()
     
-    if not recent_chirps:
-        return jsonify({'topics': []})
+    if snapshot is None:
+        # Nothing labeled yet; answer from this worker's detector meanwhile
+        detector = trending.get_detector()
+        detector.sync(conn)
+        return jsonify({'topics': trending.local_topics(detector.top(5)), 'computed_at': None})
     
-    try:
-        ai = get_ai_service()
-        chirp_texts = [chirp['content'] for chirp in recent_chirps]
-        topics = ai.generate_trending_topics(chirp_texts, top_n=5)
-        return jsonify({'topics': topics})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return jsonify(snapshot)
 
 @app.route('/ai/conversation-summary/<username>')
 @login_required
 def summarize_conversation(username):
     """Get AI summary of a conversation"""
-    conn = get_db_connection()
+    conn = get_db()
     
     other_user = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
     
     if not other_user:
-        conn.close()
         return jsonify({'error': 'User not found'}), 404
     
     # Get last 20 messages
-    messages = conn.execute('''
-        SELECT m.content, u.username
-        FROM messages m
-        JOIN users u ON u.id = m.sender_id
-        WHERE (m.sender_id = ? AND m.receiver_id = ?) 
-           OR (m.sender_id = ? AND m.receiver_id = ?)
-        ORDER BY m.created_at DESC
-        LIMIT 20
-    ''', (session['user_id'], other_user['id'], other_user['id'], session['user_id'])).fetchall()
-    
-    conn.close()
+    messages, _ = inbox.thread_page(conn, session['user_id'], other_user['id'], limit=20)
     
     if not messages:
         return jsonify({'summary': 'No messages to summarize'})
     
     try:
         ai = get_ai_service()
-        message_list = [{'username': msg['username'], 'content': msg['content']} for msg in reversed(messages)]
+        message_list = [{'username': msg['username'], 'content': msg['content']} for msg in messages]
         summary = ai.summarize_conversation(message_list)
         return jsonify({'summary': summary})
     except Exception as e:
@@ -915,7 +1078,7 @@ def summarize_conversation(username):
 @login_required
 def bookmark_chirp(chirp_id):
     """Bookmark or unbookmark a chirp"""
-    conn = get_db_connection()
+    conn = get_db()
     
     # Check if already bookmarked
     existing_bookmark = conn.execute('SELECT id FROM bookmarks WHERE user_id = ? AND chirp_id = ?',
@@ -927,94 +1090,394 @@ def bookmark_chirp(chirp_id):
                     (session['user_id'], chirp_id))
         flash('Bookmark removed!', 'info')
     else:
-        # Add bookmark
-        conn.execute('INSERT INTO bookmarks (user_id, chirp_id) VALUES (?, ?)',
-                    (session['user_id'], chirp_id))
-        flash('Chirp bookmarked!', 'success')
+        # Add bookmark (foreign keys reject chirps that no longer exist)
+        try:
+            conn.execute('INSERT INTO bookmarks (user_id, chirp_id) VALUES (?, ?)',
+                        (session['user_id'], chirp_id))
+            flash('Chirp bookmarked!', 'success')
+        except sqlite3.IntegrityError:
+            flash('Chirp not found!', 'danger')
     
     conn.commit()
-    conn.close()
     
     return redirect(request.referrer or url_for('timeline'))
 
 @app.route('/bookmarks')
 @login_required
 def bookmarks():
-    """View all bookmarked chirps"""
-    conn = get_db_connection()
-    
-    chirps = conn.execute('''
-        SELECT c.*, u.username, u.full_name, u.profile_picture,
-               (SELECT COUNT(*) FROM likes WHERE chirp_id = c.id) as like_count,
-               (SELECT COUNT(*) FROM likes WHERE chirp_id = c.id AND user_id = ?) as user_liked,
-               (SELECT COUNT(*) FROM comments WHERE chirp_id = c.id) as comment_count,
-               (SELECT COUNT(*) FROM retweets WHERE chirp_id = c.id) as retweet_count,
-               (SELECT COUNT(*) FROM retweets WHERE chirp_id = c.id AND user_id = ?) as user_retweeted,
-               1 as user_bookmarked
-        FROM chirps c
-        JOIN users u ON c.user_id = u.id
-        JOIN bookmarks b ON b.chirp_id = c.id
-        WHERE b.user_id = ?
-        ORDER BY b.created_at DESC
-    ''', (session['user_id'], session['user_id'], session['user_id'])).fetchall()
+    """View bookmarked chirps, most recently saved first"""
+    cursor = feeds.decode_cursor(request.args.get('cursor'))
+    limit = feeds.page_size(request.args.get('limit'))
+    
+    conn = get_db()
+    
+    etag = page_etag(conditional.bookmarks_etag, conn, session['user_id'], cursor, limit)
+    response = not_modified(etag)
+    if response is not None:
+        return response
     
-    conn.close()
-    return render_template('bookmarks.html', chirps=chirps)
+    chirps, next_cursor = feeds.bookmarks_page(conn, session['user_id'], cursor, limit)
+    chirps = feeds.hydrate_chirps(conn, chirps, session['user_id'])
+    
+    bookmark_count = conn.execute('SELECT COUNT(*) as count FROM bookmarks WHERE user_id = ?',
+                                  (session['user_id'],)).fetchone()['count']
+    
+    return validated(render_template('bookmarks.html', chirps=chirps, bookmark_count=bookmark_count,
+                                     next_url=next_page_url(next_cursor)), etag)
 
 # ============== Who to Follow ==============
 
+def queue_suggestions_refresh(conn, user_id=None):
+    """Queue a refresh of one user's follow suggestions, or of everyone's"""
+    if user_id is None:
+        jobs.enqueue(conn, 'refresh_suggestions', key='all')
+    else:
+        jobs.enqueue(conn, 'refresh_suggestions', key=f'user:{user_id}', payload={'user_id': user_id})
+
 @app.route('/api/who-to-follow')
 @login_required
 def who_to_follow():
-    """Get suggested users to follow"""
-    conn = get_db_connection()
+    """Get suggested users to follow (precomputed by recommendations.py)"""
+    conn = get_db()
+    result = recommendations.suggestions_for(conn, session['user_id'])
     
-    # Get users not currently followed, ordered by follower count
-    suggestions = conn.execute('''
-        SELECT u.id, u.username, u.full_name, u.profile_picture, u.bio,
-               (SELECT COUNT(*) FROM follows WHERE following_id = u.id) as follower_count
-        FROM users u
-        WHERE u.id != ?
-        AND u.id NOT IN (SELECT following_id FROM follows WHERE follower_id = ?)
-        ORDER BY follower_count DESC
-        LIMIT 5
-    ''', (session['user_id'], session['user_id'])).fetchall()
+    stale = recommendations.is_stale(result)
+    if stale or not result['personal']:
+        queue_suggestions_refresh(conn, None if stale else session['user_id'])
+        conn.commit()
+        jobs.notify()
     
-    conn.close()
+    ids = [s['id'] for s in result['suggestions'][:5]]
+    headers = profiles.get_headers(conn, ids)
     
-    return jsonify([dict(user) for user in suggestions])
+    return jsonify([{
+        **{field: headers[user_id][field] for field in
+           ('id', 'username', 'full_name', 'profile_picture', 'bio', 'follower_count')},
+        'profile_picture_url': media_url(headers[user_id]['profile_picture']) if headers[user_id]['profile_picture'] else None,
+    } for user_id in ids if user_id in headers])
+
+# ============== Feed API ==============
+
+def api_feed(load_page, etag_validator, *etag_args):
+    """
+    One JSON feed page for the /api/v1 endpoints, with ?cursor=, ?limit= and
+    ?fields=. load_page(conn, cursor, limit) returns (rows, next_cursor);
+    etag_validator is the matching conditional.*_etag.
+    """
+    try:
+        fields = feed_api.parse_fields(request.args.get('fields'))
+    except feed_api.FieldError as e:
+        return jsonify({'error': str(e)}), 400
+    cursor = feeds.decode_cursor(request.args.get('cursor'))
+    limit = feeds.page_size(request.args.get('limit'))
+    
+    conn = get_db()
+    
+    etag = page_etag(etag_validator, conn, session['user_id'], *etag_args, cursor, limit)
+    if etag is not None:
+        etag = conditional.make_etag('api', fields, etag)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    
+    chirps, next_cursor = load_page(conn, cursor, limit)
+    # Only load viewer state and media when they were asked for
+    viewer_id = session['user_id'] if feed_api.needs_viewer(fields) else None
+    chirps = feeds.hydrate_chirps(conn, chirps, viewer_id, with_media=feed_api.needs_media(fields))
+    
+    body = feed_api.serialize_page(chirps, fields, next_cursor, next_page_url(next_cursor), media_url)
+    return validated(app.response_class(body, mimetype='application/json'), etag)
+
+@app.route('/api/v1/timeline')
+@login_required
+def api_timeline():
+    """The home timeline as JSON pages"""
+    user_id = session['user_id']
+    return api_feed(lambda conn, cursor, limit: feeds.timeline_page(conn, user_id, cursor, limit),
+                    conditional.timeline_etag)
+
+@app.route('/api/v1/explore')
+@login_required
+def api_explore():
+    """All chirps, newest first, as JSON pages"""
+    return api_feed(feeds.explore_page, conditional.explore_etag)
+
+@app.route('/api/v1/users/<username>/chirps')
+@login_required
+def api_user_chirps(username):
+    """A user's chirps as JSON pages"""
+    user = profiles.get_header_by_username(get_db(), username)
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    return api_feed(lambda conn, cursor, limit: feeds.user_page(conn, user['id'], cursor, limit),
+                    conditional.profile_etag, user)
+
+@app.route('/api/v1/bookmarks')
+@login_required
+def api_bookmarks():
+    """The user's bookmarks, most recently saved first, as JSON pages"""
+    user_id = session['user_id']
+    return api_feed(lambda conn, cursor, limit: feeds.bookmarks_page(conn, user_id, cursor, limit),
+                    conditional.bookmarks_etag)
 
 # ============== AI Image Generation ==============
 
+def generated_image_response(result):
+    """JSON for an image generation, with the URL to poll while it is pending"""
+    body = {'success': True, 'status': result['status'],
+            'status_url': url_for('generated_image_status', key=result['key'])}
+    if result['status'] == image_gen.DONE:
+        body['image_url'] = media_url(result['path'])
+    elif result['status'] == image_gen.FAILED:
+        body['success'] = False
+        body['error'] = 'Failed to generate image. Please try again.'
+    return body
+
 @app.route('/ai/generate-image', methods=['POST'])
 @login_required
 def generate_image():
-    """Generate image using Pollinations.ai (free) based on description"""
-    data = request.get_json()
-    prompt = data.get('prompt', '')
+    """Start generating an image with Pollinations.ai (free); the client polls status_url"""
+    data = request.get_json(silent=True) or {}
+    prompt = image_gen.normalize_prompt(data.get('prompt', ''))
     
     if not prompt:
         return jsonify({'error': 'Prompt is required'}), 400
     
+    conn = get_db()
+    result = image_gen.request(conn, prompt, session['user_id'])
+    if result['status'] == image_gen.DONE:
+        return jsonify(generated_image_response(result))
+    
+    jobs.enqueue(conn, 'generate_image', key=result['key'], payload={'key': result['key']}, max_attempts=2)
+    conn.commit()
+    jobs.notify()
+    return jsonify(generated_image_response(result)), 202
+
+@app.route('/ai/generate-image/<key>')
+@login_required
+def generated_image_status(key):
+    """Status of an image generation started by generate_image"""
+    row = image_gen.get(get_db(), key)
+    if not row:
+        return jsonify({'error': 'Unknown image'}), 404
+    return jsonify(generated_image_response(dict(row, key=key)))
+
+# ============== Background Jobs ==============
+
+def save_chirp_analysis(conn, chirp_id, analysis):
+    """Store an AIService.analyze_chirp() result as the chirp's ai_analysis row"""
+    values = (
+        analysis['sentiment'],
+        analysis['score'],
+        json.dumps(analysis['emotions']),
+        json.dumps(analysis['hashtags']),
+        0 if analysis['moderation']['is_safe'] else 1,
+        analysis['moderation']['reason'],
+        analysis['spam']['confidence'] if analysis['spam']['is_spam'] else 0.0,
+        chirp_id,
+    )
+    
+    # Update-or-insert keeps retries idempotent: one ai_analysis row per chirp
+    updated = conn.execute('''
+        UPDATE ai_analysis
+        SET sentiment = ?, sentiment_score = ?, emotions = ?, suggested_hashtags = ?,
+            moderation_flag = ?, moderation_reason = ?, spam_score = ?
+        WHERE chirp_id = ?
+    ''', values).rowcount
+    if not updated:
+        conn.execute('''
+            INSERT INTO ai_analysis (sentiment, sentiment_score, emotions, suggested_hashtags,
+                                     moderation_flag, moderation_reason, spam_score, chirp_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', values)
+
+@jobs.handler('enrich_chirp')
+def enrich_chirp_job(conn, payload):
+    """Analyze a chirp whose analysis could not be done when it was posted"""
+    chirp_id = payload['chirp_id']
+    chirp = conn.execute('SELECT content FROM chirps WHERE id = ?', (chirp_id,)).fetchone()
+    if not chirp:
+        return  # Deleted before we got to it
+    
     try:
         ai = get_ai_service()
-        result = ai.generate_image_with_pollinations(prompt)
-        
-        if result.get('success'):
-            return jsonify({
-                'success': True,
-                'image_path': result['image_path'],
-                'type': result['type'],
-                'message': 'Image generated successfully!'
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'error': result.get('error', 'Failed to generate image')
-            }), 500
-            
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    except ValueError as ve:
+        print(f"AI enrichment skipped: {str(ve)}")
+        return
+    
+    analysis = ai.analyze_chirp(chirp['content'])
+    if analysis is None:
+        raise RuntimeError('AI analysis failed')  # Retried with backoff
+    save_chirp_analysis(conn, chirp_id, analysis)
+
+def refresh_trending_topics(conn):
+    """Recompute and publish trending topics from the detector's top terms"""
+    detector = trending.get_detector()
+    detector.sync(conn)
+    terms = detector.top(20)
+    
+    topics = []
+    if terms:
+        try:
+            topics = get_ai_service().label_trending_topics(terms, top_n=5)
+        except ValueError as ve:
+            print(f"Trending labels skipped: {str(ve)}")
+        if not topics:
+            topics = trending.local_topics(terms)
+    
+    trending.save_snapshot(conn, topics)
+    return topics
+
+@jobs.handler('generate_image')
+def generate_image_job(conn, payload):
+    """Download a requested AI image; the client polls generated_image_status for it"""
+    image_gen.generate(conn, payload['key'])
+
+@jobs.on_dead('generate_image')
+def generate_image_failed(conn, payload, error):
+    """The last retry of a generation failed; tell the polling client"""
+    image_gen.fail(conn, payload['key'], error)
+
+@jobs.handler('refresh_suggestions')
+def refresh_suggestions_job(conn, payload):
+    """Recompute follow suggestions: one user's after a follow change, or everyone's when stale"""
+    if 'user_id' in payload:
+        recommendations.refresh_user(conn, payload['user_id'])
+    else:
+        recommendations.refresh_all(conn)
+
+@jobs.handler('label_trending')
+def label_trending_job(conn, payload):
+    """Periodic trending refresh, queued by the endpoint when the snapshot is stale"""
+    refresh_trending_topics(conn)
+
+# ============== Maintenance Commands ==============
+
+@app.cli.command('rebuild-timelines')
+@click.option('--user', 'username', default=None, help='Only rebuild this user\'s home timeline')
+def rebuild_timelines_command(username):
+    """Rebuild materialized home timelines from chirps and follows"""
+    conn = get_db()
+    user_id = None
+    if username:
+        user = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+        if not user:
+            raise click.ClickException(f'User not found: {username}')
+        user_id = user['id']
+    
+    entries = timeline_store.rebuild_home_timelines(conn, user_id)
+    conn.commit()
+    click.echo(f'Rebuilt home timelines ({entries} entries).')
+
+@app.cli.command('reconcile-stats')
+def reconcile_stats_command():
+    """Recompute chirp engagement and user follower/following/chirp counters that drifted"""
+    conn = get_db()
+    fixed = chirp_stats.reconcile_chirp_stats(conn)
+    users_fixed = profiles.reconcile_user_counts(conn)
+    conn.commit()
+    click.echo(f'Reconciled chirp stats ({fixed} rows fixed) and user counts ({users_fixed} users fixed).')
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Rebuild the full-text search indexes over chirps and users"""
+    conn = get_db()
+    search_index.rebuild_search_index(conn)
+    conn.commit()
+    click.echo('Rebuilt search indexes.')
+
+@app.cli.command('refresh-suggestions')
+def refresh_suggestions_command():
+    """Recompute every user's who-to-follow suggestions"""
+    conn = get_db()
+    users = recommendations.refresh_all(conn)
+    conn.commit()
+    click.echo(f'Refreshed follow suggestions ({users} users).')
+
+@app.cli.command('run-worker')
+@click.option('--threads', default=jobs.JOB_WORKER_THREADS, show_default=True, help='Worker threads')
+def run_worker_command(threads):
+    """Drain the background job queue until interrupted"""
+    pool = jobs.start_workers(threads)
+    click.echo(f'Job worker running with {threads} threads. Press Ctrl+C to stop.')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pool.stop(timeout=10)
+
+@app.cli.command('jobs')
+@click.option('--requeue-dead', is_flag=True, help='Retry dead-lettered jobs')
+@click.option('--purge-done', is_flag=True, help='Delete finished jobs')
+def jobs_command(requeue_dead, purge_done):
+    """Show background job queue status"""
+    conn = get_db()
+    if requeue_dead:
+        click.echo(f'Requeued {jobs.requeue_dead(conn)} dead jobs.')
+    if purge_done:
+        click.echo(f'Purged {jobs.purge_done(conn)} finished jobs.')
+    conn.commit()
+    
+    for status, count in jobs.queue_stats(conn).items():
+        click.echo(f'{status}: {count}')
+    for job in conn.execute("SELECT id, kind, key, attempts, last_error FROM jobs WHERE status = 'dead' ORDER BY id DESC LIMIT 20"):
+        click.echo(f"  dead #{job['id']} {job['kind']}({job['key']}) after {job['attempts']} attempts: {job['last_error']}")
+
+@app.cli.command('rebuild-conversations')
+def rebuild_conversations_command():
+    """Rebuild the DM inbox (conversations table) from messages"""
+    conn = get_db()
+    rows = inbox.rebuild_conversations(conn)
+    conn.commit()
+    click.echo(f'Rebuilt conversations ({rows} rows).')
+
+@app.cli.command('refresh-trending')
+def refresh_trending_command():
+    """Recompute trending topics now"""
+    conn = get_db()
+    topics = refresh_trending_topics(conn)
+    conn.commit()
+    for topic in topics:
+        click.echo(f"{topic['topic']} ({topic['relevance']:.2f}): {', '.join(topic['terms'])}")
+
+@app.cli.command('migrate-media')
+@click.option('--dry-run', is_flag=True, help='Only count what would be migrated.')
+def migrate_media_command(dry_run):
+    """Move uploads saved before content addressing into deduplicated blobs."""
+    conn = get_db()
+    counts = media_store.migrate_legacy(conn, dry_run=dry_run)
+    click.echo(f"{'Would migrate' if dry_run else 'Migrated'} {counts['chirp_media']} chirp media and "
+               f"{counts['profile_pictures']} profile pictures; {counts['missing']} files missing or unreadable, "
+               f"{counts['deleted_files']} old files deleted.")
+
+@app.cli.command('media-gc')
+@click.option('--reconcile', is_flag=True, help='Recompute reference counts first.')
+@click.option('--grace', type=int, default=media_store.MEDIA_GC_GRACE_SECONDS, show_default=True,
+              help='Keep unreferenced blobs younger than this many seconds.')
+def media_gc_command(reconcile, grace):
+    """Delete media blobs that no chirp or profile uses any more."""
+    conn = get_db()
+    if reconcile:
+        click.echo(f"Corrected {media_store.reconcile_refcounts(conn)} reference counts.")
+        conn.commit()
+    removed = media_store.collect_garbage(conn, grace)
+    conn.commit()
+    click.echo(f"Removed {removed} unreferenced blobs.")
+
+@app.cli.command('ai-cache')
+@click.option('--purge-expired', is_flag=True, help='Delete expired entries')
+@click.option('--clear', 'clear_all', is_flag=True, help='Delete every cached response')
+def ai_cache_command(purge_expired, clear_all):
+    """Show the shared AI response cache, or clean it up"""
+    conn = get_db()
+    if clear_all:
+        click.echo(f'Cleared {ai_cache.clear(conn)} cached responses.')
+    elif purge_expired:
+        click.echo(f'Purged {ai_cache.purge_expired(conn)} expired responses.')
+    conn.commit()
+    
+    for row in ai_cache.persistent_stats(conn):
+        click.echo(f"{row['task']}: {row['entries']} entries, {row['hits']} hits")
 
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
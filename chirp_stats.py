@@ -0,0 +1,59 @@
+"""
+Chirp Engagement Counters for ChirpX
+Like, comment and retweet counts are denormalized into the chirp_stats table
+and kept in sync by SQLite triggers (see schema.sql). This module recomputes
+them from the source tables when they drift.
+"""
+
+import sqlite3
+
+# Counts recomputed from the source tables, one row per existing chirp
+_ACTUAL_COUNTS = '''
+    SELECT c.id AS chirp_id,
+           COALESCE(l.n, 0) AS like_count,
+           COALESCE(cm.n, 0) AS comment_count,
+           COALESCE(r.n, 0) AS retweet_count
+    FROM chirps c
+    LEFT JOIN (SELECT chirp_id, COUNT(*) AS n FROM likes GROUP BY chirp_id) l ON l.chirp_id = c.id
+    LEFT JOIN (SELECT chirp_id, COUNT(*) AS n FROM comments GROUP BY chirp_id) cm ON cm.chirp_id = c.id
+    LEFT JOIN (SELECT chirp_id, COUNT(*) AS n FROM retweets GROUP BY chirp_id) r ON r.chirp_id = c.id
+'''
+
+
+def reconcile_chirp_stats(conn: sqlite3.Connection) -> int:
+    """
+    Recompute counters that drifted from the likes, comments and retweets tables.
+    Missing rows are created and rows for deleted chirps are removed.
+    Returns the number of chirp_stats rows that were fixed.
+    """
+    cursor = conn.execute(f'''
+        INSERT INTO chirp_stats (chirp_id, like_count, comment_count, retweet_count)
+        SELECT a.chirp_id, a.like_count, a.comment_count, a.retweet_count
+        FROM ({_ACTUAL_COUNTS}) a
+        LEFT JOIN chirp_stats s ON s.chirp_id = a.chirp_id
+        WHERE s.chirp_id IS NULL
+           OR s.like_count != a.like_count
+           OR s.comment_count != a.comment_count
+           OR s.retweet_count != a.retweet_count
+        ON CONFLICT(chirp_id) DO UPDATE SET
+            like_count = excluded.like_count,
+            comment_count = excluded.comment_count,
+            retweet_count = excluded.retweet_count
+    ''')
+    fixed = cursor.rowcount
+
+    cursor = conn.execute('DELETE FROM chirp_stats WHERE chirp_id NOT IN (SELECT id FROM chirps)')
+    return fixed + cursor.rowcount
+
+
+def backfill_if_empty(conn: sqlite3.Connection) -> bool:
+    """
+    Populate counters once for databases created before chirp_stats existed.
+    Returns True when a backfill was performed.
+    """
+    if conn.execute('SELECT 1 FROM chirp_stats LIMIT 1').fetchone():
+        return False
+    if not conn.execute('SELECT 1 FROM chirps LIMIT 1').fetchone():
+        return False
+    reconcile_chirp_stats(conn)
+    return True
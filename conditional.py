@@ -0,0 +1,112 @@
+"""
+Conditional GET for ChirpX
+Feed and profile pages carry an ETag built from a few indexed reads instead of
+the page itself: which chirps are on the page, the version counters of their
+authors (users.feed_version, moved by triggers on every change a card shows)
+and the viewer's own activity_version. A browser revalidating a page that has
+not changed gets a 304 before anything is hydrated or rendered.
+"""
+
+import hashlib
+import os
+import sqlite3
+from typing import Dict, Iterable, Optional, Tuple
+
+from feeds import keyset_clause
+
+# Settings (override through environment variables)
+CONDITIONAL_GET_ENABLED = os.getenv('CONDITIONAL_GET_ENABLED', '1') == '1'
+# Mixed into every ETag; change it to drop all cached pages at once
+ETAG_SALT = os.getenv('ETAG_SALT', '')
+
+_code_version: Optional[str] = None
+
+
+def code_version() -> str:
+    """
+    Digest of the templates and modules that render pages, so a deploy that
+    changes markup does not answer 304 for pages cached before it
+    """
+    global _code_version
+    if _code_version is None:
+        root = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha1(ETAG_SALT.encode())
+        for directory, suffix in ((root, '.py'), (os.path.join(root, 'templates'), '.html')):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(suffix):
+                    with open(os.path.join(directory, name), 'rb') as f:
+                        digest.update(name.encode() + b'\0' + f.read())
+        _code_version = digest.hexdigest()[:16]
+    return _code_version
+
+
+def make_etag(*parts) -> str:
+    """Opaque tag over the code version and the given validator parts"""
+    raw = repr((code_version(), parts)).encode()
+    return hashlib.sha1(raw).hexdigest()
+
+
+def activity_version(conn: sqlite3.Connection, user_id: int) -> int:
+    row = conn.execute('SELECT activity_version FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def page_versions(conn: sqlite3.Connection, sql: str, params: Iterable) -> Tuple:
+    """
+    Run a feed's page query (see feeds.*_page) reduced to (id, author
+    feed_version) pairs, with the same seek and LIMIT limit + 1, so the result
+    also tells whether a next page exists
+    """
+    return tuple(tuple(row) for row in conn.execute(sql, list(params)))
+
+
+def timeline_etag(conn: sqlite3.Connection, viewer_id: int, cursor: Optional[Tuple[str, int]], limit: int) -> str:
+    seek, seek_params = keyset_clause(cursor, 'h.created_at', 'h.chirp_id')
+    rows = page_versions(conn, f'''
+        SELECT h.chirp_id, u.feed_version
+        FROM home_timeline h
+        JOIN users u ON u.id = h.author_id
+        WHERE h.user_id = ? AND {seek}
+        ORDER BY h.created_at DESC, h.chirp_id DESC
+        LIMIT ?
+    ''', (viewer_id, *seek_params, limit + 1))
+    return make_etag('timeline', viewer_id, activity_version(conn, viewer_id), limit, rows)
+
+
+def explore_etag(conn: sqlite3.Connection, viewer_id: int, cursor: Optional[Tuple[str, int]], limit: int) -> str:
+    seek, seek_params = keyset_clause(cursor, 'c.created_at', 'c.id')
+    rows = page_versions(conn, f'''
+        SELECT c.id, u.feed_version
+        FROM chirps c
+        JOIN users u ON u.id = c.user_id
+        WHERE {seek}
+        ORDER BY c.created_at DESC, c.id DESC
+        LIMIT ?
+    ''', (*seek_params, limit + 1))
+    return make_etag('explore', viewer_id, activity_version(conn, viewer_id), limit, rows)
+
+
+def bookmarks_etag(conn: sqlite3.Connection, viewer_id: int, cursor: Optional[Tuple[str, int]], limit: int) -> str:
+    seek, seek_params = keyset_clause(cursor, 'b.created_at', 'b.id')
+    rows = page_versions(conn, f'''
+        SELECT b.id, u.feed_version
+        FROM bookmarks b
+        JOIN chirps c ON c.id = b.chirp_id
+        JOIN users u ON u.id = c.user_id
+        WHERE b.user_id = ? AND {seek}
+        ORDER BY b.created_at DESC, b.id DESC
+        LIMIT ?
+    ''', (viewer_id, *seek_params, limit + 1))
+    return make_etag('bookmarks', viewer_id, activity_version(conn, viewer_id), limit, rows)
+
+
+def profile_etag(conn: sqlite3.Connection, viewer_id: int, header: Dict, cursor: Optional[Tuple[str, int]],
+                 limit: int) -> str:
+    """
+    A profile page shows only the profile user's header and chirps, all covered
+    by their feed_version, so no page query is needed. The version is taken from
+    the header being rendered (see profiles.get_header), so the tag always
+    describes what the page shows.
+    """
+    return make_etag('profile', viewer_id, activity_version(conn, viewer_id), header['id'], header['feed_version'],
+                     cursor, limit)
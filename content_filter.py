@@ -0,0 +1,247 @@
+"""
+Content Pre-Filter for ChirpX
+Cheap local spam heuristics (and an optional blocklist) that run before any
+Groq call: clear spam is rejected without the LLM, and clearly clean chirps
+skip the LLM's spam verdict. Moderation is always left to the LLM.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Set
+
+# Settings (override through environment variables)
+FILTER_ENABLED = os.getenv('FILTER_ENABLED', '1') == '1'
+FILTER_MAX_LINKS = int(os.getenv('FILTER_MAX_LINKS', '3'))
+FILTER_MAX_HASHTAG_DENSITY = float(os.getenv('FILTER_MAX_HASHTAG_DENSITY', '0.5'))
+FILTER_RECENT_POSTS = int(os.getenv('FILTER_RECENT_POSTS', '20'))
+FILTER_REPEAT_SIMILARITY = float(os.getenv('FILTER_REPEAT_SIMILARITY', '0.85'))
+FILTER_RATE_WINDOW_SECONDS = int(os.getenv('FILTER_RATE_WINDOW_SECONDS', '600'))
+FILTER_RATE_LIMIT = int(os.getenv('FILTER_RATE_LIMIT', '15'))
+# Spam score at or above which a chirp is rejected without asking the LLM
+FILTER_BLOCK_SCORE = float(os.getenv('FILTER_BLOCK_SCORE', '1.0'))
+# Spam score at or below which a chirp counts as not spam; the LLM still moderates it
+FILTER_ALLOW_SCORE = float(os.getenv('FILTER_ALLOW_SCORE', '0.0'))
+# Optional extra terms, one per line
+FILTER_SPAM_TERMS_FILE = os.getenv('FILTER_SPAM_TERMS_FILE', '')
+FILTER_BLOCKED_TERMS_FILE = os.getenv('FILTER_BLOCKED_TERMS_FILE', '')
+
+# Decisions
+ALLOW = 'allow'
+BLOCK = 'block'
+UNSURE = 'unsure'  # let the LLM decide on spam too
+
+# Phrases that count towards the spam score
+DEFAULT_SPAM_TERMS = [
+    'buy followers', 'free followers', 'click here', 'click the link', 'dm me for',
+    'earn money fast', 'make money fast', 'work from home', 'guaranteed profit',
+    'double your money', 'crypto giveaway', 'free giveaway', 'limited time offer',
+    'act now', 'claim your prize', 'you have won', 'verify your account',
+    'onlyfans', 'cheap viagra', 'casino bonus',
+]
+
+_URL_RE = re.compile(r'(?:https?://|www\.)\S+', re.IGNORECASE)
+_HASHTAG_RE = re.compile(r'#\w+')
+_WORD_RE = re.compile(r'\w+')
+
+
+class AhoCorasick:
+    """Multi-pattern matcher: finds every pattern in a text in one pass"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Set[str]] = [set()]
+        for pattern in patterns:
+            pattern = pattern.strip().lower()
+            if pattern:
+                self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str) -> None:
+        state = 0
+        for char in pattern:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(set())
+            state = nxt
+        self._out[state].add(pattern)
+
+    def _build(self) -> None:
+        # Breadth-first so every failure link points at an already finished state
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] |= self._out[self._fail[nxt]]
+
+    def find(self, text: str) -> Set[str]:
+        """Patterns that occur in text as whole words or phrases (case-insensitive)"""
+        text = text.lower()
+        found = set()
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for pattern in self._out[state]:
+                start = end - len(pattern) + 1
+                before = text[start - 1] if start > 0 else ' '
+                after = text[end + 1] if end + 1 < len(text) else ' '
+                if not before.isalnum() and not after.isalnum():
+                    found.add(pattern)
+        return found
+
+
+def _load_terms(path: str) -> List[str]:
+    if not path:
+        return []
+    try:
+        with open(path, encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    except OSError as e:
+        print(f"Content filter: could not read {path}: {str(e)}")
+        return []
+
+
+_matchers: Dict[str, AhoCorasick] = {}
+_matchers_lock = threading.Lock()
+
+
+def _matcher(name: str) -> AhoCorasick:
+    """Blocklist matchers, built once per process"""
+    if name not in _matchers:
+        with _matchers_lock:
+            if name not in _matchers:
+                if name == 'spam':
+                    terms = DEFAULT_SPAM_TERMS + _load_terms(FILTER_SPAM_TERMS_FILE)
+                else:
+                    terms = _load_terms(FILTER_BLOCKED_TERMS_FILE)
+                _matchers[name] = AhoCorasick(terms)
+    return _matchers[name]
+
+
+def _shingles(text: str) -> Set[str]:
+    words = _WORD_RE.findall(_URL_RE.sub(' ', text.lower()))
+    if len(words) < 3:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + 3]) for i in range(len(words) - 2)}
+
+
+def similarity(a: str, b: str) -> float:
+    """Jaccard similarity of the word 3-shingles of two texts"""
+    sa, sb = _shingles(a), _shingles(b)
+    if not sa or not sb:
+        return 0.0
+    return len(sa & sb) / len(sa | sb)
+
+
+@dataclass
+class Verdict:
+    decision: str
+    category: str = ''  # 'spam' or 'moderation' when blocked
+    spam_score: float = 0.0
+    reasons: List[str] = field(default_factory=list)
+
+    @property
+    def reason(self) -> str:
+        return '; '.join(self.reasons)
+
+
+_decisions: Counter = Counter()
+_decisions_lock = threading.Lock()
+
+
+def _record(verdict: Verdict) -> Verdict:
+    with _decisions_lock:
+        _decisions[verdict.decision] += 1
+    return verdict
+
+
+def classify(conn: sqlite3.Connection, user_id: int, content: str) -> Verdict:
+    """
+    Score a chirp that user_id is about to post.
+    BLOCK is confident enough to reject without the LLM. ALLOW only settles
+    spam: a clean spam score says nothing about abuse, so the LLM still
+    moderates the chirp. UNSURE leaves spam to the LLM as well.
+    """
+    if not FILTER_ENABLED:
+        return Verdict(UNSURE)
+
+    blocked = _matcher('blocked').find(content)
+    if blocked:
+        return _record(Verdict(BLOCK, 'moderation', reasons=['Contains blocked terms']))
+
+    score = 0.0
+    reasons = []
+
+    links = len(_URL_RE.findall(content))
+    if links:
+        score += 0.15 * links
+        if links >= FILTER_MAX_LINKS:
+            score += 0.5
+            reasons.append(f'{links} links')
+
+    words = len(_WORD_RE.findall(_URL_RE.sub(' ', content)))
+    hashtags = len(_HASHTAG_RE.findall(content))
+    if hashtags >= 3 and words and hashtags / words >= FILTER_MAX_HASHTAG_DENSITY:
+        score += 0.5
+        reasons.append('Too many hashtags')
+
+    spam_terms = _matcher('spam').find(content)
+    if spam_terms:
+        score += 0.4 * len(spam_terms)
+        reasons.append('Promotional phrases')
+
+    recent = conn.execute('''
+        SELECT content FROM chirps WHERE user_id = ?
+        ORDER BY created_at DESC, id DESC LIMIT ?
+    ''', (user_id, FILTER_RECENT_POSTS)).fetchall()
+    repeats = sum(1 for row in recent if similarity(content, row['content']) >= FILTER_REPEAT_SIMILARITY)
+    if repeats:
+        score += 0.5 + 0.25 * (repeats - 1)
+        reasons.append('Repeats your recent chirps')
+
+    posted = conn.execute('''
+        SELECT COUNT(*) FROM chirps WHERE user_id = ? AND created_at >= datetime('now', ?)
+    ''', (user_id, f'-{FILTER_RATE_WINDOW_SECONDS} seconds')).fetchone()[0]
+    if posted >= FILTER_RATE_LIMIT:
+        score += 0.5
+        reasons.append('Posting too fast')
+
+    if score >= FILTER_BLOCK_SCORE:
+        return _record(Verdict(BLOCK, 'spam', score, reasons))
+    if score <= FILTER_ALLOW_SCORE:
+        return _record(Verdict(ALLOW, spam_score=score))
+    return _record(Verdict(UNSURE, spam_score=score, reasons=reasons))
+
+
+def stats() -> Dict[str, float]:
+    """
+    Decisions made by this process. Only BLOCK saves an LLM call (ALLOW chirps
+    are still moderated), so llm_calls_saved counts blocks alone; decision_rate
+    is the share whose spam check was settled locally.
+    """
+    with _decisions_lock:
+        counts = {ALLOW: _decisions[ALLOW], BLOCK: _decisions[BLOCK], UNSURE: _decisions[UNSURE]}
+    total = sum(counts.values())
+    decided = counts[ALLOW] + counts[BLOCK]
+    return {
+        **counts,
+        'total': total,
+        'llm_calls_saved': counts[BLOCK],
+        'llm_calls_saved_rate': round(counts[BLOCK] / total, 4) if total else 0.0,
+        'decision_rate': round(decided / total, 4) if total else 0.0,
+    }
@@ -0,0 +1,176 @@
+"""
+Database Connection Manager for ChirpX
+Tuned SQLite connections, a per-worker pool and one connection per request
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+from flask import g
+
+# Settings (override through environment variables)
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'chirpx.db')
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')  # NORMAL is durable enough under WAL
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '16384'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(128 * 1024 * 1024)))
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '8'))
+
+
+def connect(path: Optional[str] = None) -> sqlite3.Connection:
+    """Open a new connection with row access by name and the tuning pragmas applied"""
+    conn = sqlite3.connect(path or DATABASE_PATH,
+                           timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}')
+    conn.execute(f'PRAGMA synchronous = {SQLITE_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+
+def add_missing_columns(conn: sqlite3.Connection, table: str, columns: Dict[str, str]) -> List[str]:
+    """
+    Add columns (name -> type and constraints) that an existing table lacks;
+    CREATE TABLE IF NOT EXISTS never changes a table that is already there.
+    Missing tables are skipped.
+    Returns the names of the columns added.
+    """
+    existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    if not existing:
+        return []  # The table is created with every column by the schema
+    added = []
+    for name, definition in columns.items():
+        if name not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+            added.append(name)
+    return added
+
+
+# Columns added to tables after they first shipped; schema.sql has them for new databases.
+# They are added before the schema runs so its indexes and triggers can use them.
+COLUMN_MIGRATIONS = {
+    'chirp_media': {'width': 'INTEGER', 'height': 'INTEGER', 'variants': 'TEXT', 'blob_key': 'TEXT'},
+    'users': {'profile_picture_variants': 'TEXT', 'profile_picture_blob': 'TEXT',
+              'follower_count': 'INTEGER NOT NULL DEFAULT 0', 'following_count': 'INTEGER NOT NULL DEFAULT 0',
+              'chirp_count': 'INTEGER NOT NULL DEFAULT 0', 'feed_version': 'INTEGER NOT NULL DEFAULT 0',
+              'activity_version': 'INTEGER NOT NULL DEFAULT 0'},
+}
+
+
+def initialize(path: Optional[str] = None, schema_path: str = 'schema.sql') -> None:
+    """
+    Create the database or bring an existing one up to date: add the columns in
+    COLUMN_MIGRATIONS, run the idempotent schema, then fill the derived tables
+    (home timelines, counters, search index, ...) of databases that predate them.
+    Used by app startup and init_db.py.
+    """
+    # These modules use db themselves, so they are imported here rather than at the top
+    import chirp_stats
+    import inbox
+    import profiles
+    import recommendations
+    import search_index
+    import timeline_store
+
+    conn = connect(path)
+    try:
+        added = {table: add_missing_columns(conn, table, columns) for table, columns in COLUMN_MIGRATIONS.items()}
+        with open(schema_path, 'r') as f:
+            conn.executescript(f.read())
+        if 'follower_count' in added['users']:
+            # Existing users start at zero; count what they already have
+            profiles.reconcile_user_counts(conn)
+        conn.commit()
+
+        if timeline_store.backfill_if_empty(conn):
+            print("Home timelines backfilled.")
+        if chirp_stats.backfill_if_empty(conn):
+            print("Chirp stats backfilled.")
+        if search_index.backfill_if_empty(conn):
+            print("Search index built.")
+        if inbox.backfill_if_empty(conn):
+            print("Conversations backfilled.")
+        if recommendations.backfill_if_empty(conn):
+            print("Follow suggestions computed.")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class ConnectionPool:
+    """
+    Keeps up to `size` idle connections for reuse within one worker process.
+    Connections are opened lazily; when the pool is empty a new one is opened,
+    and when it is full a released connection is closed instead of kept.
+    """
+
+    def __init__(self, path: Optional[str] = None, size: int = SQLITE_POOL_SIZE):
+        self.path = path or DATABASE_PATH
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.path)
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        try:
+            # Never hand out a connection with a half-finished transaction
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+    def close_all(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Get the pool for the current process (a forked worker never reuses its parent's)"""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = ConnectionPool()
+                _pool_pid = pid
+    return _pool
+
+
+def get_db() -> sqlite3.Connection:
+    """Get the connection bound to the current request, borrowing one from the pool on first use"""
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+
+def close_db(exception: Optional[BaseException] = None) -> None:
+    """Return the request's connection to the pool"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
+
+
+def init_app(app) -> None:
+    """Register the per-request connection teardown with the Flask app"""
+    app.teardown_appcontext(close_db)
@@ -0,0 +1,290 @@
+"""
+Live Event Bus for ChirpX
+Publish/subscribe for the /events/stream Server-Sent Events endpoint. Each
+process fans events out to its own open streams; the backend decides how
+events reach other processes (the shared events table, or nowhere at all for
+the in-memory stand-in used in tests and single-process runs).
+"""
+
+import itertools
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import db
+
+# Settings (override through environment variables)
+EVENTS_BACKEND = os.getenv('EVENTS_BACKEND', 'sqlite')  # 'sqlite' (all workers) or 'memory' (one process)
+EVENTS_POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', '0.5'))
+EVENTS_RETENTION_SECONDS = int(os.getenv('EVENTS_RETENTION_SECONDS', '300'))
+EVENTS_QUEUE_SIZE = int(os.getenv('EVENTS_QUEUE_SIZE', '100'))
+EVENTS_KEEPALIVE_SECONDS = float(os.getenv('EVENTS_KEEPALIVE_SECONDS', '15'))
+# Streams are closed after this long; the browser reconnects and resumes from Last-Event-ID
+EVENTS_MAX_STREAM_SECONDS = int(os.getenv('EVENTS_MAX_STREAM_SECONDS', '300'))
+# Open streams per worker process; the rest are told to retry later so streams
+# cannot take every thread a gthread worker has
+EVENTS_MAX_STREAMS = int(os.getenv('EVENTS_MAX_STREAMS', '8'))
+# Reconnect delay suggested to browsers turned away by EVENTS_MAX_STREAMS
+EVENTS_BUSY_RETRY_MS = int(os.getenv('EVENTS_BUSY_RETRY_MS', '30000'))
+
+
+def user_channel(user_id: int) -> str:
+    """Events addressed to one user (messages, likes, comments)"""
+    return f'user:{user_id}'
+
+
+def author_channel(user_id: int) -> str:
+    """New chirps by one user, for their followers"""
+    return f'chirps:{user_id}'
+
+
+@dataclass
+class Event:
+    id: int
+    channel: str
+    event: str
+    data: Dict
+
+
+class Subscription:
+    """One open stream's queue of events on a set of channels"""
+
+    def __init__(self, bus: 'Bus', channels: Set[str]):
+        self.bus = bus
+        self.channels = channels
+        self.dropped = 0
+        self.last_id = 0
+        self._queue: 'queue.Queue[Event]' = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+
+    def put(self, event: Event) -> None:
+        if event.id <= self.last_id:
+            return  # Already queued by the replay
+        self.last_id = event.id
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # A stalled client must not hold up delivery to everyone else
+            self.dropped += 1
+
+    def get(self, timeout: float) -> Optional[Event]:
+        """The next event, or None when nothing arrived within timeout seconds"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        self.bus.unsubscribe(self)
+
+    def __enter__(self) -> 'Subscription':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class MemoryBackend:
+    """Delivers within the publishing process only; keeps a short log for replay"""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._log: 'deque[Event]' = deque(maxlen=1000)
+        self._deliver: Optional[Callable[[Event], None]] = None
+        self._lock = threading.Lock()
+
+    def start(self, deliver: Callable[[Event], None]) -> None:
+        self._deliver = deliver
+
+    def publish(self, channels: Iterable[str], event: str, data: Dict) -> None:
+        with self._lock:
+            published = [Event(next(self._ids), channel, event, data) for channel in channels]
+            self._log.extend(published)
+        if self._deliver:
+            for item in published:
+                self._deliver(item)
+
+    def since(self, channels: Set[str], last_id: int) -> List[Event]:
+        with self._lock:
+            return [e for e in self._log if e.id > last_id and e.channel in channels]
+
+
+class SQLiteBackend:
+    """
+    Appends events to the events table; a dispatcher thread in each process
+    with open streams polls it for new rows and hands them to the local bus.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._deliver: Optional[Callable[[Event], None]] = None
+        self._wake = threading.Event()
+        self._last_purge = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = db.connect()
+        return conn
+
+    def start(self, deliver: Callable[[Event], None]) -> None:
+        self._deliver = deliver
+        threading.Thread(target=self._dispatch, name='events-dispatcher', daemon=True).start()
+
+    def publish(self, channels: Iterable[str], event: str, data: Dict) -> None:
+        now = time.time()
+        payload = json.dumps(data)
+        try:
+            conn = self._connection()
+            conn.executemany('INSERT INTO events (channel, event, data, created_at) VALUES (?, ?, ?, ?)',
+                             [(channel, event, payload, now) for channel in channels])
+            if now - self._last_purge >= 60:
+                self._last_purge = now
+                conn.execute('DELETE FROM events WHERE created_at < ?', (now - EVENTS_RETENTION_SECONDS,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Event publish error: {str(e)}")
+            return
+        # Streams in this process need not wait for the next poll
+        self._wake.set()
+
+    def since(self, channels: Set[str], last_id: int) -> List[Event]:
+        try:
+            rows = self._connection().execute('SELECT * FROM events WHERE id > ? ORDER BY id',
+                                              (last_id,)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Event replay error: {str(e)}")
+            return []
+        return [_row_event(row) for row in rows if row['channel'] in channels]
+
+    def _dispatch(self) -> None:
+        conn = db.connect()
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+        while True:
+            self._wake.wait(EVENTS_POLL_INTERVAL)
+            self._wake.clear()
+            try:
+                rows = conn.execute('SELECT * FROM events WHERE id > ? ORDER BY id LIMIT 500',
+                                    (last_id,)).fetchall()
+            except sqlite3.Error as e:
+                print(f"Event dispatcher error: {str(e)}")
+                continue
+            for row in rows:
+                last_id = row['id']
+                self._deliver(_row_event(row))
+
+
+def _row_event(row: sqlite3.Row) -> Event:
+    return Event(row['id'], row['channel'], row['event'], json.loads(row['data']))
+
+
+class Bus:
+    """Routes published events to this process's subscriptions by channel"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self._started = False
+        self._counters: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def publish(self, channels: Iterable[str], event: str, data: Dict) -> None:
+        channels = list(channels)
+        if channels:
+            self.backend.publish(channels, event, data)
+            with self._lock:
+                self._counters['published'] += len(channels)
+
+    def subscribe(self, channels: Iterable[str], last_event_id: Optional[int] = None) -> Subscription:
+        """
+        Open a subscription; events after last_event_id (when the client reconnects
+        with one) that are still retained are queued first.
+        """
+        subscription = Subscription(self, set(channels))
+        with self._lock:
+            if not self._started:
+                self.backend.start(self.deliver)
+                self._started = True
+            # Replay before live delivery can reach the subscription, so events stay in order
+            if last_event_id is not None:
+                for event in self.backend.since(subscription.channels, last_event_id):
+                    subscription.put(event)
+            for channel in subscription.channels:
+                self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[channel]
+            self._counters['dropped'] += subscription.dropped
+
+    def deliver(self, event: Event) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers.get(event.channel, ()))
+            self._counters['delivered'] += len(subscribers)
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            streams = len({s for subscribers in self._subscribers.values() for s in subscribers})
+            return {'backend': type(self.backend).__name__, 'open_streams': streams, **self._counters}
+
+
+_bus: Optional[Bus] = None
+_bus_pid: Optional[int] = None
+_bus_lock = threading.Lock()
+
+
+def get_bus() -> Bus:
+    """This process's bus, with the backend chosen by EVENTS_BACKEND"""
+    global _bus, _bus_pid
+    pid = os.getpid()
+    if _bus is None or _bus_pid != pid:
+        with _bus_lock:
+            if _bus is None or _bus_pid != pid:
+                _bus = Bus(MemoryBackend() if EVENTS_BACKEND == 'memory' else SQLiteBackend())
+                _bus_pid = pid
+    return _bus
+
+
+def publish(channels: Iterable[str], event: str, data: Dict) -> None:
+    get_bus().publish(channels, event, data)
+
+
+def subscribe(channels: Iterable[str], last_event_id: Optional[int] = None) -> Subscription:
+    return get_bus().subscribe(channels, last_event_id)
+
+
+_open_streams = 0
+_streams_lock = threading.Lock()
+
+
+def acquire_stream() -> bool:
+    """Take one of this process's EVENTS_MAX_STREAMS stream slots; False when all are taken"""
+    global _open_streams
+    with _streams_lock:
+        if _open_streams >= EVENTS_MAX_STREAMS:
+            return False
+        _open_streams += 1
+        return True
+
+
+def release_stream() -> None:
+    global _open_streams
+    with _streams_lock:
+        _open_streams = max(0, _open_streams - 1)
+
+
+def stats() -> Dict:
+    return {**get_bus().stats(), 'max_streams': EVENTS_MAX_STREAMS}
@@ -0,0 +1,90 @@
+"""
+Feed API for ChirpX
+JSON pages of hydrated chirps for the /api/v1 feed endpoints. Clients pick
+the fields they need with ?fields= (sparse fieldsets); fields that are not
+asked for are neither loaded nor serialized. Pages are encoded in one pass
+with a compact, reused JSON encoder.
+"""
+
+import json
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+DEFAULT_FIELDS = ('id', 'content', 'created_at', 'author', 'like_count', 'comment_count', 'retweet_count',
+                  'media', 'liked', 'retweeted', 'bookmarked')
+
+# Fields that need the viewer's likes, retweets and bookmarks, or the chirp's media
+VIEWER_FIELDS = frozenset({'liked', 'retweeted', 'bookmarked'})
+MEDIA_FIELDS = frozenset({'media'})
+
+_encoder = json.JSONEncoder(ensure_ascii=False, check_circular=False, separators=(',', ':'))
+
+
+class FieldError(ValueError):
+    """?fields= named fields the API does not have"""
+
+
+def _author(chirp: Dict, media_url: Callable[[str], str]) -> Dict:
+    return {
+        'id': chirp['user_id'],
+        'username': chirp['username'],
+        'full_name': chirp['full_name'],
+        'profile_picture_url': media_url(chirp['profile_picture']) if chirp['profile_picture'] else None,
+    }
+
+
+def _media(chirp: Dict, media_url: Callable[[str], str]) -> List[Dict]:
+    return [{'type': m['media_type'], 'url': media_url(m['media_url']), 'width': m['width'], 'height': m['height']}
+            for m in chirp['media']]
+
+
+# Field name -> getter(chirp, media_url)
+FIELDS: Dict[str, Callable[[Dict, Callable[[str], str]], object]] = {
+    'id': lambda chirp, _: chirp['id'],
+    'content': lambda chirp, _: chirp['content'],
+    'created_at': lambda chirp, _: chirp['created_at'],
+    'author': _author,
+    'like_count': lambda chirp, _: chirp['like_count'],
+    'comment_count': lambda chirp, _: chirp['comment_count'],
+    'retweet_count': lambda chirp, _: chirp['retweet_count'],
+    'media': _media,
+    'liked': lambda chirp, _: chirp['user_liked'],
+    'retweeted': lambda chirp, _: chirp['user_retweeted'],
+    'bookmarked': lambda chirp, _: chirp['is_bookmarked'],
+    'bookmarked_at': lambda chirp, _: chirp.get('bookmarked_at'),
+}
+
+
+def parse_fields(requested: Optional[str]) -> Tuple[str, ...]:
+    """
+    Resolve a ?fields=id,content,... value to field names, in the order asked
+    for; all DEFAULT_FIELDS when missing. Raises FieldError for unknown names.
+    """
+    if not requested:
+        return DEFAULT_FIELDS
+    fields = tuple(dict.fromkeys(name.strip() for name in requested.split(',') if name.strip()))
+    unknown = [name for name in fields if name not in FIELDS]
+    if unknown:
+        raise FieldError(f"Unknown fields: {', '.join(unknown)}")
+    return fields or DEFAULT_FIELDS
+
+
+def needs_viewer(fields: Iterable[str]) -> bool:
+    return not VIEWER_FIELDS.isdisjoint(fields)
+
+
+def needs_media(fields: Iterable[str]) -> bool:
+    return not MEDIA_FIELDS.isdisjoint(fields)
+
+
+def serialize_page(chirps: Sequence[Dict], fields: Sequence[str], next_cursor: Optional[str],
+                   next_url: Optional[str], media_url: Callable[[str], str]) -> str:
+    """
+    The JSON body of one page:
+    {"chirps": [{field: value}], "next_cursor": str|null, "next_url": str|null}
+    """
+    getters = [(name, FIELDS[name]) for name in fields]
+    return _encoder.encode({
+        'chirps': [{name: get(chirp, media_url) for name, get in getters} for chirp in chirps],
+        'next_cursor': next_cursor,
+        'next_url': next_url,
+    })
@@ -0,0 +1,226 @@
+"""
+Feed Helpers for ChirpX
+Keyset (cursor) pagination and batched chirp hydration shared by the
+timeline, explore, profile, search and bookmarks feeds
+"""
+
+import base64
+import json
+import os
+import sqlite3
+from typing import Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_PAGE_SIZE = int(os.getenv('FEED_PAGE_SIZE', '20'))
+MAX_PAGE_SIZE = int(os.getenv('FEED_MAX_PAGE_SIZE', '100'))
+
+
+def encode_cursor(created_at: str, row_id: int) -> str:
+    """Pack a (created_at, id) sort key into an opaque URL-safe token"""
+    raw = json.dumps([created_at, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[str, int]]:
+    """
+    Unpack a token produced by encode_cursor.
+    Returns None for a missing or malformed cursor, which means "first page".
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        if not isinstance(created_at, str) or not isinstance(row_id, int):
+            return None
+        return created_at, row_id
+    except (ValueError, TypeError):
+        return None
+
+
+def encode_rank_cursor(rank: float, row_id: int, seen: int) -> str:
+    """Pack a (rank, id) sort key and the number of results already shown (search pages)"""
+    raw = json.dumps([rank, row_id, seen], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_rank_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int, int]]:
+    """Unpack a token produced by encode_rank_cursor. Returns None for a missing or malformed cursor."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        rank, row_id, seen = json.loads(raw)
+        if not isinstance(rank, (int, float)) or not isinstance(row_id, int) or not isinstance(seen, int):
+            return None
+        return float(rank), row_id, seen
+    except (ValueError, TypeError):
+        return None
+
+
+def page_size(requested: Optional[str] = None) -> int:
+    """Resolve a ?limit= value to a page size within [1, MAX_PAGE_SIZE]"""
+    try:
+        size = int(requested) if requested else DEFAULT_PAGE_SIZE
+    except ValueError:
+        size = DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def keyset_clause(cursor: Optional[Tuple[str, int]], created_col: str, id_col: str) -> Tuple[str, tuple]:
+    """
+    Build the "(created_at, id) < (?, ?)" seek predicate for a cursor.
+    Returns an always-true predicate for the first page.
+    """
+    if cursor is None:
+        return '1', ()
+    return f'({created_col}, {id_col}) < (?, ?)', cursor
+
+
+def split_page(rows: Sequence, limit: int, created_key: str = 'created_at',
+               id_key: str = 'id') -> Tuple[List, Optional[str]]:
+    """
+    Trim a result fetched with LIMIT limit + 1 to one page.
+    Returns the page rows and the cursor for the next page (None on the last page).
+    """
+    rows = list(rows)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last[created_key], last[id_key])
+
+
+def timeline_page(conn: sqlite3.Connection, user_id: int, cursor: Optional[Tuple[str, int]],
+                  limit: int) -> Tuple[List, Optional[str]]:
+    """One page of a user's materialized home timeline (followed users and self)"""
+    seek, seek_params = keyset_clause(cursor, 'h.created_at', 'h.chirp_id')
+    rows = conn.execute(f'''
+        SELECT c.*
+        FROM home_timeline h
+        JOIN chirps c ON c.id = h.chirp_id
+        WHERE h.user_id = ? AND {seek}
+        ORDER BY h.created_at DESC, h.chirp_id DESC
+        LIMIT ?
+    ''', (user_id, *seek_params, limit + 1)).fetchall()
+    return split_page(rows, limit)
+
+
+def explore_page(conn: sqlite3.Connection, cursor: Optional[Tuple[str, int]],
+                 limit: int) -> Tuple[List, Optional[str]]:
+    """One page of all chirps, newest first"""
+    seek, seek_params = keyset_clause(cursor, 'c.created_at', 'c.id')
+    rows = conn.execute(f'''
+        SELECT c.*
+        FROM chirps c
+        WHERE {seek}
+        ORDER BY c.created_at DESC, c.id DESC
+        LIMIT ?
+    ''', (*seek_params, limit + 1)).fetchall()
+    return split_page(rows, limit)
+
+
+def user_page(conn: sqlite3.Connection, user_id: int, cursor: Optional[Tuple[str, int]],
+              limit: int) -> Tuple[List, Optional[str]]:
+    """One page of a user's own chirps, newest first"""
+    seek, seek_params = keyset_clause(cursor, 'c.created_at', 'c.id')
+    rows = conn.execute(f'''
+        SELECT c.*
+        FROM chirps c
+        WHERE c.user_id = ? AND {seek}
+        ORDER BY c.created_at DESC, c.id DESC
+        LIMIT ?
+    ''', (user_id, *seek_params, limit + 1)).fetchall()
+    return split_page(rows, limit)
+
+
+def bookmarks_page(conn: sqlite3.Connection, user_id: int, cursor: Optional[Tuple[str, int]],
+                   limit: int) -> Tuple[List, Optional[str]]:
+    """One page of a user's bookmarked chirps, most recently saved first"""
+    seek, seek_params = keyset_clause(cursor, 'b.created_at', 'b.id')
+    rows = conn.execute(f'''
+        SELECT c.*, b.id as bookmark_id, b.created_at as bookmarked_at
+        FROM bookmarks b
+        JOIN chirps c ON c.id = b.chirp_id
+        WHERE b.user_id = ? AND {seek}
+        ORDER BY b.created_at DESC, b.id DESC
+        LIMIT ?
+    ''', (user_id, *seek_params, limit + 1)).fetchall()
+    return split_page(rows, limit, 'bookmarked_at', 'bookmark_id')
+
+
+def _placeholders(values: Sequence) -> str:
+    return ', '.join('?' * len(values))
+
+
+def hydrate_chirps(conn: sqlite3.Connection, rows: Sequence, viewer_id: Optional[int],
+                   with_media: bool = True) -> List[Dict]:
+    """
+    Attach author, engagement counts, media and viewer state to a page of chirp rows.
+    Each relation is loaded with a single IN (...) query, so the cost is a fixed
+    number of queries no matter how many chirps are on the page.
+    rows must provide at least 'id' and 'user_id'; returns one dict per row, in order.
+    Callers that do not show media or viewer state skip their queries with
+    with_media=False and viewer_id=None.
+    """
+    chirps = [dict(row) for row in rows]
+    if not chirps:
+        return chirps
+
+    chirp_ids = [chirp['id'] for chirp in chirps]
+    author_ids = list({chirp['user_id'] for chirp in chirps})
+    in_chirps = _placeholders(chirp_ids)
+
+    authors = {
+        row['id']: row for row in conn.execute(
+            f'SELECT id, username, full_name, profile_picture, profile_picture_variants FROM users '
+            f'WHERE id IN ({_placeholders(author_ids)})',
+            author_ids)
+    }
+
+    stats = {
+        row['chirp_id']: row for row in conn.execute(
+            f'SELECT chirp_id, like_count, comment_count, retweet_count FROM chirp_stats WHERE chirp_id IN ({in_chirps})',
+            chirp_ids)
+    }
+
+    media: Dict[int, List[Dict]] = {}
+    if with_media:
+        for row in conn.execute(
+                f'SELECT * FROM chirp_media WHERE chirp_id IN ({in_chirps}) ORDER BY chirp_id, display_order',
+                chirp_ids):
+            media.setdefault(row['chirp_id'], []).append(dict(row))
+
+    def viewer_set(table: str) -> set:
+        if viewer_id is None:
+            return set()
+        return {
+            row['chirp_id'] for row in conn.execute(
+                f'SELECT chirp_id FROM {table} WHERE user_id = ? AND chirp_id IN ({in_chirps})',
+                (viewer_id, *chirp_ids))
+        }
+
+    liked = viewer_set('likes')
+    retweeted = viewer_set('retweets')
+    bookmarked = viewer_set('bookmarks')
+
+    # Chirps whose author no longer exists are dropped, matching the old JOIN users
+    chirps = [chirp for chirp in chirps if chirp['user_id'] in authors]
+
+    for chirp in chirps:
+        author = authors[chirp['user_id']]
+        chirp['username'] = author['username']
+        chirp['full_name'] = author['full_name']
+        chirp['profile_picture'] = author['profile_picture']
+        chirp['profile_picture_variants'] = author['profile_picture_variants']
+
+        chirp_stats = stats.get(chirp['id'])
+        chirp['like_count'] = chirp_stats['like_count'] if chirp_stats else 0
+        chirp['comment_count'] = chirp_stats['comment_count'] if chirp_stats else 0
+        chirp['retweet_count'] = chirp_stats['retweet_count'] if chirp_stats else 0
+
+        chirp['media'] = media.get(chirp['id'], [])
+        chirp['user_liked'] = chirp['id'] in liked
+        chirp['user_retweeted'] = chirp['id'] in retweeted
+        chirp['is_bookmarked'] = chirp['id'] in bookmarked
+
+    return chirps
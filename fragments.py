@@ -0,0 +1,159 @@
+"""
+Chirp Card Fragments for ChirpX
+Rendered chirp cards are cached as HTML, keyed by page variant, chirp id and
+a version made of everything the card shows that can change (counts, author
+name and avatar, media files), so a stale card is never served. Whether the
+viewer liked, retweeted, bookmarked or wrote the chirp is left in the cached
+HTML as markers that are filled in per request with one regex pass.
+"""
+
+import os
+import re
+import secrets
+import threading
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Set, Tuple
+
+from markupsafe import Markup, escape
+
+# Settings (override through environment variables)
+FRAGMENT_CACHE_ENABLED = os.getenv('FRAGMENT_CACHE_ENABLED', '1') == '1'
+FRAGMENT_CACHE_ENTRIES = int(os.getenv('FRAGMENT_CACHE_ENTRIES', '5000'))
+
+# Per-viewer flags a card may toggle on; is_owner is derived from the chirp's author
+VIEWER_FLAGS = ('user_liked', 'user_retweeted', 'is_bookmarked', 'is_owner')
+
+# \x00<nonce>:flag\x01shown when set\x02shown otherwise\x00; the per-process nonce keeps
+# anything a user typed into a chirp from passing for a marker
+_NONCE = secrets.token_hex(8)
+_MARKER_RE = re.compile(rf'\x00{_NONCE}:(\w+)\x01(.*?)\x02(.*?)\x00', re.DOTALL)
+
+Key = Tuple[str, int, Hashable]
+
+
+class FragmentCache:
+    """LRU of rendered cards that can also drop every card of one chirp or one author"""
+
+    def __init__(self, max_entries: int = FRAGMENT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Key, Tuple[int, str]]' = OrderedDict()
+        self._by_chirp: Dict[int, Set[Key]] = {}
+        self._by_author: Dict[int, Set[int]] = {}
+        self._counters: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def get(self, key: Key) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[1]
+
+    def set(self, key: Key, author_id: int, html: str) -> None:
+        with self._lock:
+            self._entries[key] = (author_id, html)
+            self._entries.move_to_end(key)
+            self._by_chirp.setdefault(key[1], set()).add(key)
+            self._by_author.setdefault(author_id, set()).add(key[1])
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._counters['evictions'] += 1
+
+    def _remove(self, key: Key) -> None:
+        """Drop an entry and its index references (caller holds the lock)"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        chirp_id = key[1]
+        keys = self._by_chirp.get(chirp_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_chirp[chirp_id]
+                chirps = self._by_author.get(entry[0])
+                if chirps is not None:
+                    chirps.discard(chirp_id)
+                    if not chirps:
+                        del self._by_author[entry[0]]
+
+    def invalidate_chirp(self, chirp_id: int) -> None:
+        with self._lock:
+            for key in list(self._by_chirp.get(chirp_id, ())):
+                self._remove(key)
+
+    def invalidate_author(self, author_id: int) -> None:
+        with self._lock:
+            for chirp_id in list(self._by_author.get(author_id, ())):
+                for key in list(self._by_chirp.get(chirp_id, ())):
+                    self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_chirp.clear()
+            self._by_author.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._entries), **self._counters}
+
+
+_cache = FragmentCache()
+
+
+def version(chirp: Dict) -> Hashable:
+    """
+    Everything a card shows that can change after the chirp is posted, media
+    and avatar files included: migrate-media moves them to new paths in
+    another process and deletes the old files
+    """
+    media = tuple((m['media_url'], m['variants']) for m in chirp.get('media') or ())
+    return (chirp['like_count'], chirp['comment_count'], chirp['retweet_count'],
+            chirp['username'], chirp['full_name'], chirp['profile_picture'], chirp.get('profile_picture_variants'),
+            media, chirp.get('snippet'))
+
+
+def toggle(flag: str, on: str = '', off: str = '') -> Markup:
+    """Marker for markup that depends on a viewer flag; filled in by overlay()"""
+    if flag not in VIEWER_FLAGS:
+        raise ValueError(f'Unknown viewer flag: {flag}')
+    return Markup(f'\x00{_NONCE}:{flag}\x01{escape(on)}\x02{escape(off)}\x00')
+
+
+def overlay(html: str, chirp: Dict, viewer_id: Optional[int]) -> Markup:
+    """Fill a cached card's markers in for one viewer"""
+    flags = {flag: bool(chirp.get(flag)) for flag in VIEWER_FLAGS}
+    flags['is_owner'] = viewer_id is not None and chirp['user_id'] == viewer_id
+    return Markup(_MARKER_RE.sub(lambda m: m.group(2) if flags[m.group(1)] else m.group(3), html))
+
+
+def render(chirp: Dict, variant: str, render_card: Callable[[], str], viewer_id: Optional[int]) -> Markup:
+    """
+    The card for chirp in a page variant ('timeline', 'search', ...): from the
+    cache, or rendered by render_card and cached. Viewer markers are filled in.
+    """
+    if not FRAGMENT_CACHE_ENABLED:
+        return overlay(str(render_card()), chirp, viewer_id)
+    key = (variant, chirp['id'], version(chirp))
+    html = _cache.get(key)
+    if html is None:
+        html = str(render_card())
+        _cache.set(key, chirp['user_id'], html)
+    return overlay(html, chirp, viewer_id)
+
+
+def invalidate_chirp(chirp_id: int) -> None:
+    """Drop a chirp's cached cards (its counts changed or it was deleted)"""
+    _cache.invalidate_chirp(chirp_id)
+
+
+def invalidate_author(user_id: int) -> None:
+    """Drop the cached cards of every chirp by a user whose profile changed"""
+    _cache.invalidate_author(user_id)
+
+
+def stats() -> Dict[str, int]:
+    return _cache.stats()
@@ -0,0 +1,310 @@
+"""
+Resilient Groq Calls for ChirpX
+Rate limiting, bounded concurrency, retries with backoff, per-call deadlines
+and a circuit breaker around every request AIService makes to Groq
+"""
+
+import os
+import random
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Iterable, Iterator, Optional, TypeVar
+
+# Settings (override through environment variables)
+GROQ_RATE_PER_SECOND = float(os.getenv('GROQ_RATE_PER_SECOND', '5'))
+GROQ_BURST = int(os.getenv('GROQ_BURST', '10'))
+GROQ_MAX_CONCURRENCY = int(os.getenv('GROQ_MAX_CONCURRENCY', '4'))
+GROQ_MAX_RETRIES = int(os.getenv('GROQ_MAX_RETRIES', '3'))
+GROQ_RETRY_BASE_DELAY = float(os.getenv('GROQ_RETRY_BASE_DELAY', '0.5'))
+GROQ_RETRY_MAX_DELAY = float(os.getenv('GROQ_RETRY_MAX_DELAY', '4.0'))
+# Total time budget for one call, including queueing and retries
+GROQ_CALL_DEADLINE = float(os.getenv('GROQ_CALL_DEADLINE', '10.0'))
+# Total time budget for a streamed call, from the request to the last chunk
+GROQ_STREAM_DEADLINE = float(os.getenv('GROQ_STREAM_DEADLINE', '30.0'))
+GROQ_BREAKER_FAILURES = int(os.getenv('GROQ_BREAKER_FAILURES', '5'))
+GROQ_BREAKER_RESET_SECONDS = float(os.getenv('GROQ_BREAKER_RESET_SECONDS', '30.0'))
+
+T = TypeVar('T')
+
+
+class Unavailable(Exception):
+    """Groq was not called or did not answer in time; callers use their fallback"""
+
+
+class TokenBucket:
+    """Allows `rate` calls per second on average with bursts of up to `capacity`"""
+
+    def __init__(self, rate: float = GROQ_RATE_PER_SECOND, capacity: int = GROQ_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, deadline: float) -> bool:
+        """Take a token, waiting until deadline (monotonic time) at most"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures so calls fail fast, then lets
+    a single trial call through after `reset_seconds` (half-open). The trial's
+    outcome closes the breaker again or re-opens it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold: int = GROQ_BREAKER_FAILURES, reset_seconds: float = GROQ_BREAKER_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._trial_running or time.monotonic() - self._opened_at < self.reset_seconds:
+                return False
+            self._state = self.HALF_OPEN
+            self._trial_running = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def cancel_trial(self) -> None:
+        """Give back a call allowed through that never reached Groq, e.g. one held up locally"""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == self.HALF_OPEN or self._failures >= self.threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    status = getattr(error, 'status_code', None)
+    if status is None and getattr(error, 'response', None) is not None:
+        status = getattr(error.response, 'status_code', None)
+    return status
+
+
+def _is_retryable(error: Exception) -> bool:
+    """429s, 5xx responses, timeouts and connection errors are worth retrying"""
+    status = _status_code(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, (TimeoutError, ConnectionError)) or \
+        type(error).__name__ in ('APITimeoutError', 'APIConnectionError')
+
+
+def _is_timeout(error: Exception) -> bool:
+    return isinstance(error, TimeoutError) or type(error).__name__ in ('APITimeoutError', 'ReadTimeout',
+                                                                     'ConnectTimeout', 'TimeoutException')
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait, if it said"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class ResilientCaller:
+    """Runs Groq requests through the rate limiter, concurrency cap, retries and breaker"""
+
+    def __init__(self):
+        self.bucket = TokenBucket()
+        self.breaker = CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(GROQ_MAX_CONCURRENCY)
+        self._in_flight = 0
+        self._counters: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += n
+
+    def call(self, fn: Callable[[float], T], deadline_seconds: float = GROQ_CALL_DEADLINE) -> T:
+        """
+        Call fn(timeout) until it succeeds, giving it the time left before the deadline.
+        Raises Unavailable when the breaker is open, no rate/concurrency slot frees up
+        in time, or retries run out; errors that are not worth retrying propagate.
+        """
+        return self._run(fn, deadline_seconds)
+
+    def stream(self, fn: Callable[[float], Iterable[T]], deadline_seconds: float = GROQ_STREAM_DEADLINE) -> Iterator[T]:
+        """
+        Open a streaming request the way call() does, then yield its chunks while
+        keeping the concurrency slot. The whole stream must finish within the
+        deadline: a stalled read is bounded by the timeout fn passes to Groq, and a
+        stream still going when the deadline passes is closed and raises Unavailable.
+        Errors after the stream has started are not retried.
+        """
+        deadline = time.monotonic() + deadline_seconds
+        chunks = self._run(fn, deadline_seconds, keep_slot=True)
+        try:
+            for chunk in chunks:
+                if time.monotonic() > deadline:
+                    self._count('stream_timeouts')
+                    raise Unavailable('Groq stream did not finish before its deadline')
+                yield chunk
+        except Exception:
+            self.breaker.record_failure()
+            self._count('stream_errors')
+            raise
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+            self._release_slot()
+
+    def _release_slot(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _run(self, fn: Callable[[float], T], deadline_seconds: float, keep_slot: bool = False) -> T:
+        deadline = time.monotonic() + deadline_seconds
+        self._count('calls')
+
+        if not self.breaker.allow():
+            self._count('breaker_rejected')
+            raise Unavailable('Groq circuit breaker is open')
+
+        attempt = 0
+        while True:
+            # Waiting on our own limits says nothing about Groq's health, so
+            # only upstream errors and timeouts count against the breaker
+            if not self.bucket.acquire(deadline):
+                self._count('rate_limited')
+                self.breaker.cancel_trial()
+                raise Unavailable('Timed out waiting for the Groq rate limiter')
+            if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                self._count('concurrency_rejected')
+                self.breaker.cancel_trial()
+                raise Unavailable('Timed out waiting for a free Groq slot')
+
+            with self._lock:
+                self._in_flight += 1
+            release = True
+            try:
+                result = fn(max(0.1, deadline - time.monotonic()))
+                self.breaker.record_success()
+                self._count('successes')
+                release = not keep_slot
+                return result
+            except Exception as e:
+                if not _is_retryable(e):
+                    # The request itself was bad; Groq is healthy
+                    self.breaker.record_success()
+                    self._count('errors')
+                    raise
+                error = e
+            finally:
+                if release:
+                    self._release_slot()
+
+            if _status_code(error) == 429:
+                self._count('throttled')
+            elif _is_timeout(error):
+                self._count('timeouts')
+            elif _status_code(error) is None:
+                self._count('connection_errors')
+            else:
+                self._count('server_errors')
+
+            attempt += 1
+            delay = _retry_after(error) or random.uniform(
+                0, min(GROQ_RETRY_MAX_DELAY, GROQ_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+            if attempt > GROQ_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                self.breaker.record_failure()
+                self._count('failures')
+                raise Unavailable(f'Groq request failed after {attempt} attempts: {type(error).__name__}: {error}') from error
+            self._count('retries')
+            time.sleep(delay)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counters = dict(self._counters)
+            in_flight = self._in_flight
+        return {
+            'breaker_state': self.breaker.state,
+            'in_flight': in_flight,
+            'max_concurrency': GROQ_MAX_CONCURRENCY,
+            'tokens_available': round(self.bucket.tokens, 2),
+            **counters,
+        }
+
+
+_caller: Optional[ResilientCaller] = None
+_caller_pid: Optional[int] = None
+_caller_lock = threading.Lock()
+
+
+def get_caller() -> ResilientCaller:
+    """The limits are per process, shared by all of its threads"""
+    global _caller, _caller_pid
+    pid = os.getpid()
+    if _caller is None or _caller_pid != pid:
+        with _caller_lock:
+            if _caller is None or _caller_pid != pid:
+                _caller = ResilientCaller()
+                _caller_pid = pid
+    return _caller
+
+
+def call(fn: Callable[[float], T], deadline_seconds: float = GROQ_CALL_DEADLINE) -> T:
+    return get_caller().call(fn, deadline_seconds)
+
+
+def stream(fn: Callable[[float], Iterable[T]], deadline_seconds: float = GROQ_STREAM_DEADLINE) -> Iterator[T]:
+    return get_caller().stream(fn, deadline_seconds)
+
+
+def stats() -> Dict:
+    return get_caller().stats()
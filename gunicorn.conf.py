@@ -0,0 +1,22 @@
+"""
+Gunicorn Settings for ChirpX
+Picked up automatically by `gunicorn app:app`. The web process uses gthread
+workers, which serve each request on a thread so SQLite waits block only that
+request. /events/stream is meant for the Procfile's `events` process, which
+runs the same app on gevent workers (GUNICORN_WORKER_CLASS=gevent) where an
+open stream costs a greenlet instead of a thread; the stream closes its
+database connection before it starts waiting. Where /events/ is not routed to
+that process, EVENTS_MAX_STREAMS caps how many threads streams take per worker.
+"""
+
+import os
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+# Simultaneous connections per gevent worker, event streams included
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+# Threads per gthread worker; every open event stream occupies one
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '10'))
+keepalive = 5
@@ -0,0 +1,182 @@
+"""
+AI Image Generation for ChirpX
+Images are generated by Pollinations.ai in a background job, never in the
+request: the endpoint records the prompt and returns, the job streams the
+image to disk over a pooled HTTP session, and the client polls for the
+result. Results are kept per prompt, so a repeated prompt is answered at once.
+"""
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import media_store
+
+# Settings (override through environment variables)
+# Point at pollinations_stub.py (e.g. http://127.0.0.1:8765) to work without the real service
+POLLINATIONS_BASE_URL = os.getenv('POLLINATIONS_BASE_URL', 'https://image.pollinations.ai')
+IMAGE_GEN_SIZE = int(os.getenv('IMAGE_GEN_SIZE', '1024'))
+IMAGE_GEN_CONNECT_TIMEOUT = float(os.getenv('IMAGE_GEN_CONNECT_TIMEOUT', '5'))
+IMAGE_GEN_TIMEOUT = float(os.getenv('IMAGE_GEN_TIMEOUT', '60'))  # per read; generation happens before the first byte
+IMAGE_GEN_MAX_BYTES = int(os.getenv('IMAGE_GEN_MAX_BYTES', str(20 * 1024 * 1024)))
+IMAGE_GEN_POOL_SIZE = int(os.getenv('IMAGE_GEN_POOL_SIZE', '4'))
+IMAGE_GEN_MAX_PROMPT = 500
+GENERATED_DIR = os.path.join(media_store.MEDIA_DIR, 'generated')
+
+# Statuses
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+_EXTENSIONS = {'image/jpeg': 'jpg', 'image/png': 'png', 'image/webp': 'webp', 'image/gif': 'gif'}
+
+
+class GenerationError(Exception):
+    """Pollinations did not return a usable image"""
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        # Timeouts, dropped connections and 5xx/429 responses may succeed on another try
+        self.retryable = retryable
+
+
+def normalize_prompt(prompt: str) -> str:
+    return ' '.join(prompt.split())[:IMAGE_GEN_MAX_PROMPT]
+
+
+def prompt_hash(prompt: str) -> str:
+    """Cache key: prompts differing only in case or spacing share an image"""
+    raw = f'{IMAGE_GEN_SIZE}x{IMAGE_GEN_SIZE}\n{normalize_prompt(prompt).lower()}'
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """This process's session; keeps connections to Pollinations open between jobs"""
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=IMAGE_GEN_POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session, _session_pid = session, pid
+    return _session
+
+
+def download(prompt: str, key: str) -> str:
+    """
+    Generate the image for prompt and write it to GENERATED_DIR/<key>.<ext>,
+    streaming it to a temporary file first so a failed download leaves nothing
+    behind. Returns the path relative to MEDIA_ROOT.
+    Raises GenerationError, marked retryable when another try may succeed.
+    """
+    url = f"{POLLINATIONS_BASE_URL.rstrip('/')}/prompt/{urllib.parse.quote(prompt, safe='')}"
+    params = {'width': IMAGE_GEN_SIZE, 'height': IMAGE_GEN_SIZE, 'nologo': 'true'}
+    directory = os.path.join(media_store.MEDIA_ROOT, GENERATED_DIR)
+    os.makedirs(directory, exist_ok=True)
+
+    try:
+        with get_session().get(url, params=params, stream=True,
+                               timeout=(IMAGE_GEN_CONNECT_TIMEOUT, IMAGE_GEN_TIMEOUT)) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+            ext = _EXTENSIONS.get(content_type)
+            if ext is None:
+                raise GenerationError(f'Unexpected response type: {content_type or "none"}')
+
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.')
+            try:
+                size = 0
+                with os.fdopen(fd, 'wb') as out:
+                    for chunk in response.iter_content(media_store.MEDIA_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > IMAGE_GEN_MAX_BYTES:
+                            raise GenerationError('Generated image is too large')
+                        out.write(chunk)
+                if size == 0:
+                    raise GenerationError('Empty response')
+                path = os.path.join(GENERATED_DIR, f'{key}.{ext}')
+                os.replace(tmp_path, os.path.join(media_store.MEDIA_ROOT, path))
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else 0
+        raise GenerationError(str(e), retryable=status >= 500 or status == 429) from e
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise GenerationError(str(e), retryable=True) from e
+    except requests.RequestException as e:
+        raise GenerationError(str(e)) from e
+    return path
+
+
+def _present(row: Optional[sqlite3.Row]) -> bool:
+    return bool(row and row['path'] and os.path.exists(os.path.join(media_store.MEDIA_ROOT, row['path'])))
+
+
+def get(conn: sqlite3.Connection, key: str) -> Optional[sqlite3.Row]:
+    return conn.execute('SELECT * FROM generated_images WHERE prompt_hash = ?', (key,)).fetchone()
+
+
+def request(conn: sqlite3.Connection, prompt: str, user_id: int) -> Dict:
+    """
+    Look up or start the generation for prompt. Returns {'key', 'status', 'path'};
+    status is 'done' for an image generated before. Otherwise it is 'pending'
+    and the caller queues a 'generate_image' job keyed by key, which the job
+    queue ignores while the same prompt is already being generated.
+    """
+    key = prompt_hash(prompt)
+    row = get(conn, key)
+    if row and row['status'] == DONE and _present(row):
+        return {'key': key, 'status': DONE, 'path': row['path']}
+    if not (row and row['status'] == PENDING):
+        conn.execute('''
+            INSERT INTO generated_images (prompt_hash, prompt, status, path, error, requested_by, updated_at)
+            VALUES (?, ?, ?, NULL, NULL, ?, ?)
+            ON CONFLICT(prompt_hash) DO UPDATE SET
+                status = excluded.status, path = NULL, error = NULL,
+                requested_by = excluded.requested_by, updated_at = excluded.updated_at
+        ''', (key, normalize_prompt(prompt), PENDING, user_id, time.time()))
+    return {'key': key, 'status': PENDING, 'path': None}
+
+
+def generate(conn: sqlite3.Connection, key: str) -> None:
+    """
+    Run a pending generation and record its outcome. Retryable errors are
+    raised so the job queue tries again (the last failure is recorded by
+    fail()); any other failure is recorded at once.
+    """
+    row = get(conn, key)
+    if row is None or row['status'] != PENDING:
+        return
+    try:
+        path = download(row['prompt'], key)
+    except GenerationError as e:
+        print(f"Image generation error: {str(e)}")
+        if e.retryable:
+            raise
+        fail(conn, key, str(e))
+        return
+    conn.execute('UPDATE generated_images SET status = ?, path = ?, updated_at = ? WHERE prompt_hash = ?',
+                 (DONE, path, time.time(), key))
+
+
+def fail(conn: sqlite3.Connection, key: str, error: str) -> None:
+    """Record that a pending generation gave up, so the polling client stops waiting"""
+    conn.execute('UPDATE generated_images SET status = ?, error = ?, updated_at = ? '
+                 'WHERE prompt_hash = ? AND status = ?', (FAILED, error, time.time(), key, PENDING))
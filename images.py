@@ -0,0 +1,158 @@
+"""
+Image Pipeline for ChirpX
+Uploaded images are re-encoded in a process pool: oriented, stripped of EXIF
+and other metadata, and saved as responsive WebP and JPEG variants (square
+crops for avatars). Templates pick a variant through srcset.
+"""
+
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Settings (override through environment variables)
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))  # 0 processes images in the request thread
+IMAGE_TIMEOUT = float(os.getenv('IMAGE_TIMEOUT', '30'))
+IMAGE_WIDTHS = [int(w) for w in os.getenv('IMAGE_WIDTHS', '320,640,1080,1600').split(',')]
+AVATAR_SIZES = [int(s) for s in os.getenv('AVATAR_SIZES', '48,96,128,256').split(',')]
+IMAGE_WEBP_QUALITY = int(os.getenv('IMAGE_WEBP_QUALITY', '80'))
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '82'))
+# Larger images are rejected rather than decoded (decompression bombs)
+IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', str(40_000_000)))
+
+
+class InvalidImage(Exception):
+    """The upload is not an image Pillow can decode, or is too large to"""
+
+
+def _open(path: str) -> Image.Image:
+    Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+    try:
+        image = Image.open(path)
+        image.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise InvalidImage(str(e)) from e
+    return image
+
+
+def _flatten(image: Image.Image) -> Image.Image:
+    """RGB for JPEG, composited over white when the image has transparency"""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        rgba = image.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _save_variant(image: Image.Image, out_dir: str, name: str) -> Dict[str, str]:
+    # No exif/icc arguments are passed, so Pillow writes no metadata
+    webp = f'{name}.webp'
+    jpeg = f'{name}.jpg'
+    webp_image = image if image.mode in ('RGB', 'RGBA') else image.convert('RGBA')
+    webp_image.save(os.path.join(out_dir, webp), 'WEBP', quality=IMAGE_WEBP_QUALITY, method=4)
+    _flatten(image).save(os.path.join(out_dir, jpeg), 'JPEG', quality=IMAGE_JPEG_QUALITY,
+                         optimize=True, progressive=True)
+    return {'webp': webp, 'jpeg': jpeg}
+
+
+def process_image(src_path: str, out_dir: str, stem: str) -> Dict:
+    """
+    Re-encode a chirp image into width variants no wider than the original.
+    Runs in a pool process. Returns the oriented width and height, the file
+    to use when no variant fits ('fallback') and the variants, largest last;
+    file names are relative to out_dir. Animated images are kept as they are.
+    """
+    image = _open(src_path)
+    if getattr(image, 'is_animated', False):
+        return {'width': image.width, 'height': image.height, 'fallback': None, 'variants': []}
+
+    image = ImageOps.exif_transpose(image)
+    width, height = image.size
+    widths = sorted({w for w in IMAGE_WIDTHS if w < width} | {min(width, max(IMAGE_WIDTHS))})
+
+    variants = []
+    for target in widths:
+        resized = image if target == width else image.resize(
+            (target, max(1, round(height * target / width))), Image.LANCZOS)
+        variants.append({'width': target, **_save_variant(resized, out_dir, f'{stem}_{target}w')})
+    largest = variants[-1]['width']
+    return {
+        'width': largest,
+        'height': max(1, round(height * largest / width)),
+        'fallback': variants[-1]['jpeg'],
+        'variants': variants,
+    }
+
+
+def process_avatar(src_path: str, out_dir: str, stem: str) -> Dict:
+    """Center-cropped square variants in AVATAR_SIZES; same result shape as process_image"""
+    image = ImageOps.exif_transpose(_open(src_path))
+    side = min(image.size)
+    variants = []
+    for size in sorted(s for s in AVATAR_SIZES if s <= side) or [side]:
+        square = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        variants.append({'width': size, **_save_variant(square, out_dir, f'{stem}_{size}')})
+    return {
+        'width': variants[-1]['width'],
+        'height': variants[-1]['width'],
+        'fallback': variants[-1]['jpeg'],
+        'variants': variants,
+    }
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_pid: Optional[int] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """
+    This process's pool. Forked children only run Pillow, and unlike spawn or
+    forkserver they do not re-import the main module of whatever started the app.
+    """
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _executor_lock:
+            if _executor is None or _executor_pid != pid:
+                method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+                _executor = ProcessPoolExecutor(IMAGE_WORKERS, mp_context=multiprocessing.get_context(method))
+                _executor_pid = pid
+    return _executor
+
+
+def run(fn, *args) -> Dict:
+    """
+    Run process_image or process_avatar in the pool and wait for the result.
+    Raises InvalidImage for uploads that cannot be processed.
+    """
+    global _executor
+    if IMAGE_WORKERS <= 0:
+        return fn(*args)
+    try:
+        return _get_executor().submit(fn, *args).result(timeout=IMAGE_TIMEOUT)
+    except BrokenProcessPool:
+        # A pool process died (e.g. out of memory); start a fresh pool next time
+        with _executor_lock:
+            _executor = None
+        raise InvalidImage('Image processing failed')
+    except FutureTimeout:
+        raise InvalidImage('Image processing took too long')
+
+
+def parse_variants(variants) -> List[Dict]:
+    """Variants as stored in chirp_media.variants / users.profile_picture_variants"""
+    if not variants:
+        return []
+    if isinstance(variants, str):
+        try:
+            return json.loads(variants)
+        except ValueError:
+            return []
+    return variants
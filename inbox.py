@@ -0,0 +1,145 @@
+"""
+Direct Message Inbox for ChirpX
+One conversations row per participant and partner, holding the last message
+and the participant's unread count, so the inbox is a single indexed query.
+Threads are read by conversation key, newest page first.
+"""
+
+import os
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+# Characters of the last message kept for the inbox preview
+PREVIEW_LENGTH = 200
+DM_PAGE_SIZE = int(os.getenv('DM_PAGE_SIZE', '50'))
+
+# A conversation is keyed by its participants in a fixed order, whoever sent
+# the message; idx_messages_conversation indexes exactly these expressions
+_KEY_MATCH = 'min(m.sender_id, m.receiver_id) = ? AND max(m.sender_id, m.receiver_id) = ?'
+
+
+def conversation_key(user_id: int, other_user_id: int) -> Tuple[int, int]:
+    """The normalized (lower id, higher id) key of a two-person conversation"""
+    return min(user_id, other_user_id), max(user_id, other_user_id)
+
+
+def thread_page(conn: sqlite3.Connection, user_id: int, other_user_id: int,
+                before_id: Optional[int] = None, limit: int = DM_PAGE_SIZE) -> Tuple[List[Dict], bool]:
+    """
+    One page of a conversation going back in time from before_id (or from the newest message).
+    Returns the messages oldest first and whether older messages exist.
+    """
+    rows = conn.execute(f'''
+        SELECT m.*, u.username, u.profile_picture
+        FROM messages m
+        JOIN users u ON u.id = m.sender_id
+        WHERE {_KEY_MATCH} AND m.id < ?
+        ORDER BY m.id DESC
+        LIMIT ?
+    ''', (*conversation_key(user_id, other_user_id), before_id or 2 ** 63 - 1, limit + 1)).fetchall()
+    has_older = len(rows) > limit
+    return [dict(row) for row in reversed(rows[:limit])], has_older
+
+
+def messages_since(conn: sqlite3.Connection, user_id: int, other_user_id: int,
+                   since_id: int, limit: int = DM_PAGE_SIZE) -> List[Dict]:
+    """Messages of a conversation newer than since_id, oldest first"""
+    rows = conn.execute(f'''
+        SELECT m.*, u.username, u.profile_picture
+        FROM messages m
+        JOIN users u ON u.id = m.sender_id
+        WHERE {_KEY_MATCH} AND m.id > ?
+        ORDER BY m.id
+        LIMIT ?
+    ''', (*conversation_key(user_id, other_user_id), since_id, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def record_message(conn: sqlite3.Connection, message_id: int) -> None:
+    """
+    Update both participants' conversation rows for a newly inserted message.
+    Must run on the same connection (and transaction) as the message insert.
+    """
+    conn.execute('''
+        INSERT INTO conversations (user_id, other_user_id, last_message_id, last_sender_id,
+                                   last_message_preview, last_message_at, unread_count)
+        SELECT m.sender_id, m.receiver_id, m.id, m.sender_id, substr(m.content, 1, ?), m.created_at, 0
+        FROM messages m WHERE m.id = ?
+        UNION ALL
+        SELECT m.receiver_id, m.sender_id, m.id, m.sender_id, substr(m.content, 1, ?), m.created_at, 1
+        FROM messages m WHERE m.id = ? AND m.receiver_id != m.sender_id
+        ON CONFLICT(user_id, other_user_id) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_sender_id = excluded.last_sender_id,
+            last_message_preview = excluded.last_message_preview,
+            last_message_at = excluded.last_message_at,
+            unread_count = unread_count + excluded.unread_count
+        WHERE excluded.last_message_id > conversations.last_message_id
+    ''', (PREVIEW_LENGTH, message_id, PREVIEW_LENGTH, message_id))
+
+
+def mark_read(conn: sqlite3.Connection, user_id: int, other_user_id: int) -> None:
+    """Mark everything other_user_id sent to user_id as read"""
+    conn.execute('''
+        UPDATE messages SET read = 1
+        WHERE sender_id = ? AND receiver_id = ? AND read = 0
+    ''', (other_user_id, user_id))
+    conn.execute('''
+        UPDATE conversations SET unread_count = 0
+        WHERE user_id = ? AND other_user_id = ? AND unread_count != 0
+    ''', (user_id, other_user_id))
+
+
+def list_conversations(conn: sqlite3.Connection, user_id: int) -> List[Dict]:
+    """The user's conversations, most recent first, with the partner's profile"""
+    rows = conn.execute('''
+        SELECT u.username, u.full_name, u.profile_picture, u.profile_picture_variants,
+               c.last_message_preview AS last_message,
+               c.last_message_at AS last_message_time,
+               c.last_sender_id, c.unread_count
+        FROM conversations c
+        JOIN users u ON u.id = c.other_user_id
+        WHERE c.user_id = ?
+        ORDER BY c.last_message_at DESC, c.last_message_id DESC
+    ''', (user_id,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def rebuild_conversations(conn: sqlite3.Connection) -> int:
+    """
+    Recompute every conversation row from the messages table.
+    Returns the number of rows written.
+    """
+    conn.execute('DELETE FROM conversations')
+    cursor = conn.execute('''
+        WITH sides AS (
+            SELECT sender_id AS user_id, receiver_id AS other_user_id, id, 0 AS unread
+            FROM messages
+            UNION ALL
+            SELECT receiver_id, sender_id, id, read = 0
+            FROM messages WHERE receiver_id != sender_id
+        ),
+        latest AS (
+            SELECT user_id, other_user_id, MAX(id) AS last_id, SUM(unread) AS unread
+            FROM sides GROUP BY user_id, other_user_id
+        )
+        INSERT INTO conversations (user_id, other_user_id, last_message_id, last_sender_id,
+                                   last_message_preview, last_message_at, unread_count)
+        SELECT l.user_id, l.other_user_id, m.id, m.sender_id, substr(m.content, 1, ?), m.created_at, l.unread
+        FROM latest l
+        JOIN messages m ON m.id = l.last_id
+    ''', (PREVIEW_LENGTH,))
+    return cursor.rowcount
+
+
+def backfill_if_empty(conn: sqlite3.Connection) -> bool:
+    """
+    Populate conversations once for databases created before the table existed.
+    Returns True when a backfill was performed.
+    """
+    if conn.execute('SELECT 1 FROM conversations LIMIT 1').fetchone():
+        return False
+    if not conn.execute('SELECT 1 FROM messages LIMIT 1').fetchone():
+        return False
+    rebuild_conversations(conn)
+    return True
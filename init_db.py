@@ -1,14 +1,8 @@
-import sqlite3
+import db
 
 def init_database():
-    """Initialize the database with schema"""
-    conn = sqlite3.connect('chirpx.db')
-    
-    with open('schema.sql', 'r') as f:
-        conn.executescript(f.read())
-    
-    conn.commit()
-    conn.close()
+    """Create the database, or bring an existing one up to the current schema"""
+    db.initialize()
     print("Database initialized successfully!")
 
 if __name__ == '__main__':
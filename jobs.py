@@ -0,0 +1,254 @@
+"""
+Background Job Queue for ChirpX
+A durable SQLite-backed queue (the jobs table) drained by a pool of worker
+threads, either inside each web process or in a dedicated worker process
+"""
+
+import json
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Optional
+
+import db
+
+# Settings (override through environment variables)
+JOB_WORKER_THREADS = int(os.getenv('JOB_WORKER_THREADS', '2'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '2.0'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '5'))
+JOB_RETRY_BASE_DELAY = float(os.getenv('JOB_RETRY_BASE_DELAY', '5.0'))
+JOB_RETRY_MAX_DELAY = float(os.getenv('JOB_RETRY_MAX_DELAY', '600.0'))
+# A running job whose worker has been silent this long is assumed lost and re-claimed
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '300.0'))
+
+# Job statuses
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+DEAD = 'dead'  # exhausted its retries; kept for inspection and manual requeue
+
+Handler = Callable[[sqlite3.Connection, Dict], None]
+DeadHandler = Callable[[sqlite3.Connection, Dict, str], None]
+_handlers: Dict[str, Handler] = {}
+_dead_handlers: Dict[str, DeadHandler] = {}
+
+
+def handler(kind: str) -> Callable[[Handler], Handler]:
+    """
+    Register the function that runs jobs of the given kind.
+    It is called as fn(conn, payload) on the worker's own connection, and the
+    worker commits after it returns. Raising an exception schedules a retry.
+    """
+    def decorator(fn: Handler) -> Handler:
+        _handlers[kind] = fn
+        return fn
+    return decorator
+
+
+def on_dead(kind: str) -> Callable[[DeadHandler], DeadHandler]:
+    """
+    Register the function called as fn(conn, payload, last_error) when a job of
+    the given kind runs out of attempts, so its handler can keep raising for
+    retries and leave recording the failure to the last one
+    """
+    def decorator(fn: DeadHandler) -> DeadHandler:
+        _dead_handlers[kind] = fn
+        return fn
+    return decorator
+
+
+def enqueue(conn: sqlite3.Connection, kind: str, key: Optional[str] = None,
+            payload: Optional[Dict] = None, delay: float = 0.0,
+            max_attempts: int = JOB_MAX_ATTEMPTS) -> None:
+    """
+    Add a job on the caller's connection, so it commits (or rolls back) together
+    with the caller's own writes. A job with the same kind and key that is still
+    pending is left as is rather than queued twice; one that is running is
+    queued to run once more after the current run, which may have read the
+    data too early.
+    Call notify() after committing to wake in-process workers immediately.
+    """
+    conn.execute('''
+        INSERT INTO jobs (kind, key, payload, status, attempts, max_attempts, run_after)
+        VALUES (?, ?, ?, ?, 0, ?, ?)
+        ON CONFLICT(kind, key) DO UPDATE SET
+            payload = excluded.payload,
+            status = excluded.status,
+            attempts = 0,
+            max_attempts = excluded.max_attempts,
+            run_after = excluded.run_after,
+            last_error = NULL
+        WHERE jobs.status IN (?, ?, ?)
+    ''', (kind, key, json.dumps(payload or {}), PENDING, max_attempts,
+          time.time() + delay, DONE, DEAD, RUNNING))
+
+
+def _claim(conn: sqlite3.Connection, worker_id: str) -> Optional[sqlite3.Row]:
+    """
+    Atomically take the next runnable job (or one whose lease expired). A
+    pending job that is still locked was queued again while running and waits
+    for that run to release it.
+    """
+    now = time.time()
+    rows = conn.execute('''
+        UPDATE jobs
+        SET status = ?, attempts = attempts + 1, locked_by = ?, locked_at = ?
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE (status = ? AND locked_by IS NULL AND run_after <= ?)
+               OR (status IN (?, ?) AND locked_by IS NOT NULL AND locked_at < ?)
+            ORDER BY run_after, id
+            LIMIT 1
+        )
+        RETURNING *
+    ''', (RUNNING, worker_id, now, PENDING, now, RUNNING, PENDING, now - JOB_LEASE_SECONDS)).fetchall()
+    return rows[0] if rows else None
+
+
+def _retry_delay(attempts: int) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(JOB_RETRY_MAX_DELAY, JOB_RETRY_BASE_DELAY * 2 ** (attempts - 1)))
+
+
+def _release(conn: sqlite3.Connection, job: sqlite3.Row, worker_id: str, status: str,
+             last_error: Optional[str] = None, run_after: Optional[float] = None) -> bool:
+    """
+    Record the outcome of a claimed job. If enqueue() asked for another run
+    meanwhile, the job is pending again: just unlock it so it can be claimed.
+    Returns whether the outcome was recorded.
+    """
+    claim = (job['id'], worker_id, job['locked_at'])
+    recorded = conn.execute('''
+        UPDATE jobs SET status = ?, locked_by = NULL, last_error = ?, run_after = COALESCE(?, run_after)
+        WHERE id = ? AND locked_by = ? AND locked_at = ? AND status = ?
+    ''', (status, last_error, run_after, *claim, RUNNING)).rowcount
+    if not recorded:
+        conn.execute('UPDATE jobs SET locked_by = NULL WHERE id = ? AND locked_by = ? AND locked_at = ?', claim)
+    return bool(recorded)
+
+
+def run_one(conn: sqlite3.Connection, worker_id: str = 'inline') -> bool:
+    """
+    Claim and run a single job on conn.
+    Returns False when there was nothing to do.
+    """
+    job = _claim(conn, worker_id)
+    conn.commit()
+    if job is None:
+        return False
+
+    fn = _handlers.get(job['kind'])
+    try:
+        if fn is None:
+            raise LookupError(f"No handler registered for job kind '{job['kind']}'")
+        fn(conn, json.loads(job['payload']))
+        _release(conn, job, worker_id, DONE)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        error = f"{type(e).__name__}: {e}"
+        if job['attempts'] >= job['max_attempts']:
+            print(f"Job {job['id']} ({job['kind']}) moved to dead letter: {error}")
+            dead_fn = _dead_handlers.get(job['kind'])
+            if _release(conn, job, worker_id, DEAD, error) and dead_fn is not None:
+                try:
+                    dead_fn(conn, json.loads(job['payload']), error)
+                except Exception as dead_error:
+                    print(f"Dead letter handler for job {job['id']} failed: {str(dead_error)}")
+        else:
+            _release(conn, job, worker_id, PENDING, error, time.time() + _retry_delay(job['attempts']))
+        conn.commit()
+    return True
+
+
+def requeue_dead(conn: sqlite3.Connection, kind: Optional[str] = None) -> int:
+    """Give dead-lettered jobs a fresh set of attempts. Returns how many were requeued."""
+    query = 'UPDATE jobs SET status = ?, attempts = 0, run_after = ?, last_error = NULL WHERE status = ?'
+    params: List = [PENDING, time.time(), DEAD]
+    if kind:
+        query += ' AND kind = ?'
+        params.append(kind)
+    return conn.execute(query, params).rowcount
+
+
+def purge_done(conn: sqlite3.Connection) -> int:
+    """Delete finished jobs. Returns how many were removed."""
+    return conn.execute('DELETE FROM jobs WHERE status = ?', (DONE,)).rowcount
+
+
+def queue_stats(conn: sqlite3.Connection) -> Dict[str, int]:
+    """Number of jobs in each status"""
+    counts = {PENDING: 0, RUNNING: 0, DONE: 0, DEAD: 0}
+    for row in conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status'):
+        counts[row['status']] = row['n']
+    return counts
+
+
+class WorkerPool:
+    """Worker threads that poll the jobs table until stopped"""
+
+    def __init__(self, threads: int = JOB_WORKER_THREADS, poll_interval: float = JOB_POLL_INTERVAL):
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._workers: List[threading.Thread] = []
+
+    def start(self) -> None:
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+        for n in range(self.threads):
+            worker = threading.Thread(target=self._run, args=(f"{prefix}:{n}",),
+                                      name=f"job-worker-{n}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stopping.set()
+        self._wakeup.set()
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def _run(self, worker_id: str) -> None:
+        conn = db.connect()
+        try:
+            while not self._stopping.is_set():
+                try:
+                    if run_one(conn, worker_id):
+                        continue
+                except sqlite3.Error:
+                    # Usually a lock timeout; back off and try again
+                    traceback.print_exc()
+                    conn.rollback()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+        finally:
+            conn.close()
+
+
+_pool: Optional[WorkerPool] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+
+def start_workers(threads: int = JOB_WORKER_THREADS) -> WorkerPool:
+    """Start this process's worker pool (once per process)"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = WorkerPool(threads)
+            _pool_pid = os.getpid()
+            _pool.start()
+    return _pool
+
+
+def notify() -> None:
+    """Wake this process's workers, if it runs any"""
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.notify()
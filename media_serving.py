@@ -0,0 +1,73 @@
+"""
+Media Serving for ChirpX
+Serves uploads under /media/ with validators and caching that suit them:
+content-addressed files never change, so they are cached for a year as
+immutable; Range requests stream just the requested bytes (video seeking);
+a front proxy can take over the transfer (X-Accel-Redirect / X-Sendfile).
+"""
+
+import mimetypes
+import os
+import re
+
+from flask import Response, abort, send_file
+from werkzeug.security import safe_join
+
+import media_store
+
+# Settings (override through environment variables)
+# Files not named by their hash (uploads from before content addressing) may change
+MEDIA_MAX_AGE = int(os.getenv('MEDIA_MAX_AGE', '300'))
+MEDIA_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Set to nginx's internal location for uploads (e.g. /protected-media) to let nginx send files
+MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv('MEDIA_ACCEL_REDIRECT_PREFIX', '')
+# Let Apache/lighttpd send files through X-Sendfile (applied to the app's USE_X_SENDFILE)
+MEDIA_X_SENDFILE = os.getenv('MEDIA_X_SENDFILE', '0') == '1'
+
+mimetypes.add_type('image/webp', '.webp')
+
+# ab/cd/<sha256>... as written by media_store
+_HASHED_RE = re.compile(r'^([0-9a-f]{2})/([0-9a-f]{2})/(\1\2[0-9a-f]{60})[._][\w.]+$')
+
+
+def is_hashed(filename: str) -> bool:
+    """Whether the file at uploads/<filename> is content-addressed (its bytes never change)"""
+    return _HASHED_RE.match(filename) is not None
+
+
+def send_media(filename: str) -> Response:
+    """
+    Response for uploads/<filename>: 304 when If-None-Match matches, 206 for a
+    satisfiable Range, 416 for one that is not. The file is streamed in chunks
+    (or handed to the proxy), never read into memory whole.
+    """
+    media_dir = os.path.abspath(os.path.join(media_store.MEDIA_ROOT, media_store.MEDIA_DIR))
+    path = safe_join(media_dir, filename)
+    if path is None or filename.startswith('.') or not os.path.isfile(path):
+        abort(404)
+
+    hashed = is_hashed(filename)
+    if MEDIA_ACCEL_REDIRECT_PREFIX:
+        # nginx serves the body (ranges and validators included); headers set here are kept
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{MEDIA_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{filename}"
+    else:
+        # The name already identifies the content, so it makes a strong ETag;
+        # otherwise werkzeug derives one from mtime and size
+        response = send_file(path, conditional=True, etag=os.path.basename(filename) if hashed else True,
+                             max_age=MEDIA_IMMUTABLE_MAX_AGE if hashed else MEDIA_MAX_AGE)
+
+    response.cache_control.public = True
+    response.cache_control.no_cache = None
+    if hashed:
+        response.cache_control.max_age = MEDIA_IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = MEDIA_MAX_AGE
+    return response
+
+
+def media_path(path: str) -> str:
+    """Path under /media/ for a stored path relative to static/ (uploads/...), or None if it is elsewhere"""
+    prefix = media_store.MEDIA_DIR.rstrip('/') + '/'
+    return path[len(prefix):] if path and path.startswith(prefix) else None
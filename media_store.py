@@ -0,0 +1,261 @@
+"""
+Media Storage for ChirpX
+Content-addressed uploads: files are named by the SHA-256 of their bytes
+(hashed while the upload streams to disk) under sharded directories, so
+identical uploads are stored and processed once. media_blobs counts the
+chirp_media rows and profiles that use each blob.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+import images
+
+# Settings (override through environment variables)
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', 'static')  # URLs are paths relative to this (the static folder)
+MEDIA_DIR = os.getenv('MEDIA_DIR', 'uploads')  # Blobs live under MEDIA_ROOT/MEDIA_DIR
+MEDIA_CHUNK_SIZE = 64 * 1024
+# Unreferenced blobs younger than this are kept; an upload may be about to reuse them
+MEDIA_GC_GRACE_SECONDS = int(os.getenv('MEDIA_GC_GRACE_SECONDS', '3600'))
+
+# Blob kinds: how the uploaded bytes were turned into served files
+IMAGE = 'image'  # responsive variants
+AVATAR = 'avatar'  # square variants
+FILE = 'file'  # stored as uploaded (video, animated GIF)
+
+
+def blob_key(digest: str, kind: str) -> str:
+    """One blob per content and processing, so a picture used as a chirp image and an avatar is two blobs"""
+    return digest if kind != AVATAR else f'{AVATAR}:{digest}'
+
+
+def shard_dir(digest: str) -> str:
+    """Directory of a blob's files, relative to MEDIA_ROOT: uploads/ab/cd"""
+    return os.path.join(MEDIA_DIR, digest[:2], digest[2:4])
+
+
+def _abs(relative: str) -> str:
+    return os.path.join(MEDIA_ROOT, relative)
+
+
+def receive(stream: BinaryIO) -> Tuple[str, str, int]:
+    """
+    Copy an upload to a temporary file, hashing it on the way.
+    Returns (sha256 hex digest, temporary path, size in bytes).
+    """
+    tmp_dir = _abs(os.path.join(MEDIA_DIR, '.tmp'))
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(MEDIA_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return digest.hexdigest(), tmp_path, size
+
+
+def _blob_dict(row: sqlite3.Row) -> Dict:
+    return {'key': row['key'], 'url': row['path'], 'width': row['width'], 'height': row['height'],
+            'variants': row['variants']}
+
+
+def _files(row) -> List[str]:
+    """Every file of a blob, relative to MEDIA_ROOT"""
+    paths = {row['path']}
+    for variant in images.parse_variants(row['variants']):
+        paths.update((variant['webp'], variant['jpeg']))
+    return sorted(paths)
+
+
+def _present(row: sqlite3.Row) -> bool:
+    return all(os.path.exists(_abs(path)) for path in _files(row))
+
+
+def _materialize(tmp_path: str, digest: str, ext: str, kind: str) -> Dict:
+    """Turn a received upload into its served files; consumes tmp_path"""
+    directory = shard_dir(digest)
+    os.makedirs(_abs(directory), exist_ok=True)
+    try:
+        if kind != FILE:
+            stem = digest if kind == IMAGE else f'{digest}_{AVATAR}'
+            process = images.process_image if kind == IMAGE else images.process_avatar
+            result = images.run(process, tmp_path, _abs(directory), stem)
+            if result['fallback'] is not None:
+                variants = [{'width': v['width'],
+                             'webp': os.path.join(directory, v['webp']),
+                             'jpeg': os.path.join(directory, v['jpeg'])} for v in result['variants']]
+                return {'path': os.path.join(directory, result['fallback']), 'width': result['width'],
+                        'height': result['height'], 'variants': json.dumps(variants)}
+            # Animated: served as uploaded
+            width, height = result['width'], result['height']
+        else:
+            width = height = None
+        path = os.path.join(directory, f'{digest}.{ext}')
+        # Same name means same bytes, so replacing a concurrent writer's copy is harmless
+        os.replace(tmp_path, _abs(path))
+        return {'path': path, 'width': width, 'height': height, 'variants': None}
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def store(conn: sqlite3.Connection, stream: BinaryIO, ext: str, kind: str) -> Dict:
+    """
+    Store an upload and return its blob: {'key', 'url', 'width', 'height', 'variants'}.
+    Content already stored with the same processing is reused without touching
+    the new copy. The blob starts unreferenced; inserting a chirp_media row or
+    setting users.profile_picture_blob takes a reference (schema triggers).
+    Files are processed before anything is written, and the media_blobs row is
+    committed at once (with anything else pending on conn), so no write lock is
+    held while this or a later upload is being processed.
+    Raises images.InvalidImage when an image cannot be processed.
+    """
+    digest, tmp_path, size = receive(stream)
+    key = blob_key(digest, kind)
+
+    row = conn.execute('SELECT * FROM media_blobs WHERE key = ?', (key,)).fetchone()
+    if row and _present(row):
+        os.remove(tmp_path)
+        # Keeps collect_garbage from removing it before the new reference is committed
+        conn.execute('UPDATE media_blobs SET updated_at = ? WHERE key = ?', (time.time(), key))
+        conn.commit()
+        return _blob_dict(row)
+
+    stored = _materialize(tmp_path, digest, ext.lower(), kind)
+    conn.execute('''
+        INSERT INTO media_blobs (key, sha256, kind, path, size, width, height, variants, refcount, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?)
+        ON CONFLICT(key) DO UPDATE SET
+            path = excluded.path, width = excluded.width, height = excluded.height,
+            variants = excluded.variants, updated_at = excluded.updated_at
+    ''', (key, digest, kind, stored['path'], size, stored['width'], stored['height'],
+          stored['variants'], time.time()))
+    conn.commit()
+    return {'key': key, 'url': stored['path'], 'width': stored['width'], 'height': stored['height'],
+            'variants': stored['variants']}
+
+
+def collect_garbage(conn: sqlite3.Connection, grace_seconds: int = MEDIA_GC_GRACE_SECONDS) -> int:
+    """
+    Delete blobs nothing has referenced for grace_seconds, files first.
+    Returns the number of blobs removed.
+    """
+    rows = conn.execute('SELECT * FROM media_blobs WHERE refcount <= 0 AND updated_at < ?',
+                        (time.time() - grace_seconds,)).fetchall()
+    for row in rows:
+        for path in _files(row):
+            try:
+                os.remove(_abs(path))
+            except FileNotFoundError:
+                pass
+        conn.execute('DELETE FROM media_blobs WHERE key = ? AND refcount <= 0', (row['key'],))
+    return len(rows)
+
+
+def reconcile_refcounts(conn: sqlite3.Connection) -> int:
+    """Recompute every refcount from chirp_media and users. Returns how many changed."""
+    return conn.execute('''
+        UPDATE media_blobs SET refcount = (
+            (SELECT COUNT(*) FROM chirp_media WHERE blob_key = media_blobs.key) +
+            (SELECT COUNT(*) FROM users WHERE profile_picture_blob = media_blobs.key)
+        ), updated_at = ?
+        WHERE refcount != (
+            (SELECT COUNT(*) FROM chirp_media WHERE blob_key = media_blobs.key) +
+            (SELECT COUNT(*) FROM users WHERE profile_picture_blob = media_blobs.key)
+        )
+    ''', (time.time(),)).rowcount
+
+
+def _legacy_files(path: Optional[str], variants) -> List[str]:
+    """A pre-blob upload and its variants; only files directly in MEDIA_DIR, never blob files"""
+    files = {path} if path else set()
+    for variant in images.parse_variants(variants):
+        files.update((variant['webp'], variant['jpeg']))
+    return [f for f in files if os.path.dirname(f) == MEDIA_DIR]
+
+
+def migrate_legacy(conn: sqlite3.Connection, dry_run: bool = False) -> Dict[str, int]:
+    """
+    Move uploads stored before content addressing (flat uploads/<name>) into
+    blobs: chirp media and profile pictures are re-stored from their file,
+    which also dedupes them, and the old files are deleted once nothing
+    points at them. Rows whose file is missing are left alone.
+    Returns counts of migrated, missing and deleted files.
+    """
+    counts = {'chirp_media': 0, 'profile_pictures': 0, 'missing': 0, 'deleted_files': 0}
+    stored: Dict[Tuple[str, str], Dict] = {}
+    old_files = set()
+
+    def restore(path: str, kind: str) -> Optional[Dict]:
+        if (path, kind) in stored:
+            return stored[(path, kind)]
+        if not os.path.exists(_abs(path)):
+            counts['missing'] += 1
+            return None
+        if dry_run:
+            blob = {'key': None}
+        else:
+            with open(_abs(path), 'rb') as f:
+                try:
+                    blob = store(conn, f, path.rsplit('.', 1)[-1], kind)
+                except images.InvalidImage:
+                    counts['missing'] += 1
+                    return None
+        stored[(path, kind)] = blob
+        return blob
+
+    media_rows = conn.execute('SELECT id, media_url, media_type, variants FROM chirp_media '
+                              'WHERE blob_key IS NULL').fetchall()
+    for row in media_rows:
+        ext = row['media_url'].rsplit('.', 1)[-1].lower()
+        kind = IMAGE if row['media_type'] == 'image' and ext != 'gif' else FILE
+        blob = restore(row['media_url'], kind)
+        if blob is None:
+            continue
+        counts['chirp_media'] += 1
+        old_files.update(_legacy_files(row['media_url'], row['variants']))
+        if not dry_run:
+            conn.execute('''
+                UPDATE chirp_media SET media_url = ?, width = ?, height = ?, variants = ?, blob_key = ?
+                WHERE id = ?
+            ''', (blob['url'], blob['width'], blob['height'], blob['variants'], blob['key'], row['id']))
+
+    user_rows = conn.execute('SELECT id, profile_picture, profile_picture_variants FROM users '
+                             'WHERE profile_picture IS NOT NULL AND profile_picture_blob IS NULL').fetchall()
+    for row in user_rows:
+        blob = restore(row['profile_picture'], AVATAR)
+        if blob is None:
+            continue
+        counts['profile_pictures'] += 1
+        old_files.update(_legacy_files(row['profile_picture'], row['profile_picture_variants']))
+        if not dry_run:
+            conn.execute('''
+                UPDATE users SET profile_picture = ?, profile_picture_variants = ?, profile_picture_blob = ?
+                WHERE id = ?
+            ''', (blob['url'], blob['variants'], blob['key'], row['id']))
+
+    if not dry_run:
+        conn.commit()
+        still_used = {row[0] for row in conn.execute(
+            'SELECT media_url FROM chirp_media UNION SELECT profile_picture FROM users')}
+        for path in old_files - still_used:
+            try:
+                os.remove(_abs(path))
+                counts['deleted_files'] += 1
+            except FileNotFoundError:
+                pass
+    return counts
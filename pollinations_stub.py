@@ -0,0 +1,74 @@
+"""
+Pollinations Stub for ChirpX
+A local stand-in for image.pollinations.ai for development and tests: it
+answers GET /prompt/<prompt> with a solid-colour JPEG derived from the
+prompt, after an optional delay. Prompts containing "fail" get a 500.
+
+    python pollinations_stub.py --port 8765 --delay 2
+    POLLINATIONS_BASE_URL=http://127.0.0.1:8765 flask --app app run
+"""
+
+import argparse
+import hashlib
+import io
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+    requests_served = 0
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if not url.path.startswith('/prompt/'):
+            self.send_error(404)
+            return
+        prompt = urllib.parse.unquote(url.path[len('/prompt/'):])
+        params = urllib.parse.parse_qs(url.query)
+        width = min(int(params.get('width', ['256'])[0]), 2048)
+        height = min(int(params.get('height', ['256'])[0]), 2048)
+
+        type(self).requests_served += 1
+        time.sleep(self.delay)
+        if 'fail' in prompt.lower():
+            self.send_error(500, 'Generation failed')
+            return
+
+        colour = tuple(hashlib.sha256(prompt.encode()).digest()[:3])
+        buffer = io.BytesIO()
+        Image.new('RGB', (width, height), colour).save(buffer, 'JPEG', quality=80)
+        body = buffer.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int = 0, delay: float = 0.0) -> ThreadingHTTPServer:
+    """Start the stub in a background thread; its URL is http://127.0.0.1:<server.server_port>"""
+    handler = type('Handler', (StubHandler,), {'delay': delay})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, name='pollinations-stub', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds to wait before answering')
+    args = parser.parse_args()
+    server = serve(args.port, args.delay)
+    print(f'Pollinations stub on http://127.0.0.1:{server.server_port}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
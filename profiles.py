@@ -0,0 +1,58 @@
+"""
+Profile Headers for ChirpX
+The public face of a user (name, bio, avatar and follower, following and
+chirp counts), shared by the profile page, user search and who-to-follow.
+The counts are denormalized into users and kept in sync by triggers (see
+schema.sql), so a header is one primary-key read and is always current.
+"""
+
+import sqlite3
+from typing import Dict, Iterable, Optional
+
+HEADER_COLUMNS = ('id', 'username', 'full_name', 'bio', 'location', 'website', 'profile_picture',
+                  'profile_picture_variants', 'created_at', 'follower_count', 'following_count', 'chirp_count',
+                  'feed_version')
+
+
+def _fetch(conn: sqlite3.Connection, where: str, params: Iterable) -> Dict[int, Dict]:
+    rows = conn.execute(f'SELECT {", ".join(HEADER_COLUMNS)} FROM users WHERE {where}', list(params)).fetchall()
+    return {row['id']: dict(row) for row in rows}
+
+
+def get_headers(conn: sqlite3.Connection, user_ids: Iterable[int]) -> Dict[int, Dict]:
+    """Headers by user id; ids of users that do not exist are left out"""
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+    return _fetch(conn, f'id IN ({",".join("?" * len(user_ids))})', user_ids)
+
+
+def get_header(conn: sqlite3.Connection, user_id: int) -> Optional[Dict]:
+    return _fetch(conn, 'id = ?', (user_id,)).get(user_id)
+
+
+def get_header_by_username(conn: sqlite3.Connection, username: str) -> Optional[Dict]:
+    return next(iter(_fetch(conn, 'username = ?', (username,)).values()), None)
+
+
+def reconcile_user_counts(conn: sqlite3.Connection) -> int:
+    """Recompute follower, following and chirp counts that drifted. Returns how many users were fixed."""
+    fixed = conn.execute('''
+        UPDATE users SET
+            follower_count = a.follower_count,
+            following_count = a.following_count,
+            chirp_count = a.chirp_count,
+            feed_version = feed_version + 1
+        FROM (
+            SELECT u.id,
+                   (SELECT COUNT(*) FROM follows WHERE following_id = u.id) AS follower_count,
+                   (SELECT COUNT(*) FROM follows WHERE follower_id = u.id) AS following_count,
+                   (SELECT COUNT(*) FROM chirps WHERE user_id = u.id) AS chirp_count
+            FROM users u
+        ) AS a
+        WHERE a.id = users.id
+          AND (users.follower_count != a.follower_count
+               OR users.following_count != a.following_count
+               OR users.chirp_count != a.chirp_count)
+    ''').rowcount
+    return fixed
@@ -0,0 +1,209 @@
+"""
+Follow Recommendations for ChirpX
+Who-to-follow lists are precomputed: a periodic refresh loads the follows
+graph into compressed sparse row arrays and ranks each user's
+friends-of-friends by how many of the people they follow already follow the
+candidate, plus the candidate's popularity. Following someone updates just
+the follower's list. Serving a list is one primary-key lookup.
+"""
+
+import heapq
+import json
+import math
+import os
+import sqlite3
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Settings (override through environment variables)
+RECOMMEND_TOP_N = int(os.getenv('RECOMMEND_TOP_N', '20'))  # suggestions stored per user
+RECOMMEND_REFRESH_SECONDS = int(os.getenv('RECOMMEND_REFRESH_SECONDS', '900'))
+RECOMMEND_MUTUAL_WEIGHT = float(os.getenv('RECOMMEND_MUTUAL_WEIGHT', '1.0'))
+RECOMMEND_POPULARITY_WEIGHT = float(os.getenv('RECOMMEND_POPULARITY_WEIGHT', '0.5'))
+
+# follow_suggestions row holding the most-followed users, which fill the
+# lists of users who follow few people (or nobody yet)
+POPULAR_ROW = 0
+
+
+def score(mutual: int, followers: int) -> float:
+    """Each mutual follow counts fully; popularity with diminishing returns"""
+    return RECOMMEND_MUTUAL_WEIGHT * mutual + RECOMMEND_POPULARITY_WEIGHT * math.log1p(followers)
+
+
+def _suggestion(user_id: int, mutual: int, followers: int) -> Dict:
+    return {'id': user_id, 'mutual': mutual, 'score': round(score(mutual, followers), 4)}
+
+
+def _fill(ranked: List[Dict], popular: List[Dict], exclude: Set[int], top_n: int) -> List[Dict]:
+    """Top up a short list with popular users the user does not follow"""
+    seen = exclude | {s['id'] for s in ranked}
+    for candidate in popular:
+        if len(ranked) >= top_n:
+            break
+        if candidate['id'] not in seen:
+            ranked.append(candidate)
+            seen.add(candidate['id'])
+    return ranked
+
+
+class FollowGraph:
+    """
+    The follows table as CSR arrays over dense node indexes: the users node i
+    follows are targets[offsets[i]:offsets[i + 1]]; followers[i] is its in-degree.
+    """
+
+    def __init__(self, user_ids: Iterable[int], edges: Iterable[Tuple[int, int]]):
+        self.user_ids = array('q', sorted(user_ids))
+        self.index = {user_id: i for i, user_id in enumerate(self.user_ids)}
+        n = len(self.user_ids)
+        self.offsets = array('q', bytes(8 * (n + 1)))
+        self.targets = array('q')
+        self.followers = array('q', bytes(8 * n))
+
+        # Edges arrive grouped by follower (ordered by follower id)
+        previous = 0
+        for follower_id, following_id in edges:
+            source, target = self.index.get(follower_id), self.index.get(following_id)
+            if source is None or target is None:
+                continue
+            for i in range(previous + 1, source + 1):
+                self.offsets[i] = len(self.targets)
+            previous = source
+            self.targets.append(target)
+            self.followers[target] += 1
+        for i in range(previous + 1, n + 1):
+            self.offsets[i] = len(self.targets)
+
+    @classmethod
+    def load(cls, conn: sqlite3.Connection) -> 'FollowGraph':
+        user_ids = [row[0] for row in conn.execute('SELECT id FROM users')]
+        edges = conn.execute('SELECT follower_id, following_id FROM follows ORDER BY follower_id, following_id')
+        return cls(user_ids, edges)
+
+    def following(self, node: int) -> array:
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def popular(self, top_n: int) -> List[Dict]:
+        """The most-followed users"""
+        nodes = heapq.nlargest(top_n, (i for i in range(len(self.user_ids)) if self.followers[i]),
+                               key=lambda i: self.followers[i])
+        return [_suggestion(self.user_ids[i], 0, self.followers[i]) for i in nodes]
+
+    def suggest(self, user_id: int, top_n: int, popular: List[Dict]) -> List[Dict]:
+        """Friends-of-friends of user_id, best first, topped up from popular"""
+        node = self.index[user_id]
+        followed = set(self.following(node))
+        followed.add(node)
+        mutual: Dict[int, int] = {}
+        for friend in followed - {node}:
+            for candidate in self.following(friend):
+                if candidate not in followed:
+                    mutual[candidate] = mutual.get(candidate, 0) + 1
+        best = heapq.nlargest(top_n, mutual.items(),
+                              key=lambda item: (score(item[1], self.followers[item[0]]), -item[0]))
+        ranked = [_suggestion(self.user_ids[i], m, self.followers[i]) for i, m in best]
+        return _fill(ranked, popular, {self.user_ids[i] for i in followed}, top_n)
+
+
+def _save(conn: sqlite3.Connection, rows: Iterable[Tuple[int, List[Dict]]]) -> None:
+    now = time.time()
+    conn.executemany('''
+        INSERT INTO follow_suggestions (user_id, suggestions, computed_at) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET suggestions = excluded.suggestions, computed_at = excluded.computed_at
+    ''', ((user_id, json.dumps(suggestions), now) for user_id, suggestions in rows))
+
+
+def refresh_all(conn: sqlite3.Connection, top_n: int = RECOMMEND_TOP_N) -> int:
+    """Recompute every user's suggestions from one scan of follows. Returns the number of users."""
+    graph = FollowGraph.load(conn)
+    # Enough popular users to fill a list after skipping the ones already followed
+    popular = graph.popular(top_n * 4)
+    _save(conn, [(POPULAR_ROW, popular)])
+    _save(conn, ((user_id, graph.suggest(user_id, top_n, popular)) for user_id in graph.user_ids))
+    conn.execute('DELETE FROM follow_suggestions WHERE user_id != ? AND user_id NOT IN (SELECT id FROM users)',
+                 (POPULAR_ROW,))
+    return len(graph.user_ids)
+
+
+def _load(conn: sqlite3.Connection, user_id: int) -> Optional[sqlite3.Row]:
+    return conn.execute('SELECT suggestions, computed_at FROM follow_suggestions WHERE user_id = ?',
+                        (user_id,)).fetchone()
+
+
+def refresh_user(conn: sqlite3.Connection, user_id: int, top_n: int = RECOMMEND_TOP_N) -> List[Dict]:
+    """Recompute one user's suggestions with a two-hop query, e.g. after they follow or unfollow someone"""
+    followed = {row[0] for row in conn.execute('SELECT following_id FROM follows WHERE follower_id = ?',
+                                               (user_id,))}
+    rows = conn.execute('''
+        SELECT f.following_id AS id, COUNT(*) AS mutual, u.follower_count AS followers
+        FROM follows f
+        JOIN users u ON u.id = f.following_id
+        WHERE f.follower_id IN (SELECT following_id FROM follows WHERE follower_id = ?)
+        GROUP BY f.following_id
+    ''', (user_id,)).fetchall()
+    candidates = [row for row in rows if row['id'] != user_id and row['id'] not in followed]
+    best = heapq.nlargest(top_n, candidates, key=lambda row: (score(row['mutual'], row['followers']), -row['id']))
+    ranked = [_suggestion(row['id'], row['mutual'], row['followers']) for row in best]
+
+    popular_row = _load(conn, POPULAR_ROW)
+    popular = json.loads(popular_row['suggestions']) if popular_row else []
+    suggestions = _fill(ranked, popular, followed | {user_id}, top_n)
+    _save(conn, [(user_id, suggestions)])
+    return suggestions
+
+
+def record_follow(conn: sqlite3.Connection, follower_id: int, following_id: int) -> None:
+    """
+    Take a newly followed user off the follower's list right away; run on the
+    follow's transaction. Queue refresh_user to bring in that user's follows.
+    """
+    row = _load(conn, follower_id)
+    if row is None:
+        return
+    suggestions = json.loads(row['suggestions'])
+    kept = [s for s in suggestions if s['id'] != following_id]
+    if len(kept) != len(suggestions):
+        conn.execute('UPDATE follow_suggestions SET suggestions = ? WHERE user_id = ?',
+                     (json.dumps(kept), follower_id))
+
+
+def suggestions_for(conn: sqlite3.Connection, user_id: int) -> Dict:
+    """
+    The user's precomputed suggestions, best first, in one lookup:
+    {'suggestions': [{id, mutual, score}], 'personal': bool, 'computed_at': unix time}.
+    Users not computed yet get the popular list ('personal' False); computed_at
+    is that of the last full refresh (None before the first one).
+    """
+    rows = {row['user_id']: row for row in conn.execute(
+        'SELECT * FROM follow_suggestions WHERE user_id IN (?, ?)', (user_id, POPULAR_ROW))}
+    popular_row = rows.get(POPULAR_ROW)
+    computed_at = popular_row['computed_at'] if popular_row else None
+    if user_id in rows:
+        return {'suggestions': json.loads(rows[user_id]['suggestions']), 'personal': True,
+                'computed_at': computed_at}
+    suggestions = []
+    if popular_row is not None:
+        followed = {r[0] for r in conn.execute('SELECT following_id FROM follows WHERE follower_id = ?',
+                                               (user_id,))}
+        suggestions = _fill([], json.loads(popular_row['suggestions']), followed | {user_id}, RECOMMEND_TOP_N)
+    return {'suggestions': suggestions, 'personal': False, 'computed_at': computed_at}
+
+
+def is_stale(result: Dict) -> bool:
+    """Whether the lists are due for a full refresh"""
+    return result['computed_at'] is None or time.time() - result['computed_at'] >= RECOMMEND_REFRESH_SECONDS
+
+
+def backfill_if_empty(conn: sqlite3.Connection) -> bool:
+    """
+    Compute suggestions once for databases created before the table existed.
+    Returns True when a backfill was performed.
+    """
+    if conn.execute('SELECT 1 FROM follow_suggestions LIMIT 1').fetchone():
+        return False
+    if not conn.execute('SELECT 1 FROM follows LIMIT 1').fetchone():
+        return False
+    refresh_all(conn)
+    return True
@@ -9,6 +9,15 @@ CREATE TABLE IF NOT EXISTS users (
     location TEXT,
     website TEXT,
     profile_picture TEXT,
+    profile_picture_variants TEXT, -- JSON [{width, webp, jpeg}], smallest first
+    profile_picture_blob TEXT, -- media_blobs.key
+    -- Denormalized counts, maintained by the triggers below (see profiles.py)
+    follower_count INTEGER NOT NULL DEFAULT 0,
+    following_count INTEGER NOT NULL DEFAULT 0,
+    chirp_count INTEGER NOT NULL DEFAULT 0,
+    -- Change counters behind the feed and profile ETags (see conditional.py)
+    feed_version INTEGER NOT NULL DEFAULT 0,
+    activity_version INTEGER NOT NULL DEFAULT 0,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -28,6 +37,10 @@ CREATE TABLE IF NOT EXISTS chirp_media (
     media_url TEXT NOT NULL,
     media_type TEXT NOT NULL, -- 'image' or 'video'
     display_order INTEGER DEFAULT 0,
+    width INTEGER, -- images only, of the largest variant
+    height INTEGER,
+    variants TEXT, -- JSON [{width, webp, jpeg}], smallest first
+    blob_key TEXT, -- media_blobs.key
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (chirp_id) REFERENCES chirps (id) ON DELETE CASCADE
 );
@@ -90,6 +103,20 @@ CREATE TABLE IF NOT EXISTS messages (
     FOREIGN KEY (receiver_id) REFERENCES users (id) ON DELETE CASCADE
 );
 
+-- Conversations table (DM inbox: one row per participant and partner, see inbox.py)
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id INTEGER NOT NULL,
+    other_user_id INTEGER NOT NULL,
+    last_message_id INTEGER NOT NULL,
+    last_sender_id INTEGER NOT NULL,
+    last_message_preview TEXT NOT NULL,
+    last_message_at TIMESTAMP NOT NULL,
+    unread_count INTEGER NOT NULL DEFAULT 0, -- messages from other_user_id that user_id has not read
+    PRIMARY KEY (user_id, other_user_id),
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+    FOREIGN KEY (other_user_id) REFERENCES users (id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
 -- AI Analysis table (for caching AI results)
 CREATE TABLE IF NOT EXISTS ai_analysis (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -116,6 +143,326 @@ CREATE TABLE IF NOT EXISTS bookmarks (
     UNIQUE(user_id, chirp_id)
 );
 
+-- Jobs table (durable background job queue, see jobs.py)
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT, -- deduplication key, e.g. the chirp id for enrichment jobs
+    payload TEXT NOT NULL DEFAULT '{}', -- JSON
+    status TEXT NOT NULL DEFAULT 'pending', -- 'pending', 'running', 'done' or 'dead'
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    run_after REAL NOT NULL, -- unix time
+    locked_by TEXT,
+    locked_at REAL, -- unix time
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(kind, key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(status, run_after);
+
+-- AI cache table (persistent tier of the AI response cache, see ai_cache.py)
+CREATE TABLE IF NOT EXISTS ai_cache (
+    key TEXT PRIMARY KEY, -- SHA-256 of model, messages and parameters
+    task TEXT NOT NULL,
+    response TEXT NOT NULL,
+    expires_at REAL NOT NULL, -- unix time
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_ai_cache_expires ON ai_cache(expires_at);
+
+-- Trending snapshots table (latest labeled trending topics, see trending.py)
+CREATE TABLE IF NOT EXISTS trending_snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topics TEXT NOT NULL, -- JSON array of {topic, relevance, terms}
+    computed_at REAL NOT NULL -- unix time
+);
+
+-- Follow suggestions table (precomputed who-to-follow lists, see recommendations.py)
+CREATE TABLE IF NOT EXISTS follow_suggestions (
+    user_id INTEGER PRIMARY KEY, -- 0 holds the most-followed users, used to fill short lists
+    suggestions TEXT NOT NULL, -- JSON [{id, mutual, score}], best first
+    computed_at REAL NOT NULL -- unix time
+);
+
+-- Generated images table (AI image generation results by prompt, see image_gen.py)
+CREATE TABLE IF NOT EXISTS generated_images (
+    prompt_hash TEXT PRIMARY KEY, -- SHA-256 of the normalized prompt and image parameters
+    prompt TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending', -- 'pending', 'done' or 'failed'
+    path TEXT, -- relative to static/, e.g. uploads/generated/<prompt_hash>.jpg
+    error TEXT,
+    requested_by INTEGER,
+    updated_at REAL NOT NULL, -- unix time
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Live events for /events/stream, kept for a few minutes so reconnecting clients can catch up
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL, -- 'user:<id>' or 'chirps:<author id>'
+    event TEXT NOT NULL,
+    data TEXT NOT NULL, -- JSON
+    created_at REAL NOT NULL -- unix time
+);
+
+-- Home timeline table (materialized per-user feed, fan-out on write)
+CREATE TABLE IF NOT EXISTS home_timeline (
+    user_id INTEGER NOT NULL,
+    chirp_id INTEGER NOT NULL,
+    author_id INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, chirp_id),
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+    FOREIGN KEY (chirp_id) REFERENCES chirps (id) ON DELETE CASCADE,
+    FOREIGN KEY (author_id) REFERENCES users (id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+-- Chirp Stats table (denormalized engagement counters, maintained by triggers below)
+CREATE TABLE IF NOT EXISTS chirp_stats (
+    chirp_id INTEGER PRIMARY KEY,
+    like_count INTEGER NOT NULL DEFAULT 0,
+    comment_count INTEGER NOT NULL DEFAULT 0,
+    retweet_count INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (chirp_id) REFERENCES chirps (id) ON DELETE CASCADE
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_chirps_stats_insert AFTER INSERT ON chirps
+BEGIN
+    INSERT OR IGNORE INTO chirp_stats (chirp_id) VALUES (NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chirps_stats_delete AFTER DELETE ON chirps
+BEGIN
+    DELETE FROM chirp_stats WHERE chirp_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_likes_stats_insert AFTER INSERT ON likes
+BEGIN
+    INSERT INTO chirp_stats (chirp_id, like_count) VALUES (NEW.chirp_id, 1)
+    ON CONFLICT(chirp_id) DO UPDATE SET like_count = like_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_likes_stats_delete AFTER DELETE ON likes
+BEGIN
+    UPDATE chirp_stats SET like_count = MAX(like_count - 1, 0) WHERE chirp_id = OLD.chirp_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_comments_stats_insert AFTER INSERT ON comments
+BEGIN
+    INSERT INTO chirp_stats (chirp_id, comment_count) VALUES (NEW.chirp_id, 1)
+    ON CONFLICT(chirp_id) DO UPDATE SET comment_count = comment_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_comments_stats_delete AFTER DELETE ON comments
+BEGIN
+    UPDATE chirp_stats SET comment_count = MAX(comment_count - 1, 0) WHERE chirp_id = OLD.chirp_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_retweets_stats_insert AFTER INSERT ON retweets
+BEGIN
+    INSERT INTO chirp_stats (chirp_id, retweet_count) VALUES (NEW.chirp_id, 1)
+    ON CONFLICT(chirp_id) DO UPDATE SET retweet_count = retweet_count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_retweets_stats_delete AFTER DELETE ON retweets
+BEGIN
+    UPDATE chirp_stats SET retweet_count = MAX(retweet_count - 1, 0) WHERE chirp_id = OLD.chirp_id;
+END;
+
+-- Media blobs (content-addressed uploads; refcount maintained by the triggers below)
+CREATE TABLE IF NOT EXISTS media_blobs (
+    key TEXT PRIMARY KEY, -- sha256 hex of the uploaded bytes ('avatar:<sha256>' for profile pictures)
+    sha256 TEXT NOT NULL,
+    kind TEXT NOT NULL, -- 'image', 'avatar' or 'file'
+    path TEXT NOT NULL, -- relative to static/, e.g. uploads/ab/cd/<sha256>_1600w.jpg
+    size INTEGER NOT NULL, -- bytes uploaded
+    width INTEGER,
+    height INTEGER,
+    variants TEXT, -- JSON [{width, webp, jpeg}], smallest first
+    refcount INTEGER NOT NULL DEFAULT 0, -- chirp_media rows and users using the blob
+    updated_at REAL NOT NULL, -- unix time of the last reference change
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_chirp_media_blob_insert AFTER INSERT ON chirp_media
+WHEN NEW.blob_key IS NOT NULL
+BEGIN
+    UPDATE media_blobs SET refcount = refcount + 1, updated_at = (julianday('now') - 2440587.5) * 86400.0 WHERE key = NEW.blob_key;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chirp_media_blob_delete AFTER DELETE ON chirp_media
+WHEN OLD.blob_key IS NOT NULL
+BEGIN
+    UPDATE media_blobs SET refcount = MAX(refcount - 1, 0), updated_at = (julianday('now') - 2440587.5) * 86400.0 WHERE key = OLD.blob_key;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chirp_media_blob_update AFTER UPDATE OF blob_key ON chirp_media
+WHEN OLD.blob_key IS NOT NEW.blob_key
+BEGIN
+    UPDATE media_blobs SET refcount = MAX(refcount - 1, 0), updated_at = (julianday('now') - 2440587.5) * 86400.0 WHERE key = OLD.blob_key;
+    UPDATE media_blobs SET refcount = refcount + 1, updated_at = (julianday('now') - 2440587.5) * 86400.0 WHERE key = NEW.blob_key;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_avatar_blob AFTER UPDATE OF profile_picture_blob ON users
+WHEN OLD.profile_picture_blob IS NOT NEW.profile_picture_blob
+BEGIN
+    UPDATE media_blobs SET refcount = MAX(refcount - 1, 0), updated_at = (julianday('now') - 2440587.5) * 86400.0 WHERE key = OLD.profile_picture_blob;
+    UPDATE media_blobs SET refcount = refcount + 1, updated_at = (julianday('now') - 2440587.5) * 86400.0 WHERE key = NEW.profile_picture_blob;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_avatar_blob_delete AFTER DELETE ON users
+WHEN OLD.profile_picture_blob IS NOT NULL
+BEGIN
+    UPDATE media_blobs SET refcount = MAX(refcount - 1, 0), updated_at = (julianday('now') - 2440587.5) * 86400.0 WHERE key = OLD.profile_picture_blob;
+END;
+
+-- User counts: follows and chirps keep users.follower_count, following_count and chirp_count current
+CREATE TRIGGER IF NOT EXISTS trg_follows_counts_insert AFTER INSERT ON follows
+BEGIN
+    UPDATE users SET following_count = following_count + 1 WHERE id = NEW.follower_id;
+    UPDATE users SET follower_count = follower_count + 1 WHERE id = NEW.following_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_follows_counts_delete AFTER DELETE ON follows
+BEGIN
+    UPDATE users SET following_count = MAX(following_count - 1, 0) WHERE id = OLD.follower_id;
+    UPDATE users SET follower_count = MAX(follower_count - 1, 0) WHERE id = OLD.following_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chirps_count_insert AFTER INSERT ON chirps
+BEGIN
+    UPDATE users SET chirp_count = chirp_count + 1 WHERE id = NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chirps_count_delete AFTER DELETE ON chirps
+BEGIN
+    UPDATE users SET chirp_count = MAX(chirp_count - 1, 0) WHERE id = OLD.user_id;
+END;
+
+-- Page versions: users.feed_version moves whenever the user's profile header or any card of
+-- their chirps changes; users.activity_version whenever their likes, retweets, bookmarks or follows do
+CREATE TRIGGER IF NOT EXISTS trg_users_feed_version AFTER UPDATE OF
+    username, full_name, bio, location, website, profile_picture, profile_picture_variants ON users
+BEGIN
+    UPDATE users SET feed_version = feed_version + 1 WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chirps_version_insert AFTER INSERT ON chirps
+BEGIN
+    UPDATE users SET feed_version = feed_version + 1 WHERE id = NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chirps_version_delete AFTER DELETE ON chirps
+BEGIN
+    UPDATE users SET feed_version = feed_version + 1 WHERE id = OLD.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chirps_version_update AFTER UPDATE ON chirps
+BEGIN
+    UPDATE users SET feed_version = feed_version + 1 WHERE id = NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chirp_stats_version AFTER UPDATE ON chirp_stats
+BEGIN
+    UPDATE users SET feed_version = feed_version + 1 WHERE id = (SELECT user_id FROM chirps WHERE id = NEW.chirp_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chirp_media_version AFTER UPDATE ON chirp_media
+BEGIN
+    UPDATE users SET feed_version = feed_version + 1 WHERE id = (SELECT user_id FROM chirps WHERE id = NEW.chirp_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_follows_version_insert AFTER INSERT ON follows
+BEGIN
+    UPDATE users SET activity_version = activity_version + 1 WHERE id = NEW.follower_id;
+    UPDATE users SET feed_version = feed_version + 1 WHERE id IN (NEW.follower_id, NEW.following_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_follows_version_delete AFTER DELETE ON follows
+BEGIN
+    UPDATE users SET activity_version = activity_version + 1 WHERE id = OLD.follower_id;
+    UPDATE users SET feed_version = feed_version + 1 WHERE id IN (OLD.follower_id, OLD.following_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_likes_version_insert AFTER INSERT ON likes
+BEGIN
+    UPDATE users SET activity_version = activity_version + 1 WHERE id = NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_likes_version_delete AFTER DELETE ON likes
+BEGIN
+    UPDATE users SET activity_version = activity_version + 1 WHERE id = OLD.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_retweets_version_insert AFTER INSERT ON retweets
+BEGIN
+    UPDATE users SET activity_version = activity_version + 1 WHERE id = NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_retweets_version_delete AFTER DELETE ON retweets
+BEGIN
+    UPDATE users SET activity_version = activity_version + 1 WHERE id = OLD.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_bookmarks_version_insert AFTER INSERT ON bookmarks
+BEGIN
+    UPDATE users SET activity_version = activity_version + 1 WHERE id = NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_bookmarks_version_delete AFTER DELETE ON bookmarks
+BEGIN
+    UPDATE users SET activity_version = activity_version + 1 WHERE id = OLD.user_id;
+END;
+
+-- Full-text search indexes (external content; kept in sync by the triggers below)
+CREATE VIRTUAL TABLE IF NOT EXISTS chirps_fts USING fts5(
+    content,
+    content='chirps', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+    username, full_name, bio,
+    content='users', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_chirps_fts_insert AFTER INSERT ON chirps
+BEGIN
+    INSERT INTO chirps_fts (rowid, content) VALUES (NEW.id, NEW.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chirps_fts_delete AFTER DELETE ON chirps
+BEGIN
+    INSERT INTO chirps_fts (chirps_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_chirps_fts_update AFTER UPDATE OF content ON chirps
+BEGIN
+    INSERT INTO chirps_fts (chirps_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+    INSERT INTO chirps_fts (rowid, content) VALUES (NEW.id, NEW.content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_fts_insert AFTER INSERT ON users
+BEGIN
+    INSERT INTO users_fts (rowid, username, full_name, bio) VALUES (NEW.id, NEW.username, NEW.full_name, NEW.bio);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_fts_delete AFTER DELETE ON users
+BEGIN
+    INSERT INTO users_fts (users_fts, rowid, username, full_name, bio) VALUES ('delete', OLD.id, OLD.username, OLD.full_name, OLD.bio);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_fts_update AFTER UPDATE OF username, full_name, bio ON users
+BEGIN
+    INSERT INTO users_fts (users_fts, rowid, username, full_name, bio) VALUES ('delete', OLD.id, OLD.username, OLD.full_name, OLD.bio);
+    INSERT INTO users_fts (rowid, username, full_name, bio) VALUES (NEW.id, NEW.username, NEW.full_name, NEW.bio);
+END;
+
 -- Create indexes for better performance
 CREATE INDEX IF NOT EXISTS idx_chirps_user_id ON chirps(user_id);
 CREATE INDEX IF NOT EXISTS idx_chirps_created_at ON chirps(created_at);
@@ -130,6 +477,19 @@ CREATE INDEX IF NOT EXISTS idx_retweets_user ON retweets(user_id);
 CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_id);
 CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages(receiver_id);
 CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages(created_at);
+-- Conversation key (participants in id order) then id, for paging a DM thread
+CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(min(sender_id, receiver_id), max(sender_id, receiver_id), id);
+CREATE INDEX IF NOT EXISTS idx_conversations_inbox ON conversations(user_id, last_message_at DESC, last_message_id DESC);
 CREATE INDEX IF NOT EXISTS idx_ai_analysis_chirp ON ai_analysis(chirp_id);
 CREATE INDEX IF NOT EXISTS idx_bookmarks_user ON bookmarks(user_id);
 CREATE INDEX IF NOT EXISTS idx_bookmarks_chirp ON bookmarks(chirp_id);
+CREATE INDEX IF NOT EXISTS idx_home_timeline_feed ON home_timeline(user_id, created_at DESC, chirp_id DESC);
+CREATE INDEX IF NOT EXISTS idx_home_timeline_author ON home_timeline(user_id, author_id);
+CREATE INDEX IF NOT EXISTS idx_home_timeline_chirp ON home_timeline(chirp_id);
+-- Keyset pagination: each feed page is a seek on (scope, created_at, id).
+-- Explore uses idx_chirps_created_at, which already ends in the rowid (id).
+CREATE INDEX IF NOT EXISTS idx_chirps_user_created ON chirps(user_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_bookmarks_user_created ON bookmarks(user_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_events_created ON events(created_at);
+CREATE INDEX IF NOT EXISTS idx_chirp_media_blob ON chirp_media(blob_key);
+CREATE INDEX IF NOT EXISTS idx_media_blobs_unreferenced ON media_blobs(updated_at) WHERE refcount <= 0;
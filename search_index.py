@@ -0,0 +1,133 @@
+"""
+Full-Text Search for ChirpX
+Queries the FTS5 indexes over chirps and users (see schema.sql) with BM25
+ranking, prefix matching and highlighted snippets. Chirp results are paged
+with (rank, id) cursors rather than OFFSET, up to SEARCH_MAX_RESULTS deep.
+"""
+
+import os
+import re
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+from markupsafe import Markup, escape
+
+import profiles
+
+# Settings (override through environment variables)
+# Matches are ranked as a whole for every page, so results stop this deep
+SEARCH_MAX_RESULTS = int(os.getenv('SEARCH_MAX_RESULTS', '500'))
+
+# Control characters never typed by users; swapped for <mark> after escaping
+_HIGHLIGHT_START = '\x02'
+_HIGHLIGHT_END = '\x03'
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+# BM25 column weights for users_fts(username, full_name, bio)
+_USER_WEIGHTS = (10.0, 5.0, 1.0)
+
+
+def build_match_query(raw: str) -> Optional[str]:
+    """
+    Turn free text into a safe FTS5 MATCH expression.
+    Every word is quoted (so operators and punctuation are inert) and matched
+    as a prefix; all words must match. Returns None when nothing is searchable.
+    """
+    terms = _TERM_RE.findall(raw or '')
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms[:16])
+
+
+def _highlight(snippet: Optional[str]) -> Optional[Markup]:
+    """Escape an FTS5 snippet and turn the match markers into <mark> tags"""
+    if snippet is None:
+        return None
+    return Markup(str(escape(snippet))
+                  .replace(_HIGHLIGHT_START, '<mark>')
+                  .replace(_HIGHLIGHT_END, '</mark>'))
+
+
+def search_chirps(conn: sqlite3.Connection, query: str, limit: int,
+                  after: Optional[Tuple[float, int]] = None) -> List[Dict]:
+    """
+    Chirps matching query, best match first, each with a highlighted 'snippet'
+    and its 'search_rank'. after is the (search_rank, id) of the last chirp of
+    the previous page.
+    """
+    match = build_match_query(query)
+    if match is None:
+        return []
+    seek, seek_params = '1', ()
+    if after is not None:
+        # Rank ascending (bm25 is lower for better matches), then id descending
+        seek, seek_params = 'search_rank > ? OR (search_rank = ? AND id < ?)', (after[0], after[0], after[1])
+    rows = conn.execute(f'''
+        SELECT * FROM (
+            SELECT c.*, bm25(chirps_fts) AS search_rank,
+                   snippet(chirps_fts, 0, '{_HIGHLIGHT_START}', '{_HIGHLIGHT_END}', '…', 32) AS snippet
+            FROM chirps_fts
+            JOIN chirps c ON c.id = chirps_fts.rowid
+            WHERE chirps_fts MATCH ?
+        )
+        WHERE {seek}
+        ORDER BY search_rank, id DESC
+        LIMIT ?
+    ''', (match, *seek_params, limit)).fetchall()
+
+    chirps = []
+    for row in rows:
+        chirp = dict(row)
+        chirp['snippet'] = _highlight(chirp['snippet'])
+        chirps.append(chirp)
+    return chirps
+
+
+def search_users(conn: sqlite3.Connection, query: str, limit: int = 20) -> List[Dict]:
+    """
+    Users whose username, name or bio match query, weighted towards usernames:
+    their profile headers (see profiles.py) plus a highlighted bio_snippet
+    """
+    match = build_match_query(query)
+    if match is None:
+        return []
+    rows = conn.execute(f'''
+        SELECT rowid AS id,
+               snippet(users_fts, 2, '{_HIGHLIGHT_START}', '{_HIGHLIGHT_END}', '…', 16) AS bio_snippet
+        FROM users_fts
+        WHERE users_fts MATCH ?
+        ORDER BY bm25(users_fts, {', '.join(map(str, _USER_WEIGHTS))})
+        LIMIT ?
+    ''', (match, limit)).fetchall()
+
+    headers = profiles.get_headers(conn, [row['id'] for row in rows])
+    users = []
+    for row in rows:
+        if row['id'] not in headers:
+            continue
+        user = dict(headers[row['id']])
+        user['bio_snippet'] = _highlight(row['bio_snippet']) if user['bio'] else None
+        users.append(user)
+    return users
+
+
+def rebuild_search_index(conn: sqlite3.Connection) -> None:
+    """Re-read every chirp and user into the FTS5 indexes"""
+    conn.execute("INSERT INTO chirps_fts(chirps_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+
+
+def backfill_if_empty(conn: sqlite3.Connection) -> bool:
+    """
+    Index existing rows once for databases created before the FTS tables existed.
+    Returns True when a rebuild was performed.
+    """
+    # External-content FTS5 tables read through to chirps/users, so check each
+    # index's own docsize shadow table to see whether anything was indexed
+    for table in ('chirps', 'users'):
+        has_rows = conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone()
+        indexed = conn.execute(f'SELECT 1 FROM {table}_fts_docsize LIMIT 1').fetchone()
+        if has_rows and not indexed:
+            rebuild_search_index(conn)
+            return True
+    return False
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+import db
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'schema.sql')
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """A fresh, fully initialized database that db.connect() opens by default"""
+    path = str(tmp_path / 'chirpx.db')
+    monkeypatch.setattr(db, 'DATABASE_PATH', path)
+    db.initialize(path, SCHEMA_PATH)
+    return path
+
+
+@pytest.fixture
+def conn(db_path):
+    conn = db.connect(db_path)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def make_user(conn):
+    def make_user(username):
+        cursor = conn.execute('INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
+                              (username, f'{username}@example.com', 'x'))
+        conn.commit()
+        return cursor.lastrowid
+    return make_user
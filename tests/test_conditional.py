@@ -0,0 +1,103 @@
+import pytest
+
+import conditional
+import profiles
+import timeline_store
+
+LIMIT = 20
+
+
+@pytest.fixture
+def world(conn, make_user):
+    """alice follows bob; bob has two chirps, carol one"""
+    alice, bob, carol = make_user('alice'), make_user('bob'), make_user('carol')
+    conn.execute('INSERT INTO follows (follower_id, following_id) VALUES (?, ?)', (alice, bob))
+    for user_id, content in ((bob, 'first'), (carol, 'unrelated'), (bob, 'second')):
+        post(conn, user_id, content)
+    conn.commit()
+    return conn, alice, bob, carol
+
+
+def post(conn, user_id, content):
+    chirp_id = conn.execute('INSERT INTO chirps (user_id, content) VALUES (?, ?)', (user_id, content)).lastrowid
+    timeline_store.fan_out_chirp(conn, chirp_id)
+    conn.commit()
+    return chirp_id
+
+
+def timeline(conn, viewer_id):
+    return conditional.timeline_etag(conn, viewer_id, None, LIMIT)
+
+
+def profile(conn, viewer_id, username):
+    header = profiles.get_header_by_username(conn, username)
+    return conditional.profile_etag(conn, viewer_id, header, None, LIMIT)
+
+
+def test_unchanged_pages_keep_their_etag(world):
+    conn, alice, bob, _ = world
+    assert timeline(conn, alice) == timeline(conn, alice)
+    assert profile(conn, alice, 'bob') == profile(conn, alice, 'bob')
+    assert conditional.explore_etag(conn, alice, None, LIMIT) == conditional.explore_etag(conn, alice, None, LIMIT)
+
+
+def test_etags_differ_by_viewer_page_and_limit(world):
+    conn, alice, bob, _ = world
+    assert timeline(conn, alice) != timeline(conn, bob)
+    assert timeline(conn, alice) != conditional.timeline_etag(conn, alice, None, LIMIT + 1)
+    newest = conn.execute('SELECT created_at, chirp_id FROM home_timeline WHERE user_id = ? '
+                          'ORDER BY created_at DESC, chirp_id DESC LIMIT 1', (alice,)).fetchone()
+    assert timeline(conn, alice) != conditional.timeline_etag(conn, alice, tuple(newest), LIMIT)
+
+
+def test_new_chirp_from_followed_user_changes_timeline(world):
+    conn, alice, bob, carol = world
+    before = timeline(conn, alice)
+    post(conn, carol, 'not followed')
+    assert timeline(conn, alice) == before
+    post(conn, bob, 'followed')
+    assert timeline(conn, alice) != before
+
+
+def test_viewer_activity_changes_their_pages(world):
+    conn, alice, bob, _ = world
+    chirp_id = conn.execute('SELECT id FROM chirps WHERE user_id = ? LIMIT 1', (bob,)).fetchone()[0]
+    before = (timeline(conn, alice), profile(conn, alice, 'bob'), timeline(conn, bob))
+    conn.execute('INSERT INTO likes (user_id, chirp_id) VALUES (?, ?)', (alice, chirp_id))
+    conn.commit()
+    after = (timeline(conn, alice), profile(conn, alice, 'bob'), timeline(conn, bob))
+    # alice's liked state and bob's like count are both on the cards
+    assert all(b != a for b, a in zip(before, after))
+
+
+def test_author_changes_invalidate_pages_showing_them(world):
+    conn, alice, bob, carol = world
+    before = (timeline(conn, alice), profile(conn, carol, 'bob'))
+    conn.execute("UPDATE users SET full_name = 'Bob B.' WHERE id = ?", (bob,))
+    conn.commit()
+    assert timeline(conn, alice) != before[0]
+    assert profile(conn, carol, 'bob') != before[1]
+
+
+def test_follow_changes_profile_counts(world):
+    conn, alice, bob, carol = world
+    before = profile(conn, alice, 'bob')
+    conn.execute('INSERT INTO follows (follower_id, following_id) VALUES (?, ?)', (carol, bob))
+    conn.commit()
+    assert profile(conn, alice, 'bob') != before
+
+
+def test_bookmarks_etag_follows_bookmarks(world):
+    conn, alice, bob, _ = world
+    before = conditional.bookmarks_etag(conn, alice, None, LIMIT)
+    chirp_id = conn.execute('SELECT id FROM chirps WHERE user_id = ? LIMIT 1', (bob,)).fetchone()[0]
+    conn.execute('INSERT INTO bookmarks (user_id, chirp_id) VALUES (?, ?)', (alice, chirp_id))
+    conn.commit()
+    assert conditional.bookmarks_etag(conn, alice, None, LIMIT) != before
+
+
+def test_deploy_changes_every_etag(world, monkeypatch):
+    conn, alice, _, _ = world
+    before = timeline(conn, alice)
+    monkeypatch.setattr(conditional, '_code_version', 'another-deploy')
+    assert timeline(conn, alice) != before
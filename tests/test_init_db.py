@@ -0,0 +1,98 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import db
+from conftest import SCHEMA_PATH
+
+ROOT = os.path.dirname(SCHEMA_PATH)
+
+# A database from before media blobs, denormalized counts and version counters
+OLD_SCHEMA = '''
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    email TEXT UNIQUE NOT NULL,
+    password TEXT NOT NULL,
+    full_name TEXT,
+    bio TEXT,
+    location TEXT,
+    website TEXT,
+    profile_picture TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE chirps (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+CREATE TABLE chirp_media (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chirp_id INTEGER NOT NULL,
+    media_url TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    display_order INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (chirp_id) REFERENCES chirps (id) ON DELETE CASCADE
+);
+CREATE TABLE follows (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    follower_id INTEGER NOT NULL,
+    following_id INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(follower_id, following_id)
+);
+INSERT INTO users (username, email, password) VALUES ('alice', 'alice@example.com', 'x'), ('bob', 'bob@example.com', 'x');
+INSERT INTO chirps (user_id, content) VALUES (1, 'hello world'), (1, 'second'), (2, 'from bob');
+INSERT INTO chirp_media (chirp_id, media_url, media_type) VALUES (1, 'uploads/old.jpg', 'image');
+INSERT INTO follows (follower_id, following_id) VALUES (2, 1);
+'''
+
+
+def old_database(tmp_path):
+    path = str(tmp_path / 'chirpx.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(OLD_SCHEMA)
+    conn.close()
+    return path
+
+
+def columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def test_initialize_upgrades_an_existing_database(tmp_path):
+    path = old_database(tmp_path)
+    db.initialize(path, SCHEMA_PATH)
+
+    conn = db.connect(path)
+    assert {'width', 'height', 'variants', 'blob_key'} <= columns(conn, 'chirp_media')
+    assert {'follower_count', 'chirp_count', 'feed_version', 'activity_version'} <= columns(conn, 'users')
+    counts = {row['username']: (row['follower_count'], row['following_count'], row['chirp_count'])
+              for row in conn.execute('SELECT * FROM users')}
+    assert counts == {'alice': (1, 0, 2), 'bob': (0, 1, 1)}
+    # Derived tables are filled for the rows that were already there
+    assert conn.execute('SELECT COUNT(*) FROM home_timeline WHERE user_id = 2').fetchone()[0] == 3
+    assert [tuple(row) for row in conn.execute("SELECT rowid FROM chirps_fts WHERE chirps_fts MATCH 'hello'")] == [(1,)]
+    conn.close()
+
+
+def test_initialize_twice_is_harmless(tmp_path):
+    path = old_database(tmp_path)
+    db.initialize(path, SCHEMA_PATH)
+    db.initialize(path, SCHEMA_PATH)
+    conn = db.connect(path)
+    assert conn.execute('SELECT chirp_count FROM users WHERE id = 1').fetchone()[0] == 2
+    conn.close()
+
+
+def test_init_db_script_on_an_existing_database(tmp_path):
+    old_database(tmp_path)
+    os.symlink(SCHEMA_PATH, tmp_path / 'schema.sql')
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'init_db.py')], cwd=tmp_path,
+                            capture_output=True, text=True, env={**os.environ, 'PYTHONPATH': ROOT})
+    assert result.returncode == 0, result.stderr
+    assert 'Database initialized successfully!' in result.stdout
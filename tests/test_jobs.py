@@ -0,0 +1,106 @@
+import pytest
+
+import jobs
+
+
+@pytest.fixture
+def handlers(monkeypatch):
+    """Register handlers for the duration of one test"""
+    monkeypatch.setattr(jobs, '_handlers', {})
+    monkeypatch.setattr(jobs, '_dead_handlers', {})
+    monkeypatch.setattr(jobs, '_retry_delay', lambda attempts: 0.0)
+    return jobs
+
+
+def job_row(conn, key):
+    return conn.execute('SELECT * FROM jobs WHERE key = ?', (key,)).fetchone()
+
+
+def test_enqueue_skips_a_job_that_is_already_pending(conn):
+    jobs.enqueue(conn, 'k', key='a', payload={'n': 1})
+    jobs.enqueue(conn, 'k', key='a', payload={'n': 2})
+    conn.commit()
+    assert conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0] == 1
+
+
+def test_enqueue_while_running_reruns_after_release(conn):
+    jobs.enqueue(conn, 'k', key='a')
+    job = jobs._claim(conn, 'w1')
+    assert job['status'] == jobs.RUNNING
+
+    # Queued again mid-run: pending, but still locked by w1, so nobody else takes it yet
+    jobs.enqueue(conn, 'k', key='a')
+    assert job_row(conn, 'a')['status'] == jobs.PENDING
+    assert jobs._claim(conn, 'w2') is None
+
+    # w1 finishing does not mark the rerun done; it only unlocks it
+    assert not jobs._release(conn, job, 'w1', jobs.DONE)
+    row = job_row(conn, 'a')
+    assert (row['status'], row['locked_by']) == (jobs.PENDING, None)
+    assert jobs._claim(conn, 'w2')['locked_by'] == 'w2'
+
+
+def test_stale_worker_cannot_release_a_reclaimed_job(conn, monkeypatch):
+    jobs.enqueue(conn, 'k', key='a')
+    stale = jobs._claim(conn, 'w1')
+    # w1's lease runs out and w2 takes the job over
+    monkeypatch.setattr(jobs, 'JOB_LEASE_SECONDS', -1.0)
+    current = jobs._claim(conn, 'w2')
+    assert current['id'] == stale['id'] and current['attempts'] == 2
+
+    assert not jobs._release(conn, stale, 'w1', jobs.DONE)
+    row = job_row(conn, 'a')
+    assert (row['status'], row['locked_by']) == (jobs.RUNNING, 'w2')
+
+    assert jobs._release(conn, current, 'w2', jobs.DONE)
+    row = job_row(conn, 'a')
+    assert (row['status'], row['locked_by']) == (jobs.DONE, None)
+
+
+def test_failures_retry_then_dead_letter(conn, handlers):
+    calls, dead = [], []
+
+    @handlers.handler('flaky')
+    def flaky(conn, payload):
+        calls.append(payload)
+        raise RuntimeError('boom')
+
+    @handlers.on_dead('flaky')
+    def flaky_dead(conn, payload, error):
+        dead.append((payload, error))
+
+    jobs.enqueue(conn, 'flaky', key='a', payload={'n': 1}, max_attempts=3)
+    conn.commit()
+    while jobs.run_one(conn):
+        pass
+    row = job_row(conn, 'a')
+    assert (row['status'], row['attempts']) == (jobs.DEAD, 3)
+    assert row['last_error'] == 'RuntimeError: boom'
+    assert len(calls) == 3
+    assert dead == [({'n': 1}, 'RuntimeError: boom')]
+
+
+def test_success_after_a_retry(conn, handlers):
+    attempts = []
+
+    @handlers.handler('once')
+    def once(conn, payload):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError('first try')
+
+    jobs.enqueue(conn, 'once', key='a')
+    conn.commit()
+    while jobs.run_one(conn):
+        pass
+    row = job_row(conn, 'a')
+    assert (row['status'], row['attempts'], row['last_error']) == (jobs.DONE, 2, None)
+
+
+def test_requeue_dead(conn):
+    jobs.enqueue(conn, 'k', key='a')
+    job = jobs._claim(conn, 'w1')
+    jobs._release(conn, job, 'w1', jobs.DEAD, 'gave up')
+    assert jobs.requeue_dead(conn) == 1
+    row = job_row(conn, 'a')
+    assert (row['status'], row['attempts'], row['last_error']) == (jobs.PENDING, 0, None)
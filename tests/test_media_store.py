@@ -0,0 +1,109 @@
+import io
+import os
+import time
+
+import pytest
+from PIL import Image
+
+import images
+import media_store
+
+
+@pytest.fixture
+def media_root(tmp_path, monkeypatch):
+    root = tmp_path / 'static'
+    monkeypatch.setattr(media_store, 'MEDIA_ROOT', str(root))
+    # Process images in the test's own process
+    monkeypatch.setattr(images, 'IMAGE_WORKERS', 0)
+    return root
+
+
+def refcount(conn, key):
+    return conn.execute('SELECT refcount FROM media_blobs WHERE key = ?', (key,)).fetchone()['refcount']
+
+
+def add_chirp(conn, user_id, blob):
+    chirp_id = conn.execute('INSERT INTO chirps (user_id, content) VALUES (?, ?)', (user_id, 'pic')).lastrowid
+    conn.execute('INSERT INTO chirp_media (chirp_id, media_url, media_type, blob_key) VALUES (?, ?, ?, ?)',
+                 (chirp_id, blob['url'], 'video', blob['key']))
+    conn.commit()
+    return chirp_id
+
+
+def png(color):
+    buf = io.BytesIO()
+    Image.new('RGB', (64, 48), color).save(buf, 'PNG')
+    buf.seek(0)
+    return buf
+
+
+def test_identical_uploads_share_one_blob(conn, media_root):
+    first = media_store.store(conn, io.BytesIO(b'video bytes'), 'MP4', media_store.FILE)
+    second = media_store.store(conn, io.BytesIO(b'video bytes'), 'mp4', media_store.FILE)
+    assert first == second
+    assert first['url'].endswith('.mp4') and os.path.exists(media_root / first['url'])
+    assert conn.execute('SELECT COUNT(*) FROM media_blobs').fetchone()[0] == 1
+    # Each blob row is committed by store() itself, leaving no write transaction open
+    assert not conn.in_transaction
+
+
+def test_image_and_avatar_of_one_file_are_separate_blobs(conn, media_root):
+    image = media_store.store(conn, png((10, 20, 30)), 'png', media_store.IMAGE)
+    avatar = media_store.store(conn, png((10, 20, 30)), 'png', media_store.AVATAR)
+    assert avatar['key'] == f"{media_store.AVATAR}:{image['key']}"
+    assert (image['width'], image['height']) == (64, 48)
+    assert image['variants'] and avatar['variants']
+
+
+def test_unreadable_image_is_rejected(conn, media_root):
+    with pytest.raises(images.InvalidImage):
+        media_store.store(conn, io.BytesIO(b'not an image'), 'jpg', media_store.IMAGE)
+    assert conn.execute('SELECT COUNT(*) FROM media_blobs').fetchone()[0] == 0
+
+
+def test_refcount_follows_chirps_and_avatars(conn, media_root, make_user):
+    alice = make_user('alice')
+    blob = media_store.store(conn, io.BytesIO(b'clip'), 'mp4', media_store.FILE)
+    assert refcount(conn, blob['key']) == 0
+
+    first = add_chirp(conn, alice, blob)
+    add_chirp(conn, alice, blob)
+    assert refcount(conn, blob['key']) == 2
+
+    conn.execute('DELETE FROM chirps WHERE id = ?', (first,))
+    conn.commit()
+    assert refcount(conn, blob['key']) == 1
+
+    old = media_store.store(conn, png((1, 1, 1)), 'png', media_store.AVATAR)
+    new = media_store.store(conn, png((2, 2, 2)), 'png', media_store.AVATAR)
+    conn.execute('UPDATE users SET profile_picture_blob = ? WHERE id = ?', (old['key'], alice))
+    conn.execute('UPDATE users SET profile_picture_blob = ? WHERE id = ?', (new['key'], alice))
+    conn.commit()
+    assert (refcount(conn, old['key']), refcount(conn, new['key'])) == (0, 1)
+
+
+def test_garbage_collection_keeps_used_and_recent_blobs(conn, media_root, make_user):
+    alice = make_user('alice')
+    used = media_store.store(conn, io.BytesIO(b'used'), 'mp4', media_store.FILE)
+    unused = media_store.store(conn, io.BytesIO(b'unused'), 'mp4', media_store.FILE)
+    add_chirp(conn, alice, used)
+
+    # Inside the grace period nothing goes: an upload may be about to reference it
+    assert media_store.collect_garbage(conn, grace_seconds=3600) == 0
+
+    conn.execute('UPDATE media_blobs SET updated_at = ?', (time.time() - 7200,))
+    assert media_store.collect_garbage(conn, grace_seconds=3600) == 1
+    conn.commit()
+    assert not os.path.exists(media_root / unused['url'])
+    assert os.path.exists(media_root / used['url'])
+    assert [row['key'] for row in conn.execute('SELECT key FROM media_blobs')] == [used['key']]
+
+
+def test_reconcile_refcounts_repairs_drift(conn, media_root, make_user):
+    alice = make_user('alice')
+    blob = media_store.store(conn, io.BytesIO(b'clip'), 'mp4', media_store.FILE)
+    add_chirp(conn, alice, blob)
+    conn.execute('UPDATE media_blobs SET refcount = 5')
+    assert media_store.reconcile_refcounts(conn) == 1
+    assert refcount(conn, blob['key']) == 1
+    assert media_store.reconcile_refcounts(conn) == 0
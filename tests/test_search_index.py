@@ -0,0 +1,53 @@
+import pytest
+
+import search_index
+
+
+@pytest.mark.parametrize('raw, expected', [
+    ('python flask', '"python"* "flask"*'),
+    ('NOT python OR AND', '"NOT"* "python"* "OR"* "AND"*'),
+    ('"quoted" phrase*', '"quoted"* "phrase"*'),
+    ('col:value (group) -minus ^start', '"col"* "value"* "group"* "minus"* "start"*'),
+    ('café naïve', '"café"* "naïve"*'),
+])
+def test_build_match_query_quotes_every_term(raw, expected):
+    assert search_index.build_match_query(raw) == expected
+
+
+@pytest.mark.parametrize('raw', [None, '', '   ', '"*()^:-'])
+def test_build_match_query_without_terms(raw):
+    assert search_index.build_match_query(raw) is None
+
+
+def test_build_match_query_caps_the_number_of_terms():
+    assert search_index.build_match_query(' '.join(f'w{i}' for i in range(40))).count('*') == 16
+
+
+@pytest.fixture
+def chirps(conn, make_user):
+    alice = make_user('alice')
+    for content in ('python tips', 'NOT a python OR "flask" thing', 'python python python', 'about flask'):
+        conn.execute('INSERT INTO chirps (user_id, content) VALUES (?, ?)', (alice, content))
+    conn.commit()
+    return conn
+
+
+@pytest.mark.parametrize('query', ['NOT', 'python OR', '"flask', 'python)', 'content:python', 'NEAR(python'])
+def test_operator_input_is_searched_as_text(chirps, query):
+    # Would raise sqlite3.OperationalError if any of it reached FTS5 as syntax
+    search_index.search_chirps(chirps, query, 10)
+
+
+def test_search_highlights_matches(chirps):
+    results = search_index.search_chirps(chirps, 'flask', 10)
+    assert {r['content'] for r in results} == {'NOT a python OR "flask" thing', 'about flask'}
+    assert all('<mark>' in r['snippet'] for r in results)
+
+
+def test_search_pages_by_rank_and_id(chirps):
+    everything = [r['id'] for r in search_index.search_chirps(chirps, 'python', 10)]
+    assert len(everything) == 3
+    first = search_index.search_chirps(chirps, 'python', 2)
+    last = first[-1]
+    rest = search_index.search_chirps(chirps, 'python', 2, after=(last['search_rank'], last['id']))
+    assert [r['id'] for r in first + rest] == everything
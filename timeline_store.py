@@ -0,0 +1,97 @@
+"""
+Home Timeline Store for ChirpX
+Materialized per-user home feeds (fan-out on write)
+"""
+
+import os
+import sqlite3
+from typing import Optional
+
+# How many of a newly followed user's most recent chirps are copied into the
+# follower's home timeline. Older chirps are still reachable via their profile.
+FOLLOW_BACKFILL_LIMIT = int(os.getenv('TIMELINE_FOLLOW_BACKFILL', '200'))
+
+
+def fan_out_chirp(conn: sqlite3.Connection, chirp_id: int) -> int:
+    """
+    Push a freshly inserted chirp into the home timeline of its author
+    and of every follower of the author.
+    Must run on the same connection (and transaction) as the chirp insert.
+    Returns the number of home timelines the chirp was delivered to.
+    """
+    cursor = conn.execute('''
+        INSERT OR IGNORE INTO home_timeline (user_id, chirp_id, author_id, created_at)
+        SELECT f.follower_id, c.id, c.user_id, c.created_at
+        FROM chirps c
+        JOIN follows f ON f.following_id = c.user_id
+        WHERE c.id = ?
+        UNION ALL
+        SELECT c.user_id, c.id, c.user_id, c.created_at
+        FROM chirps c
+        WHERE c.id = ?
+    ''', (chirp_id, chirp_id))
+    return cursor.rowcount
+
+
+def remove_chirp(conn: sqlite3.Connection, chirp_id: int) -> None:
+    """Remove a deleted chirp from every home timeline it was delivered to"""
+    conn.execute('DELETE FROM home_timeline WHERE chirp_id = ?', (chirp_id,))
+
+
+def add_follow(conn: sqlite3.Connection, follower_id: int, following_id: int,
+               limit: int = FOLLOW_BACKFILL_LIMIT) -> None:
+    """Backfill the follower's home timeline with the followed user's recent chirps"""
+    conn.execute('''
+        INSERT OR IGNORE INTO home_timeline (user_id, chirp_id, author_id, created_at)
+        SELECT ?, c.id, c.user_id, c.created_at
+        FROM chirps c
+        WHERE c.user_id = ?
+        ORDER BY c.created_at DESC, c.id DESC
+        LIMIT ?
+    ''', (follower_id, following_id, limit))
+
+
+def remove_follow(conn: sqlite3.Connection, follower_id: int, following_id: int) -> None:
+    """Drop the unfollowed user's chirps from the follower's home timeline"""
+    conn.execute('DELETE FROM home_timeline WHERE user_id = ? AND author_id = ?',
+                 (follower_id, following_id))
+
+
+def rebuild_home_timelines(conn: sqlite3.Connection, user_id: Optional[int] = None) -> int:
+    """
+    Recompute home timelines from the chirps and follows tables.
+    Rebuilds a single user's timeline when user_id is given, otherwise all of them.
+    Returns the number of timeline entries written.
+    """
+    if user_id is None:
+        conn.execute('DELETE FROM home_timeline')
+        user_filter, params = '', ()
+    else:
+        conn.execute('DELETE FROM home_timeline WHERE user_id = ?', (user_id,))
+        user_filter, params = 'WHERE reader_id = ?', (user_id,)
+
+    cursor = conn.execute(f'''
+        INSERT OR IGNORE INTO home_timeline (user_id, chirp_id, author_id, created_at)
+        SELECT reader_id, c.id, c.user_id, c.created_at
+        FROM (
+            SELECT follower_id AS reader_id, following_id AS author_id FROM follows
+            UNION
+            SELECT id, id FROM users
+        )
+        JOIN chirps c ON c.user_id = author_id
+        {user_filter}
+    ''', params)
+    return cursor.rowcount
+
+
+def backfill_if_empty(conn: sqlite3.Connection) -> bool:
+    """
+    Populate the store once for databases created before it existed.
+    Returns True when a rebuild was performed.
+    """
+    if conn.execute('SELECT 1 FROM home_timeline LIMIT 1').fetchone():
+        return False
+    if not conn.execute('SELECT 1 FROM chirps LIMIT 1').fetchone():
+        return False
+    rebuild_home_timelines(conn)
+    return True
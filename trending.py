@@ -0,0 +1,214 @@
+"""
+Trending Topics for ChirpX
+A streaming heavy-hitters detector over chirp hashtags and terms: time-decayed
+counts in a count-min sketch with a top-k candidate set. The LLM is only asked
+now and then to label the top terms; the labeled result is shared through the
+trending_snapshots table.
+"""
+
+import calendar
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Settings (override through environment variables)
+TRENDING_HALF_LIFE_HOURS = float(os.getenv('TRENDING_HALF_LIFE_HOURS', '6'))
+TRENDING_WINDOW_HOURS = int(os.getenv('TRENDING_WINDOW_HOURS', '24'))
+TRENDING_REFRESH_SECONDS = int(os.getenv('TRENDING_REFRESH_SECONDS', '300'))
+TRENDING_TOP_K = int(os.getenv('TRENDING_TOP_K', '100'))
+TRENDING_SKETCH_WIDTH = int(os.getenv('TRENDING_SKETCH_WIDTH', '4096'))
+TRENDING_SKETCH_DEPTH = int(os.getenv('TRENDING_SKETCH_DEPTH', '4'))
+
+HASHTAG_WEIGHT = 3.0
+TERM_WEIGHT = 1.0
+
+_HASHTAG_RE = re.compile(r'#(\w+)', re.UNICODE)
+_URL_RE = re.compile(r'(?:https?://|www\.)\S+|@\w+', re.IGNORECASE)
+_WORD_RE = re.compile(r'[^\W\d_]{3,}', re.UNICODE)
+
+STOP_WORDS = frozenset('''
+    about after again all also and any are because been before being but can
+    could did does doing don down each even every few for from get got had has
+    have having her here hers him his how its just like made make many more
+    most much must not now off once one only other our out over own really
+    said same see she should some still such than that the their them then
+    there these they thing think this those through too under until very was
+    way well were what when where which while who why will with would yes yet
+    you your today day new good great know want going time people just lol
+'''.split())
+
+
+def extract_terms(content: str) -> Dict[str, float]:
+    """Weighted hashtags ('#tag') and plain terms of one chirp, each counted once"""
+    terms: Dict[str, float] = {}
+    for tag in _HASHTAG_RE.findall(content):
+        terms['#' + tag.lower()] = HASHTAG_WEIGHT
+    text = _HASHTAG_RE.sub(' ', _URL_RE.sub(' ', content))
+    for word in _WORD_RE.findall(text.lower()):
+        if word not in STOP_WORDS and '#' + word not in terms:
+            terms[word] = TERM_WEIGHT
+    return terms
+
+
+class CountMinSketch:
+    """Approximate counters for an unbounded set of keys in fixed memory (never undercounts)"""
+
+    def __init__(self, width: int = TRENDING_SKETCH_WIDTH, depth: int = TRENDING_SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self._rows = [array('d', bytes(8 * width)) for _ in range(depth)]
+
+    def _cells(self, key: str) -> Iterable[Tuple[array, int]]:
+        digest = hashlib.blake2b(key.encode(), digest_size=8 * self.depth).digest()
+        for i, row in enumerate(self._rows):
+            yield row, int.from_bytes(digest[8 * i:8 * i + 8], 'little') % self.width
+
+    def add(self, key: str, amount: float) -> float:
+        """Add amount to key (conservative update) and return its new estimate"""
+        cells = list(self._cells(key))
+        estimate = min(row[col] for row, col in cells) + amount
+        for row, col in cells:
+            if row[col] < estimate:
+                row[col] = estimate
+        return estimate
+
+    def estimate(self, key: str) -> float:
+        return min(row[col] for row, col in self._cells(key))
+
+    def scale(self, factor: float) -> None:
+        for row in self._rows:
+            for col in range(self.width):
+                row[col] *= factor
+
+
+class TrendDetector:
+    """
+    Time-decayed heavy hitters. Counts use forward decay: an observation at time t
+    adds weight * e^((t - landmark) / tau), so stored values compare directly and
+    are decayed to "now" only when read.
+    """
+
+    def __init__(self, half_life_hours: float = TRENDING_HALF_LIFE_HOURS, top_k: int = TRENDING_TOP_K):
+        self.tau = half_life_hours * 3600 / math.log(2)
+        self.top_k = top_k
+        self.sketch = CountMinSketch()
+        self.landmark = time.time()
+        self.last_chirp_id: Optional[int] = None
+        self._top: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def _rebase(self, now: float) -> None:
+        # Keep the forward-decay multipliers from overflowing
+        factor = math.exp(-(now - self.landmark) / self.tau)
+        self.sketch.scale(factor)
+        self._top = {term: value * factor for term, value in self._top.items()}
+        self.landmark = now
+
+    def observe(self, content: str, timestamp: float) -> None:
+        """Count the terms of one chirp posted at timestamp (unix time)"""
+        with self._lock:
+            if (timestamp - self.landmark) / self.tau > 50:
+                self._rebase(timestamp)
+            boost = math.exp((timestamp - self.landmark) / self.tau)
+            for term, weight in extract_terms(content).items():
+                estimate = self.sketch.add(term, weight * boost)
+                if term in self._top or len(self._top) < self.top_k:
+                    self._top[term] = estimate
+                else:
+                    weakest = min(self._top, key=self._top.get)
+                    if estimate > self._top[weakest]:
+                        del self._top[weakest]
+                        self._top[term] = estimate
+
+    def top(self, n: int = 20, now: Optional[float] = None) -> List[Tuple[str, float]]:
+        """The n heaviest terms with their decayed weight at now"""
+        now = now or time.time()
+        with self._lock:
+            decay = math.exp(-(now - self.landmark) / self.tau)
+            ranked = sorted(self._top.items(), key=lambda item: item[1], reverse=True)[:n]
+        return [(term, round(value * decay, 3)) for term, value in ranked]
+
+    def sync(self, conn: sqlite3.Connection) -> int:
+        """
+        Feed chirps posted since the last sync (from any worker) into the detector.
+        The first sync reads the whole TRENDING_WINDOW_HOURS window.
+        Returns the number of chirps observed.
+        """
+        with self._sync_lock:
+            if self.last_chirp_id is None:
+                rows = conn.execute('''
+                    SELECT id, content, created_at FROM chirps
+                    WHERE created_at >= datetime('now', ?)
+                    ORDER BY id
+                ''', (f'-{TRENDING_WINDOW_HOURS} hours',)).fetchall()
+                latest = conn.execute('SELECT MAX(id) FROM chirps').fetchone()[0]
+            else:
+                rows = conn.execute('SELECT id, content, created_at FROM chirps WHERE id > ? ORDER BY id',
+                                    (self.last_chirp_id,)).fetchall()
+                latest = rows[-1]['id'] if rows else self.last_chirp_id
+
+            for row in rows:
+                self.observe(row['content'], _timestamp(row['created_at']))
+            self.last_chirp_id = latest or 0
+            return len(rows)
+
+
+def _timestamp(created_at: str) -> float:
+    """SQLite CURRENT_TIMESTAMP text (UTC) to unix time"""
+    try:
+        return calendar.timegm(time.strptime(created_at[:19], '%Y-%m-%d %H:%M:%S'))
+    except (TypeError, ValueError):
+        return time.time()
+
+
+_detector: Optional[TrendDetector] = None
+_detector_pid: Optional[int] = None
+_detector_lock = threading.Lock()
+
+
+def get_detector() -> TrendDetector:
+    """This process's detector"""
+    global _detector, _detector_pid
+    pid = os.getpid()
+    if _detector is None or _detector_pid != pid:
+        with _detector_lock:
+            if _detector is None or _detector_pid != pid:
+                _detector = TrendDetector()
+                _detector_pid = pid
+    return _detector
+
+
+def local_topics(terms: List[Tuple[str, float]], top_n: int = 5) -> List[Dict]:
+    """Unlabeled topics straight from the detector, relevance scaled to the top term"""
+    if not terms:
+        return []
+    heaviest = terms[0][1] or 1.0
+    return [{'topic': term, 'relevance': round(weight / heaviest, 2), 'terms': [term]}
+            for term, weight in terms[:top_n]]
+
+
+def latest_snapshot(conn: sqlite3.Connection) -> Optional[Dict]:
+    """The most recent labeled topics: {'topics': [...], 'computed_at': unix time}"""
+    row = conn.execute('SELECT topics, computed_at FROM trending_snapshots ORDER BY id DESC LIMIT 1').fetchone()
+    if not row:
+        return None
+    return {'topics': json.loads(row['topics']), 'computed_at': row['computed_at']}
+
+
+def is_stale(snapshot: Optional[Dict]) -> bool:
+    return snapshot is None or time.time() - snapshot['computed_at'] >= TRENDING_REFRESH_SECONDS
+
+
+def save_snapshot(conn: sqlite3.Connection, topics: List[Dict]) -> None:
+    """Publish topics to every worker and drop older snapshots"""
+    cursor = conn.execute('INSERT INTO trending_snapshots (topics, computed_at) VALUES (?, ?)',
+                          (json.dumps(topics), time.time()))
+    conn.execute('DELETE FROM trending_snapshots WHERE id < ?', (cursor.lastrowid,))